@@ -0,0 +1,187 @@
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, DataLoader, get_worker_info
+from wsd_data import WSDDataset, StreamingCorpus
+
+'''
+torch data pipelines over the WSD corpora for the emb2seq trainers
+the worker processes read the sentences and build the tensors
+while the main process runs the model
+'''
+
+class WSDSentenceDataset(Dataset):
+	"""Map-style dataset over a compiled corpus (see wsd_data.compile_corpus)
+	The memory-mapped arrays are opened lazily, once in each worker process.
+	"""
+
+	def __init__(self, data_dir):
+		self.data_dir = data_dir
+		self.corpus = None
+		corpus = WSDDataset(data_dir)
+		self.length = len(corpus)
+
+		# the number of tokens and tagged words of each sentence, for the buckets
+		self.sentence_lengths = np.diff(corpus.sentence_offsets)
+		self.instance_counts = np.diff(corpus.instance_offsets)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, idx):
+		if self.corpus is None:
+			self.corpus = WSDDataset(self.data_dir)
+		return self.corpus[idx]
+
+class WSDStreamDataset(IterableDataset):
+	"""Iterable dataset over a StreamingCorpus (the XML read on the fly)
+	Every worker streams the XML and processes every num_workers-th sentence only.
+	With a bucket budget, the sentences are buffered bucket_pool at a time
+	and yielded as lists of sentences of similar length.
+	"""
+
+	def __init__(self, corpus, max_instances = None, max_tokens = None, bucket_pool = 1000, shuffle = False):
+		self.corpus = corpus
+		self.max_instances = max_instances
+		self.max_tokens = max_tokens
+		self.bucket_pool = bucket_pool
+		self.shuffle = shuffle
+
+	# each worker only processes its own shard of the sentences (see StreamingCorpus.iter_shard)
+	def _sentences(self):
+		worker_info = get_worker_info()
+		if worker_info is None:
+			return iter(self.corpus)
+		return self.corpus.iter_shard(worker_info.id, worker_info.num_workers)
+
+	def _buckets(self, pool):
+		batches = bucket_batches(
+			[len(item[0]) for item in pool],
+			[len(item[1]) for item in pool],
+			self.max_instances,
+			self.max_tokens)
+		if self.shuffle:
+			random.shuffle(batches)
+		for batch in batches:
+			yield [pool[idx] for idx in batch]
+
+	def __iter__(self):
+		if self.max_instances is None and self.max_tokens is None:
+			yield from self._sentences()
+			return
+
+		pool = []
+		for item in self._sentences():
+			pool.append(item)
+			if len(pool) == self.bucket_pool:
+				yield from self._buckets(pool)
+				pool = []
+		yield from self._buckets(pool)
+
+# group sentences of similar length into batches
+# sorted by length, a batch is closed once adding the next sentence would exceed
+# max_instances tagged words or max_tokens padded tokens (batch size * longest sentence)
+# a sentence over the budget on its own is a batch by itself
+def bucket_batches(sentence_lengths, instance_counts, max_instances = None, max_tokens = None):
+	order = np.argsort(np.asarray(sentence_lengths), kind = 'stable')
+
+	batches = []
+	batch, instances = [], 0
+	for idx in order.tolist():
+		length, count = int(sentence_lengths[idx]), int(instance_counts[idx])
+		full = (max_instances is not None and instances + count > max_instances) or \
+			(max_tokens is not None and (len(batch) + 1) * length > max_tokens)
+		if batch and full:
+			batches.append(batch)
+			batch, instances = [], 0
+		batch.append(idx)
+		instances += count
+	if batch:
+		batches.append(batch)
+	return batches
+
+class BucketBatchSampler(Sampler):
+	"""Batches of sentence indices of similar length, see bucket_batches
+	The buckets are fixed; with shuffle, their order changes every epoch.
+	"""
+
+	def __init__(self, sentence_lengths, instance_counts, max_instances = None, max_tokens = None, shuffle = True):
+		self.batches = bucket_batches(sentence_lengths, instance_counts, max_instances, max_tokens)
+		self.shuffle = shuffle
+
+	def __iter__(self):
+		batches = list(self.batches)
+		if self.shuffle:
+			random.shuffle(batches)
+		return iter(batches)
+
+	def __len__(self):
+		return len(self.batches)
+
+# turn a list of sentence items into ready-to-use tensors
+def collate_sentences(items):
+	'''
+	items: list of (sentence, spans, definitions, literal_definitions)
+
+	@return: a dict of
+	sentences: list of the sentences (lists of tokens)
+	spans: (total tagged, 2) the (start, end) token positions in their sentence
+	offsets: (batch + 1) the tagged words of sentence i are rows offsets[i]:offsets[i + 1]
+	definitions: (total tagged, max_length) the definition ids of all tagged words
+	literal_definitions: list of the literal definitions of each sentence
+	'''
+	sentences = [item[0] for item in items]
+	spans = torch.cat([torch.as_tensor(item[1], dtype = torch.long).view(-1, 2) for item in items])
+	definitions = torch.cat([torch.as_tensor(item[2], dtype = torch.long) for item in items])
+
+	offsets = [0]
+	for item in items:
+		offsets.append(offsets[-1] + len(item[1]))
+
+	return {
+		'sentences': sentences,
+		'spans': spans,
+		'offsets': torch.tensor(offsets, dtype = torch.long),
+		'definitions': definitions,
+		'literal_definitions': [item[3] for item in items]}
+
+# the DataLoader of a corpus, prefetching in worker processes
+# corpus: a WSDDataset directory (str) or a StreamingCorpus
+# max_instances / max_tokens: the budget of the length buckets, instead of batch_size sentences
+def make_loader(corpus, batch_size = 1, num_workers = 2, prefetch_factor = 4,
+				max_instances = None, max_tokens = None, shuffle = False):
+	bucketed = max_instances is not None or max_tokens is not None
+
+	batching = {'batch_size': batch_size}
+	if isinstance(corpus, str):
+		dataset = WSDSentenceDataset(corpus)
+		if bucketed:
+			batching = {'batch_sampler': BucketBatchSampler(
+				dataset.sentence_lengths,
+				dataset.instance_counts,
+				max_instances = max_instances,
+				max_tokens = max_tokens,
+				shuffle = shuffle)}
+		else:
+			batching['shuffle'] = shuffle
+	elif isinstance(corpus, StreamingCorpus):
+		dataset = WSDStreamDataset(corpus, max_instances = max_instances, max_tokens = max_tokens, shuffle = shuffle)
+
+		# the dataset yields whole buckets
+		if bucketed:
+			batching = {'batch_size': None}
+	else:
+		raise ValueError('corpus must be a compiled corpus directory or a StreamingCorpus')
+
+	options = {}
+	if num_workers > 0:
+		options['prefetch_factor'] = prefetch_factor
+		options['persistent_workers'] = True
+
+	return DataLoader(
+		dataset,
+		num_workers = num_workers,
+		collate_fn = collate_sentences,
+		pin_memory = torch.cuda.is_available(),
+		**batching,
+		**options)
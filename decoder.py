@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
+from torch.nn.utils.rnn import pack_padded_sequence
 import math
 
 '''
@@ -13,7 +15,11 @@ class Decoder(nn.Module):
 				max_seq_length, # max length of definition generated is 18 with <start> and <end>
 				hidden_size, # length of the generated word embedding 
 				input_size = 512, # concat the sense embedding and the generated word embedding (2 * 256)
-				device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')):
+				device = torch.device('cuda' if torch.cuda.is_available() else 'cpu'),
+				output_layer = 'linear', # 'linear', 'adaptive' (adaptive softmax) or 'sampled' (sampled softmax in training)
+				word_counts = None, # frequency of each word of the vocab, for the 'adaptive' and 'sampled' output layers
+				cutoffs = (2000, 10000), # frequency buckets of the adaptive softmax: the head has the 2000 most frequent words
+				num_sampled = 1024): # negative words per step of the sampled softmax
 
 		"""Build the layers in the decoder."""
 		super(Decoder, self).__init__()
@@ -23,31 +29,374 @@ class Decoder(nn.Module):
 		self.vocab_size = vocab_size
 		self.input_size = input_size
 		
-		# the decoding LSTM
-		self.lstm_cell = nn.LSTMCell(self.input_size, self.hidden_size)
+		# the decoding LSTM, run one time step at a time (see step)
+		# or over a whole sequence for the fully teacher-forced decoding (see forward_sequence)
+		# the checkpoints of the former nn.LSTMCell still load (see _load_from_state_dict)
+		self.lstm = nn.LSTM(self.input_size, self.hidden_size)
 		
 		# project the output from LSTM to vocabulary space
-		self.linear = nn.Linear(self.hidden_size, self.vocab_size)
+		# the adaptive softmax replaces the dense projection
+		# the sampled softmax only changes the training loss (see output_loss)
+		self.output_layer = output_layer
+		if output_layer == 'adaptive':
+			cutoffs = [cutoff for cutoff in cutoffs if cutoff < self.vocab_size]
+			self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(self.hidden_size, self.vocab_size, cutoffs, div_value = 4.0)
+		elif output_layer in ('linear', 'sampled'):
+			self.linear = nn.Linear(self.hidden_size, self.vocab_size)
+		else:
+			raise ValueError("output_layer must be 'linear', 'adaptive' or 'sampled'")
+
+		if output_layer != 'linear':
+			if word_counts is None:
+				raise ValueError('the {} output layer needs the word counts'.format(output_layer))
+			counts = torch.as_tensor(np.asarray(word_counts), dtype = torch.float)
+
+		# the adaptive softmax classes are the words by decreasing frequency
+		if output_layer == 'adaptive':
+			word_order = torch.sort(counts, descending = True, stable = True)[1]
+			self.register_buffer('word_order', word_order)
+			self.register_buffer('word_rank', torch.empty_like(word_order).scatter_(0, word_order, torch.arange(self.vocab_size)))
+
+		# the negative words are drawn from the unigram ** 0.75 distribution
+		if output_layer == 'sampled':
+			sampling_probs = counts.clamp(min = 1) ** 0.75
+			self.register_buffer('sampling_log_probs', (sampling_probs / sampling_probs.sum()).log())
+			self.num_sampled = num_sampled
 
 		# max length of sense used during decoding
 		self.max_seq_length = max_seq_length 
 		
+	# the input projection of the part of the input constant over the decoding
+	# computed once per sequence, see forward
+	def project_context(self, context_embedding):
+		'''
+		context_embedding (batch_size, context_size): the encoder (sense) embedding,
+		the first context_size columns of every decoder input
+
+		@return: context_gates (batch_size, 4 * hidden_size), with both biases
+		'''
+		context_size = context_embedding.size()[1]
+		weight = self.lstm.weight_ih_l0[:, :context_size]
+		return F.linear(context_embedding, weight, self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+
 	# this forward method only takes 1 time step
 	# explicitly iterate through the max_length to decode
 	# see the forward method of 'seq2seq_model' 
-	def forward(self, sense_embedding, hidden, cell):
+	def forward(self, sense_embedding, hidden, cell, context_gates = None):
 		'''
 		the predicted word in the embedding:
 		sense_embedding (batch_size, input_size): concat of the encoder embedding and the generated word embedding
 		hidden, cell of shape (batch, hidden_size)
+		context_gates (batch_size, 4 * hidden_size): the hoisted projection of the encoder embedding (see project_context)
+			then sense_embedding is only the generated word embedding (batch_size, word_embed_size)
 		'''
 
 		# LSTM for 1 time step: generating the next embedding
 		# (batch, hidden_size)
-		(hidden, cell) = self.lstm_cell(sense_embedding, (hidden, cell))
+		hidden, cell = self.step(sense_embedding, hidden, cell, context_gates)
 		
 		# project to the vocab
 		# (batch_size, vocab_size)
-		output = self.linear(hidden)
+		output = self.project(hidden)
 		# print('decoder out size: {}'.format(output.shape))
 		return output, hidden, cell
+
+	# the scores of all words of the vocab for the LSTM output (..., hidden_size)
+	# the logits of the dense projection, or the exact log probabilities
+	# of the adaptive softmax, in the order of the vocab
+	def project(self, hidden):
+		if self.output_layer != 'adaptive':
+			return self.linear(hidden)
+
+		log_probs = self.adaptive.log_prob(hidden.reshape(-1, self.hidden_size)).index_select(1, self.word_rank)
+		return log_probs.view(*hidden.size()[:-1], self.vocab_size)
+
+	# the summed cross entropy of the targets (num_targets) for the LSTM output (num_targets, hidden_size)
+	# and the predicted words, as with project and argmax
+	# predict: the rows whose predicted word is needed, a bool mask (num_targets), True for all or False for none
+	# the predictions that cost an extra projection are only made for these rows:
+	# the other rows get their target, and None is returned if no row is predicted
+	def output_loss(self, hidden, targets, predict = True):
+		if self.output_layer == 'adaptive':
+			loss = self.adaptive(hidden, self.word_rank[targets]).loss * targets.size()[0]
+			return loss, self._predict(hidden, targets, predict, lambda rows: self.word_order[self.adaptive.predict(rows)])
+
+		# the sampled softmax only projects the predicted rows to the whole vocab
+		if self.output_layer == 'sampled' and self.training:
+			return self._sampled_loss(hidden, targets), self._predict(hidden, targets, predict, lambda rows: self.linear(rows).argmax(1))
+
+		logits = self.linear(hidden)
+		return F.cross_entropy(logits, targets, reduction = 'sum'), logits.argmax(1)
+
+	# the predicted words of the rows given by predict (see output_loss)
+	def _predict(self, hidden, targets, predict, predict_rows):
+		if predict is False:
+			return None
+
+		with torch.no_grad():
+			if predict is True:
+				return predict_rows(hidden)
+
+			predicted = targets.clone()
+			if bool(predict.any()):
+				predicted[predict] = predict_rows(hidden[predict])
+			return predicted
+
+	# the sampled softmax: the target against num_sampled negative words shared by the batch
+	# the logits are corrected by the log probability of the words in the sampling
+	def _sampled_loss(self, hidden, targets):
+		samples = torch.multinomial(self.sampling_log_probs.exp(), self.num_sampled, replacement = True)
+
+		# (num_targets)
+		true_logits = (hidden * self.linear.weight[targets]).sum(1) + self.linear.bias[targets]
+		true_logits = true_logits - self.sampling_log_probs[targets]
+
+		# (num_targets, num_sampled), a sample equal to the target is not a negative
+		sampled_logits = F.linear(hidden, self.linear.weight[samples], self.linear.bias[samples])
+		sampled_logits = sampled_logits - self.sampling_log_probs[samples]
+		sampled_logits = sampled_logits.masked_fill(samples.unsqueeze(0) == targets.unsqueeze(1), float('-inf'))
+
+		# the target is the class 0
+		logits = torch.cat((true_logits.unsqueeze(1), sampled_logits), 1)
+		return F.cross_entropy(logits, torch.zeros_like(targets), reduction = 'sum')
+
+	# the LSTM of 1 time step, without the projection to the vocab
+	# the arguments are the same as forward
+	def step(self, sense_embedding, hidden, cell, context_gates = None):
+		if context_gates is None:
+			gates = F.linear(sense_embedding, self.lstm.weight_ih_l0, self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+		else:
+
+			# only the word embedding part of the input projection
+			weight = self.lstm.weight_ih_l0[:, self.input_size - sense_embedding.size()[1]:]
+			gates = context_gates + F.linear(sense_embedding, weight)
+		gates = gates + F.linear(hidden, self.lstm.weight_hh_l0)
+
+		# the gates of nn.LSTM, in its order
+		input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, 1)
+		cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+		hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+		return hidden, cell
+
+	# the checkpoints saved before (e.g. './models/decoder.pth') hold an nn.LSTMCell 'lstm_cell'
+	# with the same parameters as the one-layer nn.LSTM
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+			key = prefix + 'lstm_cell.' + name
+			if key in state_dict:
+				state_dict[prefix + 'lstm.' + name + '_l0'] = state_dict.pop(key)
+		super(Decoder, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+	# all time steps at once when every input word is known (full teacher forcing)
+	# the same result as calling forward at each step with the given inputs
+	def forward_sequence(self, sense_embeddings, hidden, cell):
+		'''
+		sense_embeddings (seq_length, batch_size, input_size): the decoder input of every time step
+		hidden, cell of shape (batch, hidden_size): the initial states
+
+		@return: outputs (seq_length, batch_size, vocab_size) and the final hidden, cell
+		'''
+
+		# one LSTM call over all time steps
+		# (seq_length, batch, hidden_size)
+		hiddens, (hidden, cell) = self.lstm(sense_embeddings, (hidden.unsqueeze(0), cell.unsqueeze(0)))
+
+		# one projection to the vocab for all time steps
+		# (seq_length, batch_size, vocab_size)
+		outputs = self.project(hiddens)
+		return outputs, hidden.squeeze(0), cell.squeeze(0)
+
+	# beam search over all beams of all examples as one flattened batch
+	# each step is one call of forward on (batch_size * beam_width) rows
+	def beam_search(self, embed, context_gates, hidden, cell, start_idx, end_idx, pad_idx,
+					max_length, beam_width = 5, length_penalty = 1.0, lm_fusion = None):
+		'''
+		embed: the word embedding of the generated words (nn.Embedding of the model)
+		context_gates (batch_size, 4 * hidden_size): see project_context
+		hidden, cell of shape (batch, hidden_size): the initial states
+		length_penalty: the scores of the hypotheses are divided by length ** length_penalty
+			(0 for the raw log probability)
+		lm_fusion: the language model fused into the scores (see lm_fusion.LMFusion), or None
+
+		a hypothesis is finished at its <end>, and leaves the beam
+		an example is done once beam_width of its hypotheses are finished
+
+		@return: sequences (batch_size, max_length) of the best hypotheses, padded after <end>
+		and their normalized scores (batch_size)
+		'''
+
+		batch_size, device = context_gates.size()[0], context_gates.device
+		rows = torch.arange(batch_size, device = device)
+
+		# every beam of an example is a row of the flattened batch
+		# (batch_size * beam_width, ...)
+		context_gates = context_gates.repeat_interleave(beam_width, 0)
+		hidden = hidden.repeat_interleave(beam_width, 0)
+		cell = cell.repeat_interleave(beam_width, 0)
+		word_index = torch.full((batch_size * beam_width, ), start_idx, dtype = torch.long, device = device)
+
+		# only the first beam is alive at the start, the others are copies of it
+		# (batch_size, beam_width)
+		scores = torch.full((batch_size, beam_width), float('-inf'), device = device)
+		scores[:, 0] = 0
+		sequences = torch.zeros(batch_size, beam_width, 0, dtype = torch.long, device = device)
+
+		# the best finished hypothesis of each example
+		best_sequences = torch.full((batch_size, max_length), pad_idx, dtype = torch.long, device = device)
+		best_scores = torch.full((batch_size, ), float('-inf'), device = device)
+		num_finished = torch.zeros(batch_size, dtype = torch.long, device = device)
+
+		# the language model reads the input words from step 1 on (step 0 predicts <start>)
+		if lm_fusion is not None:
+			lm_state = lm_fusion.init_state(batch_size * beam_width, device)
+
+		for t in range(max_length):
+
+			# (batch_size, beam_width, vocab_size)
+			output, hidden, cell = self(embed(word_index), hidden, cell, context_gates)
+			if lm_fusion is not None and t > 0:
+				lm_log_probs, lm_state = lm_fusion.step(word_index, lm_state)
+				log_probs = lm_fusion.fuse(output, lm_log_probs).view(batch_size, beam_width, -1)
+			else:
+				log_probs = torch.log_softmax(output, dim = 1).view(batch_size, beam_width, -1)
+
+			# the 2 * beam_width best continuations: at most beam_width of them end
+			# (batch_size, 2 * beam_width)
+			candidates = (scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+			candidate_scores, candidate_idx = candidates.topk(2 * beam_width, dim = 1)
+			candidate_beams = candidate_idx // self.vocab_size
+			candidate_words = candidate_idx % self.vocab_size
+
+			# the finished hypotheses among the beam_width best continuations
+			is_end = (candidate_words == end_idx) & (candidate_scores > float('-inf'))
+			is_end[:, beam_width:] = False
+			is_end &= (num_finished < beam_width).unsqueeze(1)
+			num_finished += is_end.sum(1)
+
+			# keep the best finished one of each example, normalized by its length (with <end>)
+			normalized = candidate_scores / float(t + 1) ** length_penalty
+			normalized = normalized.masked_fill(~is_end, float('-inf'))
+			finished_scores, finished = normalized.max(1)
+			improved = finished_scores > best_scores
+			if improved.any():
+				finished_sequence = torch.cat((
+					sequences[rows, candidate_beams[rows, finished]], 
+					torch.full((batch_size, 1), end_idx, dtype = torch.long, device = device)), 1)
+				best_sequences[:, :t + 1] = torch.where(improved.unsqueeze(1), finished_sequence, best_sequences[:, :t + 1])
+				best_scores = torch.where(improved, finished_scores, best_scores)
+
+			# all examples are done
+			if bool((num_finished >= beam_width).all()):
+				break
+
+			# the next beams are the beam_width best unfinished continuations
+			# (batch_size, beam_width)
+			ended = candidate_words == end_idx
+			order = (ended.long() * 2 * beam_width + torch.arange(2 * beam_width, device = device)).argsort(1)[:, :beam_width]
+			beams = candidate_beams.gather(1, order)
+			scores = candidate_scores.gather(1, order).masked_fill(ended.gather(1, order), float('-inf'))
+			word_index = candidate_words.gather(1, order)
+
+			# reorder the states and the histories of the beams
+			flat_beams = (rows.unsqueeze(1) * beam_width + beams).view(-1)
+			hidden, cell = hidden.index_select(0, flat_beams), cell.index_select(0, flat_beams)
+			if lm_fusion is not None:
+				lm_state = lm_fusion.reorder_state(lm_state, flat_beams)
+			sequences = torch.cat((sequences[rows.unsqueeze(1), beams], word_index.unsqueeze(2)), 2)
+			word_index = word_index.view(-1)
+
+		else:
+			# the unfinished beams compete at the full length
+			normalized = scores / float(max_length) ** length_penalty
+			active_scores, active = normalized.max(1)
+			improved = active_scores > best_scores
+			best_sequences = torch.where(improved.unsqueeze(1), sequences[rows, active], best_sequences)
+			best_scores = torch.where(improved, active_scores, best_scores)
+
+		return best_sequences, best_scores
+
+	# the training loss, projecting and scoring only the true (non <pad>) target positions
+	# the rows are sorted by target length, so the rows with a target at step t
+	# are the first batch_sizes[t] ones, and the loss is summed step by step
+	def decode_loss(self, embed, dropout, context_embedding, definition, hidden, cell,
+					start_idx, pad_idx, teacher_forcing_ratio = 0.4):
+		'''
+		embed, dropout: the word embedding of the generated words and its dropout (of the model)
+		context_embedding (batch_size, context_size): the encoder (sense) embedding
+		definition (batch_size, max_length): the true definitions, <pad> after their end
+		hidden, cell of shape (batch, hidden_size): the initial states
+		teacher_forcing_ratio: 1 to run all time steps at once (see forward_sequence)
+
+		@return: the mean cross entropy over the target words, as CrossEntropyLoss(ignore_index = pad_idx)
+		and result: list[tensor] of size (max_length, batch), the generated words at the target positions, <pad> elsewhere
+		(in training with the sampled or adaptive softmax, the true words where the correct word is fed next,
+		and only <pad> when all time steps are teacher-forced, see output_loss)
+		'''
+
+		batch_size, max_length = definition.size()
+		device = definition.device
+
+		# longest target first
+		lengths, order = (definition != pad_idx).sum(1).sort(descending = True)
+		definition, context_embedding = definition[order], context_embedding[order]
+		hidden, cell = hidden[order], cell[order]
+
+		# (max_length, batch), in the sorted order
+		result = torch.full((max_length, batch_size), pad_idx, dtype = torch.long, device = device)
+
+		if teacher_forcing_ratio >= 1:
+
+			# the input words: <start>, then the true definition one step behind
+			# (max_length, batch_size, input_size)
+			start = torch.full((1, batch_size), start_idx, dtype = torch.long, device = device)
+			word_index = torch.cat((start, definition[:, :max_length - 1].t()), 0)
+			sense_embedding = torch.cat((
+				context_embedding.unsqueeze(0).expand(max_length, -1, -1), 
+				dropout(embed(word_index))), 2)
+
+			# the LSTM and the projection run on the packed target positions only
+			# (num_targets, hidden_size), time step major as the (max_length, batch) mask
+			packed = pack_padded_sequence(sense_embedding, lengths.cpu())
+			hiddens, _ = self.lstm(packed, (hidden.unsqueeze(0), cell.unsqueeze(0)))
+			targets = torch.arange(max_length, device = device).unsqueeze(1) < lengths.unsqueeze(0)
+
+			# the predictions are not fed back, in training they are only made when they are free
+			loss, predicted = self.output_loss(hiddens.data, definition.t()[targets], predict = not self.training)
+			if predicted is not None:
+				result[targets] = predicted
+
+		else:
+			context_gates = self.project_context(context_embedding)
+			batch_sizes = (lengths.unsqueeze(0) > torch.arange(max_length, device = device).unsqueeze(1)).sum(1).tolist()
+
+			loss = 0
+			word_index = torch.full((batch_size, ), start_idx, dtype = torch.long, device = device)
+			for t, num_targets in enumerate(batch_sizes):
+				if num_targets == 0:
+					break
+
+				# only the rows with a target at this step
+				hidden, cell = hidden[:num_targets], cell[:num_targets]
+				context_gates, word_index = context_gates[:num_targets], word_index[:num_targets]
+
+				# the rows fed the correct word next, with probability teacher_forcing_ratio
+				# the others are fed the generated word
+				predict = True
+				if teacher_forcing_ratio > 0:
+					teacher_force = torch.rand(num_targets, device = device) < teacher_forcing_ratio
+					predict = ~teacher_force
+
+				# (num_targets, hidden_size)
+				hidden, cell = self.step(dropout(embed(word_index)), hidden, cell, context_gates)
+				step_loss, generated_index = self.output_loss(hidden, definition[:num_targets, t], predict = predict)
+				loss = loss + step_loss
+
+				result[t, :num_targets] = generated_index
+				word_index = generated_index
+				if teacher_forcing_ratio > 0:
+					word_index = torch.where(teacher_force, definition[:num_targets, t], generated_index)
+
+		# back to the original order of the rows
+		unsorted = torch.empty_like(result)
+		unsorted[:, order] = result
+		return loss / lengths.sum(), list(unsorted)
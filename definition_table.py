@@ -0,0 +1,115 @@
+import json
+import os
+import numpy as np
+import torch
+from wsd_data import def2idx
+
+'''
+the tokenized WordNet definitions of all synsets in the synset vocab
+built once for a decoder vocab and a max_length, and stored as memory-mapped matrices
+row i is the synset with id i in the synset vocab
+	definitions.npy: (num_synsets, max_length) int32, the padded definition ids (see wsd_data.def2idx)
+	lengths.npy: (num_synsets) int32, the number of ids before the padding, with <start> and <end>
+	literal.json: the literal definitions
+'''
+
+MANIFEST = 'manifest.json'
+DEFINITIONS = 'definitions.npy'
+LENGTHS = 'lengths.npy'
+LITERAL = 'literal.json'
+
+# tokenize the definition of every synset in the synset vocab once
+def build_definition_table(synset_vocab, vocab, max_length, out_dir):
+	from nltk.corpus import wordnet as wn
+
+	num_synsets = synset_vocab.idx
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	definitions = np.lib.format.open_memmap(os.path.join(out_dir, DEFINITIONS), mode = 'w+', dtype = np.int32, shape = (num_synsets, max_length))
+	lengths = np.zeros(num_synsets, dtype = np.int32)
+	literal = []
+
+	pad_idx = vocab('<pad>')
+	for idx in range(num_synsets):
+		definition = wn.synset(synset_vocab.idx2word[idx].replace('__', '.')).definition()
+		definitions[idx] = def2idx(definition, max_length, vocab)
+		lengths[idx] = np.count_nonzero(definitions[idx] != pad_idx)
+		literal.append(definition)
+
+		if (idx + 1) % 10000 == 0:
+			print("[{}/{}] definitions tokenized.".format(idx + 1, num_synsets))
+
+	definitions.flush()
+	np.save(os.path.join(out_dir, LENGTHS), lengths)
+	with open(os.path.join(out_dir, LITERAL), 'w') as f:
+		json.dump(literal, f)
+
+	manifest = {
+		'num_synsets': num_synsets,
+		'max_length': max_length,
+		'vocab_size': vocab.idx,
+		'definitions': DEFINITIONS,
+		'lengths': LENGTHS,
+		'literal': LITERAL}
+	with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+		json.dump(manifest, f, indent = 2)
+
+	return manifest
+
+class DefinitionTable(object):
+	"""Read-only view of a prebuilt definition table (see build_definition_table)
+	The targets of a batch of synsets are one row slice, indexed by the synset vocab id.
+	"""
+
+	def __init__(self, out_dir):
+		with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+			self.manifest = json.load(f)
+		self.out_dir = out_dir
+		self.max_length = self.manifest['max_length']
+
+		self.definitions = np.load(os.path.join(out_dir, self.manifest['definitions']), mmap_mode = 'r')
+		self.lengths = np.load(os.path.join(out_dir, self.manifest['lengths']), mmap_mode = 'r')
+		if self.definitions.shape != (self.manifest['num_synsets'], self.max_length):
+			raise ValueError('definition table does not match the manifest')
+
+		# the literal definitions are only read when needed
+		self.literal_definitions = None
+
+	def __len__(self):
+		return self.definitions.shape[0]
+
+	# the synset vocab ids of the given synset names ('dog.n.01' or 'dog__n__01')
+	@staticmethod
+	def ids(synset_vocab, synset_names):
+		return np.array([synset_vocab.word2idx[name.replace('.', '__')] for name in synset_names], dtype = np.int64)
+
+	# (len(synset_ids), max_length) int32
+	def rows(self, synset_ids):
+		return np.asarray(self.definitions[np.asarray(synset_ids, dtype = np.int64)])
+
+	# (len(synset_ids), max_length) long tensor, ready as decoder targets
+	def tensor(self, synset_ids, device = None):
+		return torch.from_numpy(self.rows(synset_ids).astype(np.int64)).to(device)
+
+	# the number of times each word of the vocab appears in the definitions
+	def word_counts(self, vocab_size):
+		return np.bincount(np.asarray(self.definitions).ravel(), minlength = vocab_size)
+
+	def literal(self, synset_ids):
+		if self.literal_definitions is None:
+			with open(os.path.join(self.out_dir, self.manifest['literal']), 'r') as f:
+				self.literal_definitions = json.load(f)
+		return [self.literal_definitions[idx] for idx in np.asarray(synset_ids).tolist()]
+
+# the literal definition of a generated sequence of word ids, up to its <end>
+def sequence_to_definition(sequence, vocab):
+	end_idx = vocab('<end>')
+	skip_idx = {vocab('<start>'), vocab('<pad>')}
+
+	words = []
+	for idx in sequence:
+		if idx == end_idx:
+			break
+		if idx not in skip_idx:
+			words.append(vocab.idx2word[idx])
+	return ' '.join(words)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+
+'''
+a disk-backed cache of the ELMo activations of the training sentences
+ELMo is frozen, so the activations of a sentence never change across epochs
+the activations are stored token by token in memory-mapped shards:
+	shard_{n}.npy: (num_tokens, 3 (layers), 1024)
+and an index file maps each sentence to (shard, offset, length)
+'''
+
+INDEX = 'index.pkl'
+
+class ElmoCache(object):
+	"""Read-only view of a prebuilt ELMo feature cache
+	get(sentence) returns the same [3, sentence length, 1024] float32 array
+	as ElmoEmbedder.embed_sentence, or None on a miss.
+	"""
+
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		with open(os.path.join(cache_dir, INDEX), 'rb') as f:
+			index = pickle.load(f)
+		self.dtype = index['dtype']
+		self.entries = index['entries']
+
+		# shards are opened lazily, without reading them into memory
+		self.shards = {}
+
+	# the key of a sentence is its content
+	@staticmethod
+	def key(sentence):
+		return hashlib.sha1('\x00'.join(sentence).encode('utf-8')).hexdigest()
+
+	def __contains__(self, sentence):
+		return self.key(sentence) in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def _shard(self, shard):
+		if shard not in self.shards:
+			self.shards[shard] = np.load(os.path.join(self.cache_dir, 'shard_{}.npy'.format(shard)), mmap_mode = 'r')
+		return self.shards[shard]
+
+	def get(self, sentence):
+		entry = self.entries.get(self.key(sentence))
+		if entry is None:
+			return None
+
+		shard, offset, length = entry
+		activations = self._shard(shard)[offset:offset + length]
+
+		# [3 (layers), sentence length, 1024]
+		return np.ascontiguousarray(activations.transpose(1, 0, 2), dtype = np.float32)
+
+class ElmoCacheWriter(object):
+	"""Appends ELMo activations to a cache directory, one shard at a time
+	Sentences already in the cache are skipped.
+	The index is rewritten after each shard, so an interrupted build
+	keeps (and continues from) all the shards written so far.
+	"""
+
+	def __init__(self, cache_dir, dtype = 'float32', shard_tokens = 20000):
+		self.cache_dir = cache_dir
+		self.shard_tokens = shard_tokens
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		# continue an existing cache
+		index_path = os.path.join(cache_dir, INDEX)
+		if os.path.exists(index_path):
+			with open(index_path, 'rb') as f:
+				index = pickle.load(f)
+			self.dtype = index['dtype']
+			self.entries = index['entries']
+			self.num_shards = index['num_shards']
+		else:
+			self.dtype = np.dtype(dtype).name
+			self.entries = {}
+			self.num_shards = 0
+
+		# the activations of the current shard: list of (length, 3, 1024)
+		# and their entries, only indexed once the shard is written
+		self.buffer = []
+		self.buffer_entries = {}
+		self.buffer_tokens = 0
+
+	def __contains__(self, sentence):
+		key = ElmoCache.key(sentence)
+		return key in self.entries or key in self.buffer_entries
+
+	# embedding: [3 (layers), sentence length, 1024] from ElmoEmbedder
+	def add(self, sentence, embedding):
+		key = ElmoCache.key(sentence)
+		if key in self.entries or key in self.buffer_entries:
+			return
+
+		length = embedding.shape[1]
+		self.buffer_entries[key] = (self.num_shards, self.buffer_tokens, length)
+		self.buffer.append(embedding.transpose(1, 0, 2).astype(self.dtype))
+		self.buffer_tokens += length
+
+		if self.buffer_tokens >= self.shard_tokens:
+			self._flush()
+
+	def _flush(self):
+		if not self.buffer:
+			return
+		np.save(os.path.join(self.cache_dir, 'shard_{}.npy'.format(self.num_shards)), np.concatenate(self.buffer))
+		self.num_shards += 1
+		self.entries.update(self.buffer_entries)
+		self.buffer = []
+		self.buffer_entries = {}
+		self.buffer_tokens = 0
+		self._write_index()
+
+	# replace the index at once, a reader never sees a partly written one
+	def _write_index(self):
+		index_path = os.path.join(self.cache_dir, INDEX)
+		with open(index_path + '.tmp', 'wb') as f:
+			pickle.dump({'dtype': self.dtype, 'num_shards': self.num_shards, 'entries': self.entries}, f)
+		os.replace(index_path + '.tmp', index_path)
+
+	# write the last shard and the index
+	def close(self):
+		self._flush()
+		self._write_index()
+
+# one ELMo per worker process
+_worker_elmo = None
+
+def _init_worker():
+	global _worker_elmo
+	from allennlp.commands.elmo import ElmoEmbedder
+	_worker_elmo = ElmoEmbedder()
+
+def _embed_chunk(sentences):
+	return list(_worker_elmo.embed_sentences(sentences))
+
+# fill the cache with the ELMo activations of the given sentences
+# using a pool of worker processes
+def build_elmo_cache(sentences, cache_dir, num_workers = 4, dtype = 'float32', shard_tokens = 20000, chunk_size = 64):
+	from multiprocessing import Pool
+
+	writer = ElmoCacheWriter(cache_dir, dtype = dtype, shard_tokens = shard_tokens)
+
+	# only embed the missing sentences, once each
+	missing = {}
+	for sentence in sentences:
+		if sentence not in writer:
+			missing[ElmoCache.key(sentence)] = sentence
+	missing = list(missing.values())
+	chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+	print("{} sentences to embed.".format(len(missing)))
+
+	pool = Pool(num_workers, initializer = _init_worker)
+	try:
+		for i, (chunk, embeddings) in enumerate(zip(chunks, pool.imap(_embed_chunk, chunks))):
+			for sentence, embedding in zip(chunk, embeddings):
+				writer.add(sentence, embedding)
+
+			if (i + 1) % 10 == 0:
+				print("[{}/{}] chunks embedded.".format(i + 1, len(chunks)))
+	finally:
+		pool.close()
+		pool.join()
+
+	writer.close()
+	return writer.entries
@@ -22,7 +22,6 @@ class Emb2Seq_Model(nn.Module):
 				vocab,
 				max_seq_length,
 				decoder_hidden_size,
-				word_idx_in_order,
 				word_embed_size = 256,
 				dropout = 0.2, 
 				regularization = None,
@@ -34,10 +33,6 @@ class Emb2Seq_Model(nn.Module):
 		# NOTICE: 1/2 of the decoder.embed_size because we will concat later
 		self.word_embed_size = word_embed_size
 
-		# words in the decoder vocab in order
-		# converted to the vocab idx for the transformer-xl
-		self.word_idx_in_order = word_idx_in_order
-
 		self.encoder = encoder
 		self.decoder = decoder
 		self.max_length = max_seq_length
@@ -51,62 +46,165 @@ class Emb2Seq_Model(nn.Module):
 		self.embed = nn.Embedding(vocab.idx, self.word_embed_size, padding_idx = self.pad_idx)
 		self.dropout = nn.Dropout(dropout)
 
-	# given the generated sequence and memory from the previous step
-	# get the log probability distribution over the vocab by the transfomer-xl model 
-	def _get_trans_prob(self, trans_model, result, batch_size, mem):
+	# fully teacher-forced decoding: the input words are all known in advance
+	# so the decoder runs over the whole sequence at once (see Decoder.forward_sequence)
+	def _decode_teacher_forced(self, encoder_embedding, definition, hidden, cell):
 
-		with torch.no_grad():
+		batch_size = encoder_embedding.size()[0]
 
-			# get the idx (batch, seq_length) for the transformer
-			# only after the first 3 time step
-			context = self._get_trans_idx(result, batch_size)
-			if mem == -1:
-				# Predict all tokens
-				predictions, mems = trans_model(context)
-			else:
-				# We can re-use the memory cells in a subsequent call to attend a longer context
-				predictions, mems = trans_model(context, mems = mem)
-
-			# get the log probability for predicted last token
-			# for the subset vocab for our model
-			our_prediction = torch.zeros(batch_size, len(self.word_idx_in_order)).to(torch.device(device))
-			for our_idx, xl_idx in enumerate(self.word_idx_in_order):
-				our_prediction[:, our_idx] = predictions[:, -1, xl_idx]
-
-		# (batch_size, vocab)
-		return our_prediction, mems
-
-	# helper method: get the idx form of the current batch
-	# (batch, seq) for the transformer-xl
-	def _get_trans_idx(self, result, batch_size):
-		with torch.no_grad():
-			context = torch.zeros(batch_size, len(result), dtype = torch.long).to(torch.device(device))
-			for b in range(batch_size):
-				for l in range(len(result)):
-					context[b, l] = self.word_idx_in_order[result[l][b].item()]
-		return context
+		# the input words: <start>, then the true definition one step behind
+		# (self.max_length, batch_size)
+		start = torch.full((1, batch_size), self.start_idx, dtype = torch.long, device = self.device)
+		word_index = torch.cat((start, definition[:, :self.max_length - 1].t()), 0)
+
+		# concat the encoder embedding to the word embedding of every time step
+		# (self.max_length, batch_size, decoder.input_size)
+		generated_embedding = self.dropout(self.embed(word_index))
+		sense_embedding = torch.cat((
+			encoder_embedding.unsqueeze(0).expand(self.max_length, -1, -1), 
+			generated_embedding), 2)
+
+		# (self.max_length, batch_size, vocab_size)
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		outputs, _, _ = decoder.forward_sequence(sense_embedding, hidden, cell)
+
+		# the max word index at each time step
+		_, generated_index = torch.max(outputs, dim = 2)
+		return outputs, list(generated_index)
 
 	# perform all-word WSD on the SemCor dataset
-	def forward(self, sentence, tagged_sent, definition, trans_model, teacher_forcing_ratio = 0.4):
+	def forward(self, sentence, tagged_sent, definition, lm_fusion = None, teacher_forcing_ratio = 0.4, spans = None):
 		
 		'''
 		teacher_forcing: the probability of using ground truth in decoding
+		lm_fusion: the language model fused into the word choices (see lm_fusion.LMFusion), or None
 
 		definition: [seq_length, self.max_length]
 		the matrix with row as seq and column as words: indices of each word in the true definition
 
 		sentence: the given plain sentence in a list
 		tagged_sent: the target sentence (list) with only tagged words from the SemCor
+		spans: the (start, end) token positions of the tagged words in the sentence
+			(tagged_sent is not needed when spans are given)
 		'''
 		
 		# sense embedding from the encoder
 		# (seq_length, 256): batch is the seq_length for all-word WSD
-		encoder_embedding = self.encoder(sentence, tagged_sent)
+		encoder_embedding = self.encoder(sentence, tagged_sent, spans)
 		# print(encoder_embedding.shape)
 
 		# treating one sentence as a batch for all-word WSD
 		# each word is an example for the decoder
-		batch_size = len(tagged_sent)
+		return self._decode(encoder_embedding, definition, lm_fusion, teacher_forcing_ratio)
+
+	# perform all-word WSD on a bucket of sentences at once
+	def forward_batch(self, sentences, definition, lm_fusion = None, teacher_forcing_ratio = 0.4, spans = None, offsets = None):
+
+		'''
+		sentences: list of plain sentences, preferably of similar length (see data_loader.BucketBatchSampler)
+		definition: [total tagged words, self.max_length] of all sentences, in order
+		spans: the (start, end) token positions of the tagged words of each sentence,
+			either a list with one array per sentence or all rows at once with their offsets
+		offsets: the tagged words of sentence i are rows offsets[i]:offsets[i + 1]
+		'''
+
+		# sense embedding of all tagged words in the bucket
+		# (total tagged, 256): the whole bucket is one decoder batch
+		encoder_embedding, _ = self.encoder.forward_batch(sentences, None, self._sentence_spans(sentences, spans, offsets))
+		return self._decode(encoder_embedding, definition, lm_fusion, teacher_forcing_ratio)
+
+	# the training loss of a bucket of sentences
+	# the decoder only projects and scores the true (non <pad>) target positions (see Decoder.decode_loss)
+	def forward_batch_loss(self, sentences, definition, teacher_forcing_ratio = 0.4, spans = None, offsets = None):
+
+		'''
+		sentences, definition, spans, offsets: as forward_batch
+
+		@return: the mean cross entropy over the target words, as CrossEntropyLoss(ignore_index = <pad>) on forward_batch,
+		and result: list[tensor] of size (self.max_length, batch), the generated words at the target positions
+		'''
+
+		# (total tagged, 256)
+		encoder_embedding, _ = self.encoder.forward_batch(sentences, None, self._sentence_spans(sentences, spans, offsets))
+		batch_size = encoder_embedding.size()[0]
+
+		# [batch_size, self.max_length]
+		definition = torch.as_tensor(definition, dtype = torch.long, device = self.device)
+
+		# initialize h_0 and c_0 for the decoder LSTM_Cell
+		hidden = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+		cell = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		return decoder.decode_loss(
+			self.embed, 
+			self.dropout, 
+			encoder_embedding, 
+			definition, 
+			hidden, 
+			cell, 
+			self.start_idx, 
+			self.pad_idx, 
+			teacher_forcing_ratio = teacher_forcing_ratio)
+
+	# beam search decoding of all tagged words of a bucket of sentences
+	# instead of the greedy choice at each step (see Decoder.beam_search)
+	def beam_search(self, sentences, spans, offsets = None, beam_width = 5, length_penalty = 1.0, lm_fusion = None):
+
+		'''
+		sentences, spans, offsets, lm_fusion: as forward_batch
+
+		@return: result: list[tensor] of size (self.max_length, batch) as the result of forward,
+		padded after <end>, and the normalized log probability of each definition (batch)
+		'''
+
+		with torch.no_grad():
+
+			# (total tagged, 256)
+			encoder_embedding, _ = self.encoder.forward_batch(sentences, None, self._sentence_spans(sentences, spans, offsets))
+			batch_size = encoder_embedding.size()[0]
+
+			hidden = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+			cell = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+
+			decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+			sequences, scores = decoder.beam_search(
+				self.embed, 
+				decoder.project_context(encoder_embedding), 
+				hidden, 
+				cell, 
+				self.start_idx, 
+				self.end_idx, 
+				self.pad_idx, 
+				self.max_length, 
+				beam_width = beam_width, 
+				length_penalty = length_penalty, 
+				lm_fusion = lm_fusion)
+
+		return list(sequences.t()), scores
+
+	# the spans of each sentence, from all rows at once and their offsets
+	def _sentence_spans(self, sentences, spans, offsets = None):
+		if offsets is None:
+			return spans
+		offsets = [int(offset) for offset in offsets]
+		return [spans[offsets[i]:offsets[i + 1]] for i in range(len(sentences))]
+
+	# decode the definitions of a batch of sense embeddings
+	# encoder_embedding: (batch_size, 256)
+	def _decode(self, encoder_embedding, definition, lm_fusion, teacher_forcing_ratio):
+
+		batch_size = encoder_embedding.size()[0]
+
+		# the true definitions stay on the device for teacher forcing
+		# [batch_size, self.max_length]
+		definition = torch.as_tensor(definition, dtype = torch.long, device = self.device)
+
+		# no scheduled sampling: decode all time steps at once
+		if teacher_forcing_ratio >= 1:
+			hidden = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+			cell = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
+			return self._decode_teacher_forced(encoder_embedding, definition, hidden, cell)
 		
 		# tensor to store decoder outputs
 		outputs = torch.zeros(self.max_length, batch_size, self.vocab_size).to(self.device)
@@ -117,71 +215,80 @@ class Emb2Seq_Model(nn.Module):
 		generated_embedding = self.dropout(self.embed(lookup_tensor)).repeat(batch_size, 1).to(self.device)
 		# print(generated_embedding.shape)
 
-		# concat of the encoder embedding and the generated word embedding
-		# (batch_size, decoder.input_size)
-		sense_embedding = torch.cat((encoder_embedding, generated_embedding), 1).to(self.device)
+		# the encoder embedding part of the decoder input projection, computed once
+		# each step only adds the projection of the generated word embedding
+		# (batch_size, 4 * decoder.hidden_size)
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		context_gates = decoder.project_context(encoder_embedding)
 
 		# initialize h_0 and c_0 for the decoder LSTM_Cell
 		hidden = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
 		cell = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
 
 		# visualize the result
-		# store decoding context for the transformer-xl
 		# 'result': list[tensor] of size (seq_length, batch) 
 		result = []
-		mem = -1
+
+		# the language model of the shallow fusion, if any
+		# the decoder predicts <start> at step 0 (the definitions start with it)
+		# so the language model reads the decoder input from step 1 on
+		if lm_fusion is not None:
+			lm_state = lm_fusion.init_state(batch_size, self.device)
+
+		# the rows still decoding, the others are finished:
+		# they have generated <end> and their true definition has ended,
+		# so their later outputs are all ignored by the loss (zeros, <pad> in the result)
+		# (num_active)
+		active = torch.arange(batch_size, device = self.device)
+		ended = torch.zeros(batch_size, dtype = torch.bool, device = self.device)
+		target_length = (definition != self.pad_idx).sum(1)
 
 		# explicitly iterate through the max_length to decode
 		for t in range(self.max_length):
 			
 			# get embedding at each time step from the LSTM
 			# (batch, vocab_size), (batch, decoder.hidden_size)
-			output, hidden, cell = self.decoder(sense_embedding, hidden, cell)
+			output, hidden, cell = self.decoder(generated_embedding, hidden, cell, context_gates)
 			# print('deocder out size in model: {}'.format(output.shape))
 			# print(output.shape)
-			outputs[t] = output
-
-			# correct grammar for the final word choice
-			# only after the first 3 time step
-			'''
-			if t > 3:
+			outputs[t, active] = output
 
-				# inference only, saving mem
-				with torch.no_grad():
-
-					trans_prob, mem = self._get_trans_prob(trans_model, result, batch_size, mem)
-
-					# since trans-xl is on cuda 2, move it back to the default cuda
-					# trans_prob = trans_prob.to(device)
-
-				# using convex combination with the transformer-xl
-				alpha = 0.5
-				output = alpha * output + (1 - alpha) * trans_prob
-			'''
+			# correct grammar for the final word choice with the language model
+			# the outputs for the loss stay those of the decoder
+			if lm_fusion is not None and t > 0:
+				lm_log_probs, lm_state = lm_fusion.step(word_index, lm_state)
+				output = lm_fusion.fuse(output, lm_log_probs)
 
 			# get the max word index from the vocabulary
 			_, generated_index = torch.max(output, dim = 1)
-			result.append(generated_index)
+
+			# scattered back into the full batch
+			result.append(torch.full((batch_size, ), self.pad_idx, dtype = torch.long, device = self.device).index_copy(0, active, generated_index))
 
 			# final word choices for all words in this sentence
-			word_index = []
-
-			# get the generated word index for each word in the batch
-			# may use the correct word from the definition
-			# store the context for the transformer-xl
-			for batch in range(batch_size):
-				teacher_force = random.random() < teacher_forcing_ratio
-				if teacher_force:
-					word_index.append(definition[batch][t])
-				else:
-					word_index.append(generated_index[batch])
+			# the generated word index for each word in the batch
+			# or the correct word from the definition with probability teacher_forcing_ratio
+			word_index = generated_index
+			if teacher_forcing_ratio > 0:
+				teacher_force = torch.rand(len(active), device = self.device) < teacher_forcing_ratio
+				word_index = torch.where(teacher_force, definition[active, t], generated_index)
+
+			# shrink the batch to the unfinished rows, stop once all rows are finished
+			ended[active] |= generated_index == self.end_idx
+			running = ~ended[active] | (target_length[active] > t + 1)
+			if not bool(running.all()):
+				if not bool(running.any()):
+					break
+				active, word_index = active[running], word_index[running]
+				hidden, cell, context_gates = hidden[running], cell[running], context_gates[running]
+				if lm_fusion is not None:
+					lm_state = lm_fusion.reorder_state(lm_state, running)
 
 			# get the new embedding
-			# concat the encoder embedding to the generated embedding at each time step
-			lookup_tensor = torch.tensor(word_index, dtype = torch.long).to(self.device)
-			generated_embedding = self.dropout(self.embed(lookup_tensor)).to(self.device)
-			# print(generated_embedding.shape)			
-			sense_embedding = torch.cat((encoder_embedding, generated_embedding), 1).to(self.device)
+			generated_embedding = self.dropout(self.embed(word_index))
+
+		# the steps after all rows are finished
+		result += [torch.full((batch_size, ), self.pad_idx, dtype = torch.long, device = self.device)] * (self.max_length - len(result))
 
 		# print('model output size: {}'.format(outputs.shape))
 		return outputs, result
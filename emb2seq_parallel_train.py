@@ -42,6 +42,12 @@ elmo = ElmoEmbedder()
 from encoder import *
 from decoder import *
 from emb2seq_model import *
+from elmo_cache import ElmoCache
+from definition_table import DefinitionTable
+from lm_fusion import load_lm_fusion
+from wsd_data import StreamingCorpus, load_gold_keys
+from data_loader import make_loader
+import os
 
 # get the decoder vocab
 with open('./data/vocab.pkl', 'rb') as f:
@@ -55,12 +61,26 @@ with open('./data/vocab.pkl', 'rb') as f:
 max_seq_length = 17
 decoder_hidden_size = 256
 
+# the output layer: 'linear', 'adaptive' (adaptive softmax) or 'sampled' (sampled softmax in training)
+# the last two use the word counts of the definitions (see utils/build_definition_table.py)
+# and must match the pretrained decoder if any, the evaluation is an exact full softmax
+output_layer = 'linear'
+word_counts = None
+if output_layer != 'linear':
+	word_counts = DefinitionTable('./data/definitions_{}'.format(max_seq_length)).word_counts(vocab.idx)
+
 decoder = Decoder(
 	vocab_size = vocab.idx, 
 	max_seq_length = max_seq_length, 
-	hidden_size = decoder_hidden_size)
+	hidden_size = decoder_hidden_size, 
+	output_layer = output_layer, 
+	word_counts = word_counts)
+
+# use the prebuilt ELMo cache if any (see utils/build_elmo_cache.py)
+elmo_cache_dir = './data/elmo_cache'
+elmo_cache = ElmoCache(elmo_cache_dir) if os.path.exists(elmo_cache_dir) else None
 
-encoder = Encoder(elmo_class = elmo)
+encoder = Encoder(elmo_class = elmo, elmo_cache = elmo_cache)
 
 
 # In[5]:
@@ -70,24 +90,10 @@ encoder = Encoder(elmo_class = elmo)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print('Device: {}'.format(device))
 
-word_idx_in_order = None
-trans_model = None
-
-'''
-# the auxiliary transformer-xl for the decoder grammar
-from pytorch_pretrained_bert import TransfoXLTokenizer, TransfoXLModel, TransfoXLLMHeadModel
-
-# Load pre-trained model tokenizer (vocabulary from wikitext 103)
-tokenizer = TransfoXLTokenizer.from_pretrained('transfo-xl-wt103')
-# Load pre-trained model (weights)
-trans_model = TransfoXLLMHeadModel.from_pretrained('transfo-xl-wt103')
-trans_model.eval()
-
-# put on another GPU for memory issues
-trans_model.to(device = torch.device(device))
-
-word_idx_in_order = [tokenizer.convert_tokens_to_ids([vocab.idx2word.get(idx)])[0] for idx in range(vocab.idx)]
-'''
+# the definition language model for the decoder grammar (see lm_fusion.py)
+# built offline by utils/build_definition_lm.py, decoding runs without it if it is missing
+lm_fusion_path = './models/definition_lm.pth'
+lm_fusion = load_lm_fusion(lm_fusion_path, weight = 0.3, device = device) if os.path.exists(lm_fusion_path) else None
 
 # create the model instance
 emb2seq_model = Emb2Seq_Model(
@@ -95,8 +101,7 @@ emb2seq_model = Emb2Seq_Model(
 	decoder, 
 	vocab = vocab, 
 	max_seq_length = max_seq_length, 
-	decoder_hidden_size = decoder_hidden_size,
-	word_idx_in_order = word_idx_in_order)
+	decoder_hidden_size = decoder_hidden_size)
 
 emb2seq_model.to(device)
 optimizer = optim.Adam(emb2seq_model.parameters())
@@ -133,80 +138,49 @@ criterion = nn.CrossEntropyLoss(ignore_index = PAD_IDX).to(device)
 # In[6]:
 
 
-# utility function
-# turn the given definition into its index list form
-def def2idx(definition, max_length, vocab):
-	
-	# definition is given by the WN NLTK API in a string
-	def_tokens = nltk.tokenize.word_tokenize(definition.lower())
-	
-	# limit the length if too long, trim
-	if len(def_tokens) > (max_length - 2):
-		def_tokens = def_tokens[0:(max_length - 2)]
-		
-		# add the start and end symbol
-		def_tokens = ['<start>'] + def_tokens + ['<end>']
-	
-	# if the length is too short, pad
-	elif len(def_tokens) < (max_length - 2):
-		
-		# add the start and end symbol
-		def_tokens = ['<start>'] + def_tokens + ['<end>']
-		
-		pad = ['<pad>'] * (max_length - len(def_tokens))
-		def_tokens = def_tokens + pad
-		
+# the preprocessed SemCor training data and SemEval dev data
+# compiled once by utils/preprocess_corpus.py into memory-mapped arrays
+# with the token positions and definition ids of all tagged words
+# otherwise stream the XML sentence by sentence with the gold keys
+# the sentences and their tensors are prepared by worker processes
+# sentences of similar length are bucketed together, up to max_instances tagged words,
+# and all tagged words of a bucket are decoded as one batch
+# the streamed definitions come from the prebuilt definition table if any
+# see utils/build_definition_table.py (same max_seq_length)
+num_workers = 2
+max_instances = 64
+definition_dir = './data/definitions_{}'.format(max_seq_length)
+definition_table, synset_vocab = None, None
+if os.path.exists(definition_dir):
+	definition_table = DefinitionTable(definition_dir)
+	with open('./data/synset_vocab.pkl', 'rb') as f:
+		synset_vocab = pickle.load(f)
+
+def load_corpus(data_dir, corpus_path, key_path, gold_keys_path, shuffle = False):
+	if os.path.exists(data_dir):
+		corpus = data_dir
 	else:
-		def_tokens = ['<start>'] + def_tokens + ['<end>']
-			
-	# get the index for each element in the token list
-	def_idx_list = [vocab(token) for token in def_tokens]
-	
-	return def_idx_list
-  
-
-
-# In[7]:
-
-
-# utility function
-# get the literal and indices of the definition of the tagged word
-# SemCor for train
-def get_SemCor_def(instance):
-	key = ''
-	target_file = open("../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.gold.key.txt", "r")
-	for line in target_file:
-		if line.startswith(instance.get('id')):
-			key = line.replace('\n', '').split(' ')[-1]
-			
-	# literal definition from the WN
-	definition = wn.lemma_from_key(key).synset().definition()
-	return definition
-
-# SemEval 2007 for dev
-def get_SemEval_def(instance):
-	key = ''
-	target_file = open("../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.gold.key.txt", "r")
-	for line in target_file:
-		if line.startswith(instance.get('id')):
-			key = line.replace('\n', '').split(' ')[-1]
-			
-	# literal definition from the WN
-	definition = wn.lemma_from_key(key).synset().definition()
-	return definition
-
-
-# In[8]:
-
-
-# parse the SemCor training data
-import xml.etree.ElementTree as ET
-semcor_tree = ET.parse('../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml')
-semcor_corpus = semcor_tree.getroot()
-
-# parse the SemEval dev data
-semeval_tree = ET.parse('../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.data.xml')
-semeval_corpus = semeval_tree.getroot()
+		gold_keys = load_gold_keys(key_path, gold_keys_path)
+		corpus = StreamingCorpus(
+			corpus_path, 
+			gold_keys, 
+			vocab, 
+			max_seq_length, 
+			definition_table = definition_table, 
+			synset_vocab = synset_vocab)
+	return make_loader(corpus, num_workers = num_workers, max_instances = max_instances, shuffle = shuffle)
+
+semcor_corpus = load_corpus(
+	'./data/semcor', 
+	'../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml', 
+	'../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.gold.key.txt', 
+	'./data/semcor_gold_keys.pkl', 
+	shuffle = True)
+semeval_corpus = load_corpus(
+	'./data/semeval2007', 
+	'../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.data.xml', 
+	'../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.gold.key.txt', 
+	'./data/semeval2007_gold_keys.pkl')
 
 # small train and test sets
 # small_train_size = 1
@@ -221,84 +195,59 @@ def train(model, optimizer, corpus, criterion, clip):
 	
 	model.train()
 	epoch_loss = 0
+	word_num = 0
 	sentence_num = 0
-	i = 0
 
-	for sub_corpus in corpus:
-	
-		for sent in sub_corpus:
+	# one bucket of sentences per batch from the loader
+	# every sentence has at least one tagged word
+	for batch in corpus:
 
-			optimizer.zero_grad()
-			
-			# get the plain text sentence
-			sentence = [word.text for word in sent]
-			
-			# get the tagged ambiguous words
-			tagged_sent = [instance for instance in sent if instance.tag == 'instance']
-			# print(sentence)
-			# print(tagged_sent)
-			
-			# only use sentence with at least one tagged word
-			if len(tagged_sent) > 0:
-				
-				sentence_num += 1
-				
-				# get all-word definitions, batch_size is the sentence length
-				# [batch_size, self.max_length]
-				definitions = []
-				for instance in tagged_sent:
-					
-					# get the sense from the target file with ID
-					definition = get_SemCor_def(instance)
-					def_idx_list = def2idx(definition, model.max_length, vocab)
-					definitions.append(def_idx_list)
-
-				# get the encoder-decoder result
-				# (self.max_length, batch_size, vocab_size)
-				output, _ = model(
-								sentence, 
-								tagged_sent, 
-								definitions, 
-								trans_model, 
-								teacher_forcing_ratio = 0.4)
-				
-				# adjust dimension for loss calculation
-				# (self.max_length * batch_size, vocab_size)
-				output = output.view(-1, output.shape[-1])
-				target = torch.tensor(definitions, dtype = torch.long).to(device)
-
-				# (self.max_length * batch_size)
-				target = torch.transpose(target, 0, 1).contiguous().view(-1)
-				'''
-				output = output.permute(1, 2, 0)
-				target = torch.tensor(definitions, dtype = torch.long).to(device)
-				'''
-				loss = criterion(output, target)
-				loss.backward()
-
-				# add clip for gradient boost
-				# torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
-
-				optimizer.step()
-				epoch_loss += loss.item()
+		optimizer.zero_grad()
+		
+		# all-word definitions of the bucket, batch_size is the number of tagged words
+		# [batch_size, self.max_length]
+		definitions = batch['definitions'].to(device, non_blocking = True)
+
+		# get the encoder-decoder loss
+		# the same as criterion on the (self.max_length, batch_size, vocab_size) output of forward_batch
+		# but only the true (non <pad>) target positions are projected to the vocab
+		loss, _ = model.forward_batch_loss(
+						batch['sentences'], 
+						definitions, 
+						teacher_forcing_ratio = 0.4, 
+						spans = batch['spans'], 
+						offsets = batch['offsets'])
+		loss.backward()
+
+		# add clip for gradient boost
+		# torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+
+		optimizer.step()
+
+		# the loss is a mean over the target words of the bucket,
+		# weighted by their number for the mean over all target words of the epoch
+		bucket_words = int((definitions != PAD_IDX).sum())
+		epoch_loss += loss.item() * bucket_words
+		word_num += bucket_words
 
 		# keep track of progress
-		i += 1
-		if i % 10 == 0:
-			print("[{}/{}] subcorpus done.".format(i, len(corpus)))
+		if (sentence_num + len(batch['sentences'])) // 1000 > sentence_num // 1000:
+			print("[{}] sentences done.".format(sentence_num + len(batch['sentences'])))
+		sentence_num += len(batch['sentences'])
 				
-	return epoch_loss / sentence_num
+	return epoch_loss / word_num
 
 
 # In[10]:
 
 
 # evaluate the model
-def evaluate(model, corpus, criterion):
+# the written results are decoded by beam search when beam_width > 1
+def evaluate(model, corpus, criterion, beam_width = 1):
 	
 	model.eval()
 	epoch_loss = 0
-	sentence_num = 0
+	word_num = 0
 
 	# result from all dev sentences, both idx form and literal form
 	all_definitions = []
@@ -306,59 +255,54 @@ def evaluate(model, corpus, criterion):
 	
 	with torch.no_grad():
 	
-		for sub_corpus in corpus:
-	
-			for sent in sub_corpus:
-				
-				sentence = [word.text for word in sent]
-				
-				# get the tagged ambiguous words
-				tagged_sent = [instance for instance in sent if instance.tag == 'instance']
-				# print(sentence)
-				# print(tagged_sent)
-
-				# only use sentence with at least one tagged word
-				if len(tagged_sent) > 0:
-					sentence_num += 1
-
-					# get all-word definitions, batch_size is the sentence length
-					# [batch_size, self.max_length]
-					definitions = []
-					literal_def = []
-					for instance in tagged_sent:
-
-						# get the sense from the target file with ID
-						definition = get_SemEval_def(instance)
-						def_idx_list = def2idx(definition, model.max_length, vocab)
-						definitions.append(def_idx_list)
-						literal_def.append(definition)
-
-					# get the encoder-decoder result
-					# (self.max_length, batch_size, vocab_size)
-					output, result = model(
-										sentence, 
-										tagged_sent, 
-										definitions, 
-										trans_model, 
-										teacher_forcing_ratio = 0)
-
-					all_sentence_result.append(result)
-					all_definitions.append(literal_def)
-					
-					# adjust dimension for loss calculation
-					# (self.max_length * batch_size, vocab_size)
-					output = output.view(-1, output.shape[-1])
-					target = torch.tensor(definitions, dtype = torch.long).to(device)
-					# (self.max_length * batch_size)
-					target = torch.transpose(target, 0, 1).contiguous().view(-1)
-					'''
-					output = output.permute(1, 2, 0)
-					target = torch.tensor(definitions, dtype = torch.long).to(device)
-					'''
-					loss = criterion(output, target)        
-					epoch_loss += loss.item()
+		for batch in corpus:
+
+			# all-word definitions of the bucket, batch_size is the number of tagged words
+			# [batch_size, self.max_length]
+			definitions = batch['definitions'].to(device, non_blocking = True)
+
+			# get the encoder-decoder result
+			# (self.max_length, batch_size, vocab_size)
+			output, result = model.forward_batch(
+								batch['sentences'], 
+								definitions, 
+								lm_fusion, 
+								teacher_forcing_ratio = 0, 
+								spans = batch['spans'], 
+								offsets = batch['offsets'])
+
+			if beam_width > 1:
+				result, _ = model.beam_search(
+								batch['sentences'], 
+								batch['spans'], 
+								offsets = batch['offsets'], 
+								beam_width = beam_width, 
+								lm_fusion = lm_fusion)
+
+			# split the bucket result back into sentences
+			offsets = batch['offsets'].tolist()
+			for i, literal_definitions in enumerate(batch['literal_definitions']):
+				all_sentence_result.append([words[offsets[i]:offsets[i + 1]] for words in result])
+				all_definitions.append(literal_definitions)
+			
+			# adjust dimension for loss calculation
+			# (self.max_length * batch_size, vocab_size)
+			output = output.view(-1, output.shape[-1])
+			target = definitions
+			# (self.max_length * batch_size)
+			target = torch.transpose(target, 0, 1).contiguous().view(-1)
+			'''
+			output = output.permute(1, 2, 0)
+			target = torch.tensor(definitions, dtype = torch.long).to(device)
+			'''
+			loss = criterion(output, target)        
+
+			# weighted by the number of target words, as in train
+			bucket_words = int((target != PAD_IDX).sum())
+			epoch_loss += loss.item() * bucket_words
+			word_num += bucket_words
 					
-	return epoch_loss / sentence_num, all_sentence_result, all_definitions
+	return epoch_loss / word_num, all_sentence_result, all_definitions
 
 
 # In[11]:
@@ -417,6 +361,7 @@ import time
 
 N_EPOCHS = 40
 CLIP = 1
+BEAM_WIDTH = 1
 best_valid_loss = float('inf')
 train_losses = []
 dev_losses = []
@@ -428,7 +373,7 @@ for epoch in range(N_EPOCHS):
 	train_loss = train(emb2seq_model, optimizer, semcor_corpus, criterion, CLIP)
 	train_losses.append(train_loss)
 	
-	valid_loss, all_sentence_result, all_definitions = evaluate(emb2seq_model, semeval_corpus, criterion)
+	valid_loss, all_sentence_result, all_definitions = evaluate(emb2seq_model, semeval_corpus, criterion, BEAM_WIDTH)
 	dev_losses.append(valid_loss)
 		
 	end_time = time.time()
@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from definition_table import sequence_to_definition
+
+'''
+a standalone inference service around a trained Emb2Seq_Model
+the requests are (sentence, spans of the target words) and the replies their generated definitions
+concurrent requests are coalesced into one batch, so the encoder and the decoder run once per batch:
+a batch is closed when it holds max_instances target words, or max_latency seconds
+after its first request arrived, whichever comes first
+
+served over a local HTTP server (TCP or Unix socket), see utils/serve_emb2seq.py
+	POST /define {"sentence": ["The", "dog", "barks"], "spans": [[1, 2]]}
+		-> {"definitions": ["a domesticated carnivorous mammal ..."]}
+		("positions": [1] is the same as "spans": [[1, 2]])
+	GET /metrics -> the queue depth, the batch sizes and the latencies
+'''
+
+class ServerMetrics(object):
+	"""Counters of the served requests and batches
+	The latencies are kept for the last window requests and batches only.
+	"""
+
+	def __init__(self, window = 1000):
+		self.start_time = time.time()
+		self.requests = 0
+		self.instances = 0
+		self.batches = 0
+		self.errors = 0
+		self.request_latencies = collections.deque(maxlen = window)
+		self.batch_latencies = collections.deque(maxlen = window)
+		self.batch_sizes = collections.deque(maxlen = window)
+
+	def record_batch(self, num_instances, latency):
+		self.batches += 1
+		self.batch_sizes.append(num_instances)
+		self.batch_latencies.append(latency)
+
+	def record_request(self, num_instances, latency):
+		self.requests += 1
+		self.instances += num_instances
+		self.request_latencies.append(latency)
+
+	# the mean and percentiles in milliseconds
+	@staticmethod
+	def summary(latencies):
+		if not latencies:
+			return {'mean_ms': None, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+		latencies = np.asarray(latencies) * 1000
+		return {
+			'mean_ms': float(latencies.mean()),
+			'p50_ms': float(np.percentile(latencies, 50)),
+			'p95_ms': float(np.percentile(latencies, 95)),
+			'p99_ms': float(np.percentile(latencies, 99))}
+
+	def snapshot(self, queue_depth):
+		return {
+			'uptime_s': time.time() - self.start_time,
+			'queue_depth': queue_depth,
+			'requests': self.requests,
+			'instances': self.instances,
+			'batches': self.batches,
+			'errors': self.errors,
+			'mean_batch_instances': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+			'request_latency': self.summary(self.request_latencies),
+			'batch_latency': self.summary(self.batch_latencies)}
+
+class DynamicBatcher(object):
+	"""Coalesce the concurrent define requests into batches of Emb2Seq_Model.beam_search
+	The model runs in one worker thread, so the event loop keeps queueing
+	the new requests while a batch is decoded.
+	"""
+
+	def __init__(self, model, vocab, max_instances = 64, max_latency = 0.01,
+				beam_width = 1, length_penalty = 1.0, lm_fusion = None):
+		self.model = model
+		self.vocab = vocab
+		self.max_instances = max_instances
+		self.max_latency = max_latency
+		self.beam_width = beam_width
+		self.length_penalty = length_penalty
+		self.lm_fusion = lm_fusion
+
+		self.metrics = ServerMetrics()
+		self.executor = ThreadPoolExecutor(max_workers = 1)
+		self.queue = None
+		self.task = None
+
+		# a request taken from the queue that did not fit in the last batch
+		self.pending = None
+
+	def start(self):
+		self.queue = asyncio.Queue()
+		self.task = asyncio.ensure_future(self._run())
+
+	async def stop(self):
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+		self.executor.shutdown(wait = True)
+
+	def queue_depth(self):
+		return self.queue.qsize() + (self.pending is not None)
+
+	# the generated definitions of the target words of one sentence
+	async def define(self, sentence, spans):
+		'''
+		sentence: a list of words
+		spans: the (start, end) word positions of the target words, end excluded
+		'''
+		sentence = [str(word) for word in sentence]
+		spans = [(int(start), int(end)) for start, end in spans]
+		if not sentence or not spans:
+			raise ValueError('empty sentence or no target words')
+		for start, end in spans:
+			if not 0 <= start < end <= len(sentence):
+				raise ValueError('span ({}, {}) out of the sentence'.format(start, end))
+
+		future = asyncio.get_event_loop().create_future()
+		await self.queue.put((sentence, spans, future, time.time()))
+		return await future
+
+	# the next batch of requests: waits for the first one,
+	# then for more until the batch is full or its deadline passes
+	async def _next_batch(self):
+		if self.pending is not None:
+			first, self.pending = self.pending, None
+		else:
+			first = await self.queue.get()
+		batch = [first]
+		num_instances = len(first[1])
+		deadline = first[3] + self.max_latency
+
+		while num_instances < self.max_instances:
+			timeout = deadline - time.time()
+			if timeout <= 0 and self.queue.empty():
+				break
+			try:
+				request = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+			except asyncio.TimeoutError:
+				break
+
+			# a request never goes over the budget, unless it is alone
+			if num_instances + len(request[1]) > self.max_instances:
+				self.pending = request
+				break
+			batch.append(request)
+			num_instances += len(request[1])
+
+		return batch, num_instances
+
+	async def _run(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			batch, num_instances = await self._next_batch()
+
+			start_time = time.time()
+			try:
+				definitions = await loop.run_in_executor(self.executor, self._decode_batch, batch)
+			except Exception as e:
+				self.metrics.errors += len(batch)
+				for _, _, future, _ in batch:
+					if not future.done():
+						future.set_exception(e)
+				continue
+			end_time = time.time()
+			self.metrics.record_batch(num_instances, end_time - start_time)
+
+			for (_, spans, future, arrival), result in zip(batch, definitions):
+				self.metrics.record_request(len(spans), end_time - arrival)
+				if not future.done():
+					future.set_result(result)
+
+	# one beam search over the target words of all requests, in the worker thread
+	def _decode_batch(self, batch):
+		sentences = [sentence for sentence, _, _, _ in batch]
+		spans = [spans for _, spans, _, _ in batch]
+
+		# list[tensor] of size (max_length, batch)
+		result, _ = self.model.beam_search(
+			sentences,
+			spans,
+			beam_width = self.beam_width,
+			length_penalty = self.length_penalty,
+			lm_fusion = self.lm_fusion)
+		sequences = torch.stack(result, 1).tolist()
+
+		definitions, offset = [], 0
+		for instances in spans:
+			definitions.append([sequence_to_definition(sequence, self.vocab) for sequence in sequences[offset:offset + len(instances)]])
+			offset += len(instances)
+		return definitions
+
+class DefinitionServer(object):
+	"""A minimal HTTP/1.1 server for a DynamicBatcher, one request per connection"""
+
+	def __init__(self, batcher, host = '127.0.0.1', port = 8080, unix_socket = None, max_body = 1 << 20):
+		self.batcher = batcher
+		self.host = host
+		self.port = port
+		self.unix_socket = unix_socket
+		self.max_body = max_body
+		self.server = None
+
+	async def start(self):
+		self.batcher.start()
+		if self.unix_socket is not None:
+			self.server = await asyncio.start_unix_server(self._handle, path = self.unix_socket)
+		else:
+			self.server = await asyncio.start_server(self._handle, self.host, self.port)
+		return self.server
+
+	async def stop(self):
+		self.server.close()
+		await self.server.wait_closed()
+		await self.batcher.stop()
+
+	async def _handle(self, reader, writer):
+		try:
+			status, reply = await self._dispatch(reader)
+		except ValueError as e:
+			status, reply = 400, {'error': str(e)}
+		except Exception as e:
+			status, reply = 500, {'error': str(e)}
+
+		body = json.dumps(reply).encode('utf-8')
+		writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+			status, 'OK' if status == 200 else 'Error', len(body)).encode('latin-1') + body)
+		try:
+			await writer.drain()
+		finally:
+			writer.close()
+
+	async def _dispatch(self, reader):
+		request_line = (await reader.readline()).decode('latin-1').split()
+		if len(request_line) < 2:
+			raise ValueError('malformed request line')
+		method, path = request_line[0], request_line[1]
+
+		headers = {}
+		while True:
+			line = (await reader.readline()).decode('latin-1').strip()
+			if not line:
+				break
+			name, _, value = line.partition(':')
+			headers[name.strip().lower()] = value.strip()
+
+		if method == 'GET' and path == '/metrics':
+			return 200, self.batcher.metrics.snapshot(self.batcher.queue_depth())
+
+		if method == 'POST' and path == '/define':
+			length = int(headers.get('content-length', 0))
+			if length > self.max_body:
+				raise ValueError('request body too large')
+			request = json.loads((await reader.readexactly(length)).decode('utf-8'))
+			if 'spans' in request:
+				spans = request['spans']
+			else:
+				spans = [(position, position + 1) for position in request.get('positions', [])]
+			definitions = await self.batcher.define(request.get('sentence', []), spans)
+			return 200, {'definitions': definitions}
+
+		return 404, {'error': 'unknown route {} {}'.format(method, path)}
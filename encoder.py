@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 import math
 from collections import Iterable, defaultdict
 import itertools
@@ -17,6 +18,7 @@ class Encoder(nn.Module):
 				output_size = 256, # output size of each sense embedding [256, 1]
 				embedding_size = 1024, # ELMo embedding size
 				elmo_class = None,
+				elmo_cache = None, # optional ElmoCache of the precomputed ELMo activations
 				tuned_embed_size = 512,
 				mlp_dropout = 0.1,
 				lstm_hidden_size = 256, # bi-directional, so final size is 512
@@ -27,6 +29,7 @@ class Encoder(nn.Module):
 		# all senses for all words
 		# useful for all purposes
 		self.elmo_class = elmo_class
+		self.elmo_cache = elmo_cache
 		self.device = device
 
 		# for dimension reduction 
@@ -72,8 +75,14 @@ class Encoder(nn.Module):
 		''' 
 
 		# get ELMo embedding of the sentence
+		# from the cache if possible, since ELMo is frozen
 		# [3 (layers), sentence length, 1024 (word vector length)]
-		embedding = torch.from_numpy(self.elmo_class.embed_sentence(sentence))
+		embedding = None
+		if self.elmo_cache is not None:
+			embedding = self.elmo_cache.get(sentence)
+		if embedding is None:
+			embedding = self.elmo_class.embed_sentence(sentence)
+		embedding = torch.from_numpy(embedding)
 		embedding = embedding.to(self.device)
 
 		# [sentence_length, 3 (layers), 1024 (word vector length)]
@@ -90,11 +99,76 @@ class Encoder(nn.Module):
 
 		return embedding
 
+	# get the ELMo embeddings of many sentences at once
+	def _get_batch_embedding(self, sentences):
+		'''
+			@param: a list of sentences (each a list of words)
+
+			@return: 
+			dimension-reduced ELMo embeddings of all sentences, padded
+			[max sentence length, batch_size, 512]
+			and the length of each sentence
+		'''
+
+		# from the cache if possible, the misses are embedded by ELMo in one batch
+		activations = [None] * len(sentences)
+		if self.elmo_cache is not None:
+			activations = [self.elmo_cache.get(sentence) for sentence in sentences]
+		missing = [i for i, activation in enumerate(activations) if activation is None]
+		if missing:
+			for i, activation in zip(missing, self.elmo_class.embed_batch([sentences[i] for i in missing])):
+				activations[i] = activation
+
+		# [sentence_length, 3 * 1024] for each sentence
+		embedding = [torch.from_numpy(activation).permute(1, 0, 2).contiguous().view(activation.shape[1], -1) for activation in activations]
+		lengths = [e.size()[0] for e in embedding]
+
+		# [max sentence length, batch_size, 512]
+		embedding = pad_sequence(embedding).to(self.device)
+		embedding = torch.tanh(self.dimension_reduction(embedding))
+
+		return embedding, lengths
+
+	# forward propagation of many sentences at once
+	# sentences: list of plain sentences (lists of words)
+	# tagged_sents: list of the tagged XML elements of each sentence
+	# spans: the (start, end) token positions of the tagged words of each sentence
+	def forward_batch(self, sentences, tagged_sents, spans = None):
+		'''
+		returns the sense embeddings of all tagged words of all sentences
+		(total number of tagged words, 256), in the order of the sentences,
+		and the offsets of each sentence: the tagged words of sentence i are
+		rows offsets[i]:offsets[i + 1]
+		'''
+
+		# [max sentence length, batch_size, 512]
+		embedding, lengths = self._get_batch_embedding(sentences)
+
+		# Run a Bi-LSTM over the packed sentences, without the padding
+		# (max sentence length, batch, num_directions * hidden_size)
+		packed = pack_padded_sequence(embedding, lengths, enforce_sorted = False)
+		self.lstm.flatten_parameters()
+		packed_new, (hn, cn) = self.lstm(packed)
+		embedding_new, _ = pad_packed_sequence(packed_new)
+
+		# Extract the new word embedding for all tagged words of all sentences
+		# (total tagged, num_directions * hidden_size)
+		processed_embedding = self._process_batch_embedding(sentences, embedding_new, tagged_sents, spans)
+
+		# Run fine-tuning MLP on new word embedding and get sense embedding
+		# (total tagged, 256)
+		sense_embedding = self.mlp(processed_embedding)
+
+		offsets = [0]
+		for instances in (spans if spans is not None else tagged_sents):
+			offsets.append(offsets[-1] + len(instances))
+		return sense_embedding, offsets
 
 	# forward propagation selected sentence and definitions
 	# all-word WSD from the SemCor dataset
 	# tagged_sent is the list of XML elements for each word or phrase
-	def forward(self, sentence, tagged_sent):
+	# spans are their (start, end) token positions, see wsd_data.sentence_instances
+	def forward(self, sentence, tagged_sent, spans = None):
 		
 		# get the dimension-reduced ELMo embedding
 		# [sentence_length, batch_size, 512]
@@ -107,7 +181,7 @@ class Encoder(nn.Module):
 
 		# Extract the new word embedding for all tagged words
 		# (new_seq, num_directions * hidden_size)
-		processed_embedding = self._process_embedding(sentence, embedding_new, tagged_sent)
+		processed_embedding = self._process_embedding(sentence, embedding_new, tagged_sent, spans)
 
 		# Run fine-tuning MLP on new word embedding and get sense embedding
 		# (new_seq, 256): new seq length is the number of tagged words/phrases
@@ -117,13 +191,50 @@ class Encoder(nn.Module):
 
 	# average pool the phrases and remove untagged words
 	# deal with partially labeled or phrase-labeled sentences
-	# tagged_sent is the list of tagged words from the SemCor
-	def _process_embedding(self, sentence, embedding, tagged_sent):
+	# spans: (start, end) token positions of each tagged word or phrase
+	def _process_embedding(self, sentence, embedding, tagged_sent, spans = None):
 
-		# only get those tagged phrases and words 
-		new_embedding = [embedding[sentence.index(instance.text), :, :] for instance in tagged_sent]
+		# positions of the tagged words, if not given by the data pipeline
+		if spans is None:
+			spans = self._instance_spans(sentence, tagged_sent)
 
-		# concate the all-word embeddings
 		# (new_seq, num_directions * hidden_size)
-		result = torch.cat(new_embedding, dim = 0).to(self.device)
+		result = self._pool_spans(embedding.view(-1, embedding.size()[2]), spans, batch = 0, batch_size = 1)
 		return result
+
+	# the batched version of _process_embedding
+	# embedding: (max sentence length, batch, num_directions * hidden_size)
+	def _process_batch_embedding(self, sentences, embedding, tagged_sents, spans = None):
+		batch_size = embedding.size()[1]
+		if spans is None:
+			spans = [self._instance_spans(sentence, tagged_sent) for sentence, tagged_sent in zip(sentences, tagged_sents)]
+
+		# the tokens of sentence b are every batch_size rows of the flattened embedding
+		flat = embedding.view(-1, embedding.size()[2])
+		all_spans = torch.cat([torch.as_tensor(sentence_spans, dtype = torch.long).view(-1, 2) for sentence_spans in spans])
+		batch = torch.cat([torch.full((len(sentence_spans), ), b, dtype = torch.long) for b, sentence_spans in enumerate(spans)])
+
+		# (total tagged, num_directions * hidden_size)
+		result = self._pool_spans(flat, all_spans, batch = batch, batch_size = batch_size)
+		return result
+
+	# legacy positions: the first occurrence of each tagged word in the sentence
+	def _instance_spans(self, sentence, tagged_sent):
+		return [(sentence.index(instance.text), sentence.index(instance.text) + 1) for instance in tagged_sent]
+
+	# average pool the rows of each (start, end) span
+	# in the (length * batch_size, hidden) flattened embedding
+	def _pool_spans(self, flat, spans, batch, batch_size):
+		spans = torch.as_tensor(spans, dtype = torch.long).view(-1, 2)
+		starts, lengths = spans[:, 0], spans[:, 1] - spans[:, 0]
+		num_spans = spans.size()[0]
+
+		# the span and the token of each pooled row
+		span_idx = torch.repeat_interleave(torch.arange(num_spans), lengths)
+		span_offsets = torch.cumsum(lengths, 0) - lengths
+		tokens = starts[span_idx] + torch.arange(int(lengths.sum())) - span_offsets[span_idx]
+		rows = (tokens * batch_size + torch.as_tensor(batch, dtype = torch.long).expand(num_spans)[span_idx]).to(self.device)
+
+		# segment mean over the tokens of each span
+		pooled = torch.zeros(num_spans, flat.size()[1]).to(self.device).index_add(0, span_idx.to(self.device), flat.index_select(0, rows))
+		return pooled / lengths.to(self.device).unsqueeze(1).float()
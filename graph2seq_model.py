@@ -62,32 +62,44 @@ class Graph2Seq_Model(nn.Module):
 		# word embedding for decoding sense
 		self.pad_idx = vocab('<pad>')
 		self.start_idx = vocab('<start>')
-		# self.end_idx = vocab('<end>')
+		self.end_idx = vocab('<end>')
 		self.embed = nn.Embedding(vocab.idx, self.word_embed_size, padding_idx = self.pad_idx)
 		self.dropout = nn.Dropout(dropout)
 
-	# perform per-synset SGD WSD 
-	# as a pretrain model
-	def forward(self, synset, definition, teacher_forcing_ratio = 0.4):
-		
-		'''
-		teacher_forcing: the probability of using ground truth in decoding
+	# fully teacher-forced decoding: the input words are all known in advance
+	# so the decoder runs over the whole sequence at once (see Decoder.forward_sequence)
+	def _decode_teacher_forced(self, graph_lstm_embedding, definition, hidden, cell):
 
-		definition: a list 
-		row as the batch ( == 1 here) and column as words: indices of each word in the true definition from the vocab
+		batch_size = graph_lstm_embedding.size()[0]
 
-		synset: name of the target synset node
-		'''
-		
-		# SGD per synset node on the graph
-		batch_size = 1
+		# the input words: <start>, then the true definition one step behind
+		# (self.max_length, batch_size)
+		start = torch.full((1, batch_size), self.start_idx, dtype = torch.long, device = self.device)
+		word_index = torch.cat((start, definition[:, :self.max_length - 1].t()), 0)
+
+		# concat the graph_lstm embedding to the word embedding of every time step
+		# (self.max_length, batch_size, decoder.input_size)
+		generated_embedding = self.dropout(self.embed(word_index))
+		sense_embedding = torch.cat((
+			graph_lstm_embedding.unsqueeze(0).expand(self.max_length, -1, -1), 
+			generated_embedding), 2)
+
+		# (self.max_length, batch_size, vocab_size)
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		outputs, _, _ = decoder.forward_sequence(sense_embedding, hidden, cell)
+
+		# the max word index at each time step
+		_, generated_index = torch.max(outputs, dim = 2)
+		return outputs, list(generated_index)
+
+	# the sense embedding and cell state of the target synsets from both graph lstms
+	def _graph_embedding(self, synset):
 
 		# set the graph_lstm output same size as the embedding for now
 		# check size compatible with the decoder input
 		# assert(self.graph_lstm.hidden_size * self.graph_lstm.num_layers == self.word_embed_size)
 		# assert(self.graph_lstm.hidden_size * self.graph_lstm.num_layers + self.word_embed_size == self.decoder.input_size)
 
-		# sense embedding from the graph_lstm runing on the target synset node
 		# hyper_hypon_graph
 		hyper_hypon_h_all, (hyper_hypon_hidden, hyper_hypon_cell) = self.hyper_hypon_graph(synset, depth = self.hyper_hypon_depth)
 
@@ -95,21 +107,125 @@ class Graph2Seq_Model(nn.Module):
 		mer_holo_h_all, (mer_holo_hidden, mer_holo_cell) = self.mer_holo_graph(synset, depth = self.mer_holo_depth)
 
 		# sense embedding is made by concat [[hyper, hypon], [mer, holo]]
-		graph_lstm_embedding = torch.cat((hyper_hypon_hidden, mer_holo_hidden)).unsqueeze(0)
+		# (batch_size, 2 * num_directions * graph hidden_size)
+		graph_lstm_embedding = torch.cat((hyper_hypon_hidden, mer_holo_hidden), 1)
 		# print('graph out size: {}'.format(graph_lstm_embedding.shape))
+		return graph_lstm_embedding, torch.cat((hyper_hypon_cell, mer_holo_cell), 1)
 
-		# tensor to store decoder outputs
-		outputs = torch.zeros(self.max_length, batch_size, self.vocab_size).to(self.device)
+	# the training loss of the target synsets
+	# the decoder only projects and scores the true (non <pad>) target positions (see Decoder.decode_loss)
+	def forward_loss(self, synset, definition, teacher_forcing_ratio = 0.4):
 
-		# initialize the x_0 with <start>
-		# (batch_size == 1, word_embed_size)
-		lookup_tensor = torch.tensor([self.start_idx], dtype = torch.long).to(self.device)
-		generated_embedding = self.dropout(self.embed(lookup_tensor)).to(self.device)
-		# print(generated_embedding.shape)
+		'''
+		synset, definition: as forward
+
+		@return: the mean cross entropy over the target words, as CrossEntropyLoss(ignore_index = <pad>) on forward,
+		and result: list[tensor] of size (self.max_length, batch), the generated words at the target positions
+		'''
+
+		if isinstance(synset, str):
+			synset = [synset]
+			definition = torch.as_tensor(definition, dtype = torch.long).view(1, -1)
+
+		# [batch_size, self.max_length]
+		definition = torch.as_tensor(definition, dtype = torch.long, device = self.device)
+
+		# the decoder starts from the h and c of the graph encoder
+		graph_lstm_embedding, graph_lstm_cell = self._graph_embedding(synset)
+
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		return decoder.decode_loss(
+			self.embed, 
+			self.dropout, 
+			graph_lstm_embedding, 
+			definition, 
+			graph_lstm_embedding, 
+			graph_lstm_cell, 
+			self.start_idx, 
+			self.pad_idx, 
+			teacher_forcing_ratio = teacher_forcing_ratio)
+
+	# beam search decoding of the definitions of the target synsets
+	# instead of the greedy choice at each step (see Decoder.beam_search)
+	def beam_search(self, synset, beam_width = 5, length_penalty = 1.0, lm_fusion = None):
+
+		'''
+		synset: name of the target synset node, or a list of names
+		lm_fusion: the language model fused into the word choices (see lm_fusion.LMFusion), or None
+
+		@return: result: list[tensor] of size (self.max_length, batch) as the result of forward,
+		padded after <end>, and the normalized log probability of each definition (batch)
+		'''
+
+		if isinstance(synset, str):
+			synset = [synset]
+
+		with torch.no_grad():
+			graph_lstm_embedding, graph_lstm_cell = self._graph_embedding(synset)
+
+		return self.beam_search_embeddings(
+			graph_lstm_embedding, 
+			graph_lstm_cell, 
+			beam_width = beam_width, 
+			length_penalty = length_penalty, 
+			lm_fusion = lm_fusion)
 
-		# concat of the graph_lstm embedding and the generated word embedding
-		# (batch_size == 1, decoder.input_size)
-		sense_embedding = torch.cat((graph_lstm_embedding, generated_embedding), 1).to(self.device)
+	# beam search decoding from given sense embeddings and cell states of the target synsets
+	# e.g. the precomputed ones of graph_embeddings.load_graph_embeddings, without the graph lstms
+	def beam_search_embeddings(self, graph_lstm_embedding, graph_lstm_cell, beam_width = 5, length_penalty = 1.0, lm_fusion = None):
+
+		'''
+		graph_lstm_embedding, graph_lstm_cell: (batch, 2 * num_directions * graph hidden_size), as _graph_embedding
+
+		@return: as beam_search
+		'''
+
+		graph_lstm_embedding = graph_lstm_embedding.to(self.device)
+		graph_lstm_cell = graph_lstm_cell.to(self.device)
+
+		with torch.no_grad():
+			decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+			sequences, scores = decoder.beam_search(
+				self.embed, 
+				decoder.project_context(graph_lstm_embedding), 
+				graph_lstm_embedding, 
+				graph_lstm_cell, 
+				self.start_idx, 
+				self.end_idx, 
+				self.pad_idx, 
+				self.max_length, 
+				beam_width = beam_width, 
+				length_penalty = length_penalty, 
+				lm_fusion = lm_fusion)
+
+		return list(sequences.t()), scores
+
+	# perform per-synset or mini-batch SGD WSD 
+	# as a pretrain model
+	def forward(self, synset, definition, teacher_forcing_ratio = 0.4):
+		
+		'''
+		teacher_forcing: the probability of using ground truth in decoding
+
+		definition: a list (or a list of lists or a tensor for a mini-batch: [batch_size, self.max_length])
+		row as the batch and column as words: indices of each word in the true definition from the vocab
+
+		synset: name of the target synset node, or a list of names for a mini-batch
+		'''
+		
+		# SGD per synset node on the graph is a batch of 1
+		if isinstance(synset, str):
+			synset = [synset]
+			definition = torch.as_tensor(definition, dtype = torch.long).view(1, -1)
+		batch_size = len(synset)
+
+		# the true definitions stay on the device for teacher forcing
+		# [batch_size, self.max_length]
+		definition = torch.as_tensor(definition, dtype = torch.long, device = self.device)
+
+		# sense embedding from the graph_lstm runing on the target synset node
+		# (batch_size, 2 * num_directions * graph hidden_size)
+		graph_lstm_embedding, graph_lstm_cell = self._graph_embedding(synset)
 
 		# initialize h_0 and c_0 for the decoder LSTM_Cell as the h and c of the graph encoder
 		'''
@@ -117,42 +233,77 @@ class Graph2Seq_Model(nn.Module):
 		cell = torch.zeros(batch_size, self.decoder_hidden_size).to(self.device)
 		'''
 		hidden = graph_lstm_embedding
-		cell = torch.cat((hyper_hypon_cell, mer_holo_cell)).unsqueeze(0)
+		cell = graph_lstm_cell
+
+		# no scheduled sampling: decode all time steps at once
+		if teacher_forcing_ratio >= 1:
+			return self._decode_teacher_forced(graph_lstm_embedding, definition, hidden, cell)
+
+		# tensor to store decoder outputs
+		outputs = torch.zeros(self.max_length, batch_size, self.vocab_size).to(self.device)
+
+		# initialize the x_0 with <start>
+		# (batch_size, word_embed_size)
+		lookup_tensor = torch.tensor([self.start_idx], dtype = torch.long).to(self.device)
+		generated_embedding = self.dropout(self.embed(lookup_tensor)).repeat(batch_size, 1).to(self.device)
+		# print(generated_embedding.shape)
+
+		# the graph_lstm embedding part of the decoder input projection, computed once
+		# each step only adds the projection of the generated word embedding
+		# (batch_size, 4 * decoder.hidden_size)
+		decoder = self.decoder.module if isinstance(self.decoder, nn.DataParallel) else self.decoder
+		context_gates = decoder.project_context(graph_lstm_embedding)
 
 		# visualize the result
 		result = []
 
+		# the rows still decoding, the others are finished:
+		# they have generated <end> and their true definition has ended,
+		# so their later outputs are all ignored by the loss (zeros, <pad> in the result)
+		# (num_active)
+		active = torch.arange(batch_size, device = self.device)
+		ended = torch.zeros(batch_size, dtype = torch.bool, device = self.device)
+		target_length = (definition != self.pad_idx).sum(1)
+
 		# explicitly iterate through the max_length to decode
 		for t in range(self.max_length):
 			
 			# get embedding at each time step from the LSTM
 			# (batch, vocab_size), (batch, decoder.hidden_size)
-			output, hidden, cell = self.decoder(sense_embedding, hidden, cell)
+			output, hidden, cell = self.decoder(generated_embedding, hidden, cell, context_gates)
 			# print('deocder out size in model: {}'.format(output.shape))
 			# print(output.shape)
-			outputs[t] = output
+			outputs[t, active] = output
 
 			# get the max word index from the vocabulary
 			_, generated_index = torch.max(output, dim = 1)
 			# print(generated_index)
-			result.append(generated_index)
 
-			# final word choice
-			word_index = -1
+			# scattered back into the full batch
+			result.append(torch.full((batch_size, ), self.pad_idx, dtype = torch.long, device = self.device).index_copy(0, active, generated_index))
 
-			# get the generated word index for the target synset
-			teacher_force = random.random() < teacher_forcing_ratio
-			if teacher_force:
-				word_index = definition[t]
-			else:
-				word_index = generated_index
+			# final word choices for all synsets in the batch
+			# the generated word index for each target synset
+			# or the correct word from the definition with probability teacher_forcing_ratio
+			word_index = generated_index
+			if teacher_forcing_ratio > 0:
+				teacher_force = torch.rand(len(active), device = self.device) < teacher_forcing_ratio
+				word_index = torch.where(teacher_force, definition[active, t], generated_index)
+
+			# shrink the batch to the unfinished rows, stop once all rows are finished
+			ended[active] |= generated_index == self.end_idx
+			running = ~ended[active] | (target_length[active] > t + 1)
+			if not bool(running.all()):
+				if not bool(running.any()):
+					break
+				active, word_index = active[running], word_index[running]
+				hidden, cell, context_gates = hidden[running], cell[running], context_gates[running]
 
 			# get the new embedding
-			# concat the graph_lstm embedding to the generated embedding at each time step
-			lookup_tensor = torch.tensor([word_index], dtype = torch.long).to(self.device)
-			generated_embedding = self.dropout(self.embed(lookup_tensor)).to(self.device)
-			# print(generated_embedding.shape)			
-			sense_embedding = torch.cat((graph_lstm_embedding, generated_embedding), 1).to(self.device)
+			generated_embedding = self.dropout(self.embed(word_index))
+
+		# the steps after all rows are finished
+		result += [torch.full((batch_size, ), self.pad_idx, dtype = torch.long, device = self.device)] * (self.max_length - len(result))
 
 		# print('model output size: {}'.format(outputs.shape))
 		return outputs, result
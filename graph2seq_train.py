@@ -42,6 +42,7 @@ elmo = ElmoEmbedder()
 from graph_lstm import *
 from decoder import *
 from graph2seq_model import *
+from definition_table import DefinitionTable
 
 # get the decoder vocab
 with open('./data/vocab.pkl', 'rb') as f:
@@ -58,6 +59,17 @@ with open('./data/synset_vocab_SemCor.pkl', 'rb') as f:
     synset_vocab_SemCor = pickle.load(f)
 print("Size of synset vocab in SemCor: {}".format(synset_vocab_SemCor.idx))
 
+# get the prebuilt WordNet relation index over the synset vocab
+# see utils/build_graph_index.py
+graph_index = WordNetGraphIndex.load('./data/graph_index.npz')
+
+# get the prebuilt definition ids of all synsets, indexed by the synset vocab id
+# see utils/build_definition_table.py (same max_seq_length as below)
+definition_table = DefinitionTable('./data/definitions_20')
+
+# the synset vocab id of each synset in the SemCor
+semcor_synset_ids = DefinitionTable.ids(synset_vocab, [synset_vocab_SemCor.idx2word.get(idx) for idx in range(synset_vocab_SemCor.idx)])
+
 
 # In[4]:
 
@@ -82,37 +94,49 @@ decoder_input_size = 512
 mer_holo_depth = 5
 hyper_hypon_depth = 5
 
+assert definition_table.max_length == max_seq_length
+
 # set the hyper-hypon and mer-holo graph lstms
+# the level engine, with the same states as the recursive one (see graph_lstm.py)
 hyper_hypon_graph = ChildSumGraphLSTM_WordNet(
     synset_vocab = synset_vocab, 
+    graph_index = graph_index, 
     relationship = 'hyper_hypon', 
     input_size = 256, 
     hidden_size = 64, 
     num_layers = 2, 
     bidirectional = True, 
     bias = True, 
-    dropout = 0.2)
+    dropout = 0.2, 
+    engine = 'level')
 
 mer_holo_graph = ChildSumGraphLSTM_WordNet(
     synset_vocab = synset_vocab, 
+    graph_index = graph_index, 
     relationship = 'mer_holo',
     input_size = 256, 
     hidden_size = 64, 
     num_layers = 2, 
     bidirectional = True, 
     bias = True, 
-    dropout = 0.2)
+    dropout = 0.2, 
+    engine = 'level')
 
 # decoder
 # input size of decoder = 512
 # output size of per graph lstm = 2 * 64 = 128
 # concat graph embedding size = 256
 # concat word embedding size (decoder_hidden_size) = 512 = input size of decoder
+# the output layer: 'linear', 'adaptive' (adaptive softmax) or 'sampled' (sampled softmax in training)
+# the last two use the word counts of the definitions, the evaluation is an exact full softmax
+output_layer = 'linear'
 decoder = Decoder(
     vocab_size = vocab.idx, 
     max_seq_length = max_seq_length, 
     hidden_size = decoder_hidden_size, 
-    input_size = decoder_input_size)
+    input_size = decoder_input_size, 
+    output_layer = output_layer, 
+    word_counts = definition_table.word_counts(vocab.idx) if output_layer != 'linear' else None)
 
 # the model instance
 graph2seq_model = Graph2Seq_Model(
@@ -155,83 +179,46 @@ print('PAD_IDX: {}'.format(PAD_IDX))
 criterion = nn.CrossEntropyLoss(ignore_index = PAD_IDX).to(device)
 
 
-# In[7]:
-
-
-# utility function
-# turn the given definition into its index list form
-def def2idx(definition, max_length, vocab):
-    
-    # definition is given by the WN NLTK API in a string
-    def_tokens = nltk.tokenize.word_tokenize(definition.lower())
-    
-    # limit the length if too long, trim
-    if len(def_tokens) > (max_length - 2):
-        def_tokens = def_tokens[0:(max_length - 2)]
-        
-        # add the start and end symbol
-        def_tokens = ['<start>'] + def_tokens + ['<end>']
-    
-    # if the length is too short, pad
-    elif len(def_tokens) < (max_length - 2):
-        
-        # add the start and end symbol
-        def_tokens = ['<start>'] + def_tokens + ['<end>']
-        
-        pad = ['<pad>'] * (max_length - len(def_tokens))
-        def_tokens = def_tokens + pad
-        
-    else:
-        def_tokens = ['<start>'] + def_tokens + ['<end>']
-            
-    # get the index for each element in the token list
-    def_idx_list = [vocab(token) for token in def_tokens]
-    
-    return def_idx_list
-  
-
-
 # In[8]:
 
 
 # the training function
 # pretrain on the synsets appeared in the SemCor
+# batch_size synsets per optimizer step
 small_size = 10
-def train(model, optimizer, synset_vocab_SemCor, criterion, clip):
+batch_size = 16
+def train(model, optimizer, synset_vocab_SemCor, criterion, clip, teacher_forcing_ratio = 0.4):
     
     model.train()
     epoch_loss = 0
-    synset_num = synset_vocab_SemCor.idx
+    word_num = 0
     
     # visualize results
     all_definitions = []
     all_sentence_result = []
     
-    for idx in range(synset_vocab_SemCor.idx):
-    # for idx in range(small_size):
+    for start in range(0, synset_vocab_SemCor.idx, batch_size):
+    # for start in range(0, small_size, batch_size):
 
         optimizer.zero_grad()
         
-        # get the synset and definition
-        synset = synset_vocab_SemCor.idx2word.get(idx).replace('__', '.')
-        definition = wn.synset(synset).definition()
-        # print(synset, definition)
-        all_definitions.append(definition)
-        
-        # convert to def index list
-        def_idx_list = def2idx(definition, model.max_length, vocab)
-
-        # get the graph-decoder result
-        # (self.max_length, batch_size, vocab_size) where batch_size == 1
-        output, result = model(synset, def_idx_list, teacher_forcing_ratio = 0.4)
-        all_sentence_result.append(result)
-
-        # adjust dimension for loss calculation
-        output = output.squeeze(1)
-        target = torch.tensor(def_idx_list, dtype = torch.long).to(device)
-        # print(target, definition)
+        # get the synsets and definitions of the mini-batch
+        synsets = [synset_vocab_SemCor.idx2word.get(idx).replace('__', '.') for idx in range(start, min(start + batch_size, synset_vocab_SemCor.idx))]
+        synset_ids = semcor_synset_ids[start:start + len(synsets)]
+        all_definitions.extend(definition_table.literal(synset_ids))
         
-        loss = criterion(output, target)
+        # the prebuilt def index lists
+        # [batch_size, self.max_length]
+        definitions = definition_table.tensor(synset_ids, device)
+
+        # get the graph-decoder loss
+        # the same as criterion on the (self.max_length, batch_size, vocab_size) output of the model
+        # but only the true (non <pad>) target positions are projected to the vocab
+        # the result has the generated words at these positions
+        loss, result = model.forward_loss(synsets, definitions, teacher_forcing_ratio = teacher_forcing_ratio)
+        for b in range(len(synsets)):
+            all_sentence_result.append([word_idx[b] for word_idx in result])
+
         # print(loss)
         loss.backward()
 
@@ -239,9 +226,14 @@ def train(model, optimizer, synset_vocab_SemCor, criterion, clip):
         # torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
 
         optimizer.step()
-        epoch_loss += loss.item()
+
+        # the loss is a mean over the target words of the mini-batch,
+        # weighted by their number for the mean over all target words of the epoch
+        batch_words = int((definitions != PAD_IDX).sum())
+        epoch_loss += loss.item() * batch_words
+        word_num += batch_words
                 
-    return epoch_loss / synset_num, all_sentence_result, all_definitions
+    return epoch_loss / word_num, all_sentence_result, all_definitions
 
 
 # In[9]:
@@ -296,6 +288,11 @@ import time
 
 N_EPOCHS = 40
 CLIP = 1
+
+# the first epochs are fully teacher-forced, decoding all time steps at once
+# then scheduled sampling with the step-wise decoder
+TEACHER_FORCED_EPOCHS = 0
+TEACHER_FORCING_RATIO = 0.4
 best_train_loss = float('inf')
 train_losses = []
 
@@ -303,7 +300,8 @@ for epoch in range(N_EPOCHS):
     
     start_time = time.time()
     
-    train_loss, all_sentence_result, all_definitions = train(graph2seq_model, optimizer, synset_vocab_SemCor, criterion, CLIP)
+    teacher_forcing_ratio = 1 if epoch < TEACHER_FORCED_EPOCHS else TEACHER_FORCING_RATIO
+    train_loss, all_sentence_result, all_definitions = train(graph2seq_model, optimizer, synset_vocab_SemCor, criterion, CLIP, teacher_forcing_ratio)
     train_losses.append(train_loss)
         
     end_time = time.time()
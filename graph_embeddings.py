@@ -0,0 +1,83 @@
+import json
+import os
+import numpy as np
+import torch
+
+'''
+the graph lstm sense embeddings of all synsets in the synset vocab
+computed offline in one sweep and stored as memory-mapped matrices
+row i is the synset with id i in the synset vocab
+columns are [hyper_hypon, mer_holo], each of num_directions * hidden_size,
+the same sense embedding (and cell state) fed to the decoder by Graph2Seq_Model
+'''
+
+MANIFEST = 'manifest.json'
+HIDDEN = 'hidden.npy'
+CELL = 'cell.npy'
+
+# run the trained graph lstms over the whole graph
+# and write the final hidden and cell states of every synset to out_dir
+def export_graph_embeddings(hyper_hypon_graph, mer_holo_graph, hyper_hypon_depth, mer_holo_depth,
+							out_dir, dtype = 'float32', chunk_size = None):
+	'''
+	depth: the recursion depth the graph lstms were trained with (the same states as their forward),
+		or -1 for a complete recursion over the graph, computed once per node
+	chunk_size: number of target synsets per level sweep for the depth-limited graphs
+		the first layer is shared by the targets of a sweep, the stacked layers are computed per target,
+		so the memory of a sweep grows with its size; None to sweep all synsets at once
+	'''
+
+	num_synsets = hyper_hypon_graph.synset_vocab.idx
+	graphs = [(hyper_hypon_graph, hyper_hypon_depth), (mer_holo_graph, mer_holo_depth)]
+	widths = [graph.hidden_size * (2 if graph.bidirectional else 1) for graph, _ in graphs]
+	shape = (num_synsets, sum(widths))
+
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	hidden_matrix = np.lib.format.open_memmap(os.path.join(out_dir, HIDDEN), mode = 'w+', dtype = dtype, shape = shape)
+	cell_matrix = np.lib.format.open_memmap(os.path.join(out_dir, CELL), mode = 'w+', dtype = dtype, shape = shape)
+
+	column = 0
+	for (graph, depth), width in zip(graphs, widths):
+		graph.eval()
+
+		# the complete recursion has one state per node, so one sweep is enough
+		step = num_synsets if (chunk_size is None or depth < 0) else chunk_size
+		with torch.no_grad():
+			for start in range(0, num_synsets, step):
+				synset_ids = np.arange(start, min(start + step, num_synsets))
+				hidden, cell = graph.embed_ids(synset_ids, depth)
+				hidden_matrix[start:start + len(synset_ids), column:column + width] = hidden.cpu().numpy()
+				cell_matrix[start:start + len(synset_ids), column:column + width] = cell.cpu().numpy()
+				print("[{}/{}] synsets embedded by the {} graph.".format(start + len(synset_ids), num_synsets, graph.relationship))
+		column += width
+
+	hidden_matrix.flush()
+	cell_matrix.flush()
+
+	manifest = {
+		'num_synsets': num_synsets,
+		'dim': shape[1],
+		'dtype': np.dtype(dtype).name,
+		'hidden': HIDDEN,
+		'cell': CELL,
+		'columns': [
+			{'relationship': graph.relationship, 'depth': depth, 'start': start, 'width': width}
+			for (graph, depth), width, start in zip(graphs, widths, np.cumsum([0] + widths[:-1]).tolist())]}
+	with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+		json.dump(manifest, f, indent = 2)
+
+	return manifest
+
+# open the exported matrices without copying them into memory
+# returns (hidden, cell, manifest), rows indexed by the synset vocab id
+def load_graph_embeddings(out_dir):
+	with open(os.path.join(out_dir, MANIFEST), 'r') as f:
+		manifest = json.load(f)
+
+	hidden = np.load(os.path.join(out_dir, manifest['hidden']), mmap_mode = 'r')
+	cell = np.load(os.path.join(out_dir, manifest['cell']), mmap_mode = 'r')
+	if hidden.shape != (manifest['num_synsets'], manifest['dim']):
+		raise ValueError('graph embeddings do not match the manifest')
+
+	return hidden, cell, manifest
@@ -0,0 +1,106 @@
+import itertools
+import numpy as np
+from nltk.corpus import wordnet as wn
+
+'''
+a compressed sparse row (CSR) index of the WordNet relations
+built once from the WordNet and the synset vocab, then saved to the disk
+the graph lstm walks this index instead of calling the NLTK on every node
+'''
+
+# all relations stored in the index
+RELATIONS = ['hypernyms', 'hyponyms', 'part_meronyms', 'part_holonyms']
+
+# the (up, down) relations of each lexical relationship of the graph lstm
+RELATIONSHIPS = {
+	'hyper_hypon': ('hypernyms', 'hyponyms'),
+	'mer_holo': ('part_meronyms', 'part_holonyms')}
+
+class WordNetGraphIndex(object):
+	"""Integer adjacency of the WordNet synsets
+	The synset ids are the indices of the synset vocab ('__' names),
+	so they can be used directly by the synset embeddings.
+	For each relation, the neighbors of synset i are
+	neighbors[relation][offsets[relation][i]:offsets[relation][i + 1]]
+	The relations to synsets outside of the vocab are not in the index
+	(the graph lstms see such synsets as if they had no such neighbor),
+	so the vocab should be closed under the relations; build() reports
+	the number of dropped edges of each relation in dropped.
+	"""
+
+	def __init__(self, num_synsets, offsets, neighbors, dropped = None):
+		self.num_synsets = num_synsets
+
+		# {relation: number of edges to synsets outside of the vocab}, if known
+		self.dropped = dropped
+
+		# {relation: (num_synsets + 1) int64 array}
+		self.offsets = offsets
+
+		# {relation: (num_edges) int32 array}
+		self.neighbors = neighbors
+
+	# the neighbor ids of a single synset id
+	def neighbor_ids(self, relation, synset_id):
+		offsets = self.offsets[relation]
+		return self.neighbors[relation][offsets[synset_id]:offsets[synset_id + 1]]
+
+	# the neighbor ids of many synset ids at once
+	# returns the flat neighbor ids and the number of neighbors of each synset
+	def gather(self, relation, synset_ids):
+		offsets = self.offsets[relation]
+		starts = offsets[synset_ids]
+		counts = offsets[synset_ids + 1] - starts
+
+		# position of each neighbor in the flat neighbor array
+		segment_starts = np.cumsum(counts) - counts
+		positions = np.repeat(starts - segment_starts, counts) + np.arange(counts.sum())
+		return self.neighbors[relation][positions], counts
+
+	# build the index over all synsets in the synset vocab
+	# relations to synsets outside of the vocab are dropped (and counted)
+	@classmethod
+	def build(cls, synset_vocab):
+		num_synsets = synset_vocab.idx
+		adjacency = {relation: [] for relation in RELATIONS}
+		dropped = {relation: 0 for relation in RELATIONS}
+
+		for idx in range(num_synsets):
+
+			# convert '__' to '.' due to hashing
+			synset = wn.synset(synset_vocab.idx2word[idx].replace('__', '.'))
+
+			for relation in RELATIONS:
+				names = [other.name().replace('.', '__') for other in getattr(synset, relation)()]
+				adjacency[relation].append([synset_vocab.word2idx[name] for name in names if name in synset_vocab.word2idx])
+				dropped[relation] += len(names) - len(adjacency[relation][-1])
+
+			if (idx + 1) % 10000 == 0:
+				print("[{}/{}] synsets indexed.".format(idx + 1, num_synsets))
+
+		offsets, neighbors = {}, {}
+		for relation in RELATIONS:
+			lengths = np.array([len(n) for n in adjacency[relation]], dtype = np.int64)
+			offsets[relation] = np.concatenate([np.zeros(1, dtype = np.int64), np.cumsum(lengths)])
+			neighbors[relation] = np.fromiter(itertools.chain.from_iterable(adjacency[relation]), dtype = np.int32)
+
+		for relation in RELATIONS:
+			if dropped[relation] > 0:
+				print("Dropped {} {} edges to synsets outside of the vocab.".format(dropped[relation], relation))
+
+		return cls(num_synsets, offsets, neighbors, dropped)
+
+	def save(self, path):
+		arrays = {'num_synsets': np.array(self.num_synsets)}
+		for relation in RELATIONS:
+			arrays['offsets_' + relation] = self.offsets[relation]
+			arrays['neighbors_' + relation] = self.neighbors[relation]
+		np.savez(path, **arrays)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as arrays:
+			num_synsets = int(arrays['num_synsets'])
+			offsets = {relation: arrays['offsets_' + relation] for relation in RELATIONS}
+			neighbors = {relation: arrays['neighbors_' + relation] for relation in RELATIONS}
+		return cls(num_synsets, offsets, neighbors)
@@ -7,12 +7,14 @@ from torch.nn.modules.rnn import RNNBase
 from torch.nn import Embedding
 import time
 import pickle
+import numpy as np
 if sys.version_info.major == 3:
 	from functools import lru_cache
 else:
 	from functools32 import lru_cache
 
 from nltk.corpus import wordnet as wn
+from graph_index import WordNetGraphIndex, RELATIONSHIPS
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 # test graph print
@@ -31,11 +33,31 @@ class ChildSumGraphLSTM(RNNBase):
 	  it supports two relationships (relationships) from the WordNet:
 	  - hypernyms and hyponyms
 	  - meronyms and holonyms
+
+	The relations are read from a WordNetGraphIndex (see graph_index.py)
+	built over the same synset vocab; pass the prebuilt one (see utils/build_graph_index.py),
+	if not given, it is built again from the WordNet on every construction, which is slow.
+
+	Two execution engines are available:
+	  - 'recursive': visits the nodes one by one, recursing in Python
+	  - 'level': groups all nodes at the same recursion depth
+	    and computes each level with a few batched matrix operations
+	Both compute the same states: the recursion returns (and feeds to the next layer)
+	the last state it stored for each node, e.g. the target revisited through its hyponyms
+	with a smaller remaining depth, and the level engine plans these last stores
+	without running the recursion (see _plan_stores).
+	Without a depth limit (depth <= 0), both run the same topological sweep (see _forward_complete).
+
+	With memoize, the recursive engine computes the state of each
+	(layer, direction, synset, remaining depth) once per forward,
+	and stores each node once, at the remaining depth of its last store
+	without memoize (see _plan_stores), so the results are the same
+	for any number of layers (the next layer reads the last stored state of each node).
 	"""
 
 	__metaclass__ = ABCMeta
 
-	def __init__(self, synset_vocab, relationship, *args, **kwargs):
+	def __init__(self, synset_vocab, relationship, *args, graph_index = None, engine = 'recursive', memoize = True, **kwargs):
 		super(ChildSumGraphLSTM, self).__init__('LSTM', *args, **kwargs)
 
 		# lru_cache is normally used as a decorator, but that usage
@@ -54,6 +76,27 @@ class ChildSumGraphLSTM(RNNBase):
 		else:
 			self.relationship = relationship
 
+		# integer adjacency of the WordNet over the synset vocab ids
+		if graph_index is None:
+			print('No graph index given, building it from the WordNet (prebuild it with utils/build_graph_index.py)')
+			graph_index = WordNetGraphIndex.build(synset_vocab)
+		if graph_index.num_synsets != synset_vocab.idx:
+			raise ValueError('graph index does not match the synset vocab')
+		self.graph_index = graph_index
+
+		# the relations to follow in each direction
+		up_relation, down_relation = RELATIONSHIPS[relationship]
+		self.relations = {'up': up_relation, 'down': down_relation}
+
+		if engine not in ['recursive', 'level']:
+			print('Execution Engine Not Supported!')
+			raise NotImplementedError
+		else:
+			self.engine = engine
+
+		# reuse the node states within a forward of the recursive engine
+		self.memoize = memoize
+
 
 	@staticmethod
 	def nonlinearity(x):
@@ -73,97 +116,199 @@ class ChildSumGraphLSTM(RNNBase):
 			the current synset (node)
 			must be coverted to string by wn.synset().name()
 			and convert '.' to '__' due to hashing
+			or a list of names for a mini-batch, computed over the union of their neighbourhoods:
+			the shared nodes of the first layer are computed once for the whole mini-batch
 
 		depth: the max depth the recursion will go through the WordNet
-			use -1 for a complete resursion over the graph (may hit the Python max recursion depth error)
+			use -1 (or 0) for a complete resursion over the graph
+			(runs iteratively in a topological order, with any engine)
 
-		Due to the nltk.corpus.wordnet package support,
+		Due to the graph index built from the nltk.corpus.wordnet,
 		user does not have to provide the graph to the forward function
 
 		Returns
 		-------
 		hidden_all: list of torch.Tensor
 			the updated hidden states of all connected nodes along the resursion process
+			for a mini-batch, a node reached by several targets keeps its state
+			in the forward of the last of them
 		hidden_final, cell_final: torch.Tensor
 			the final hidden state and cell state of the target synset node.
+			(batch, num_directions * hidden_size) for a mini-batch
 		"""
 
-		# used to store all updated embeddings
-		# of all the synsets that is connected and updated in this trun
-		# {layers: {'up': {synset: [embedding tensor]}, 'down': {synset: [embedding tensor]}}}
-		self.hidden_state = {}
-		self.cell_state = {}
+		# mini-batch of synsets
+		if not isinstance(synset, str):
+			synset_ids = np.array([self.synset_vocab(s.replace('.', '__')) for s in synset])
+			if self.engine == 'level' or depth <= 0:
+				return self._forward_levels(synset_ids, depth)
+			return self._forward_recursive(synset_ids, depth)
 
-		for layer in range(self.num_layers):
+		# the synset id in the synset vocab
+		# convert '.' to '__' due to hashing
+		synset_id = self.synset_vocab(synset.replace('.', '__'))
+
+		# run all nodes of the same recursion depth together
+		if self.engine == 'level' or depth <= 0:
+			hidden_all, (hidden_final, cell_final) = self._forward_levels(np.array([synset_id]), depth)
+		else:
+			hidden_all, (hidden_final, cell_final) = self._forward_recursive(np.array([synset_id]), depth)
+		return hidden_all, (hidden_final[0], cell_final[0])
+
+	'''
+	the recursive engine for a mini-batch of synset ids
+	the targets share the computed states of the first layer, which only depend on
+	the synset and the remaining depth, where the stacked layers read the states
+	stored by the recursion of their own target
+	'''
+	def _forward_recursive(self, synset_ids, depth):
 
-			# hyper == 'up'
-			# hypon == 'down'
-			self.hidden_state[layer] = {'up': {}, 'down': {}}
-			self.cell_state[layer] = {'up': {}, 'down': {}}
+		# the computed states of this forward, shared by the targets
+		# {(layer, direction, synset_id, remaining depth[, target]): (h, c)}, see _memo_key
+		self.node_memo = {}
 
-			# get the new node embedding by all its hypers and hypons
-			# start with hyper
-			self._upward_downward(layer, 'up', synset, depth, {'up': False, 'down': False})
+		# the hidden states of all connected nodes, the later targets overwrite the shared ones
+		hidden_all, hidden_final, cell_final = dict(), [], []
 
-		# convert '__' to '.' due to hashing
-		synset = synset.replace('.', '__')
+		for target, synset_id in enumerate(synset_ids.tolist()):
+			self.memo_target = target
 
-		# the hidden states of all connected hyper and hypons during the recursion
-		# the final hidden state and cell state of the current synset
-		hidden_up = self.hidden_state[self.num_layers - 1]['up']
-		hidden_down = self.hidden_state[self.num_layers - 1]['down']
+			# used to store all updated embeddings
+			# of all the synsets that is connected and updated in this trun
+			# {layers: {'up': {synset_id: [embedding tensor]}, 'down': {synset_id: [embedding tensor]}}}
+			self.hidden_state = {}
+			self.cell_state = {}
 
-		# return all the hidden states tagged with the synset
-		hidden_all = dict()
-		# print(len(self.hidden_state[self.num_layers - 1]['up'].keys()))
-		# print(len(self.hidden_state[self.num_layers - 1]['down'].keys()))
+			# with memoize, the states are not stored during the recursion,
+			# but once per node, from the remaining depth of its last store
+			if self.memoize:
+				last_stores = self._plan_stores(synset_id, depth)
 
-		for key in self.hidden_state[self.num_layers - 1]['up'].keys():
-			hidden_all.update({key: torch.cat([hidden_up[key], hidden_down[key]])})
+			for layer in range(self.num_layers):
 
-		hidden_final = torch.cat([hidden_up[synset], hidden_down[synset]])
-		cell_final = torch.cat([self.cell_state[self.num_layers - 1]['up'][synset], self.cell_state[self.num_layers - 1]['down'][synset]])
+				# hyper == 'up'
+				# hypon == 'down'
+				self.hidden_state[layer] = {'up': {}, 'down': {}}
+				self.cell_state[layer] = {'up': {}, 'down': {}}
 
-		''''
-		support mini-batch? 
-		if self._has_batch_dimension:
-			if self.batch_first:
-				return hidden_all[None, :, :], hidden_final[None, :]
-			else:
-				return hidden_all[:, None, :], hidden_final[None, :]
-		else:
-			return hidden_all, hidden_final
-		'''
+				# get the new node embedding by all its hypers and hypons
+				# start with hyper
+				self._upward_downward(layer, 'up', synset_id, depth, {'up': False, 'down': False})
 
-		# (the standard output size of LSTM)
-		return hidden_all, (hidden_final, cell_final)
+				if self.memoize:
+					for (direction, synset), last_depth in last_stores.items():
+						self._store(layer, direction, synset, *self.node_memo[self._memo_key(layer, direction, synset, last_depth)])
+
+			# the hidden states of all connected hyper and hypons during the recursion
+			# the final hidden state and cell state of the current synset
+			hidden_up = self.hidden_state[self.num_layers - 1]['up']
+			hidden_down = self.hidden_state[self.num_layers - 1]['down']
+
+			# return all the hidden states tagged with the synset ('__' name)
+			for key in self.hidden_state[self.num_layers - 1]['up'].keys():
+				hidden_all.update({self.synset_vocab.idx2word[key]: torch.cat([hidden_up[key], hidden_down[key]])})
+
+			hidden_final.append(torch.cat([hidden_up[synset_id], hidden_down[synset_id]]))
+			cell_final.append(torch.cat([self.cell_state[self.num_layers - 1]['up'][synset_id], self.cell_state[self.num_layers - 1]['down'][synset_id]]))
+
+		# (batch, num_directions * hidden_size)
+		return hidden_all, (torch.stack(hidden_final), torch.stack(cell_final))
+
+	# the states of the first layer only depend on the synset and the remaining depth,
+	# the ones of the stacked layers also on the target, whose stored states they read
+	def _memo_key(self, layer, direction, synset, depth):
+		if layer == 0:
+			return (layer, direction, synset, depth)
+		return (layer, direction, synset, depth, self.memo_target)
 
 	'''
-	given the current node (synset, in '__')
+	given the current node (synset id)
 	find all its hyper/hypon embeddings recursively (in _construct_previous)
 	calculate the new embedding by the LSTM gates
 	'''
 	def _upward_downward(self, layer, direction, synset, depth, explored):
 
-		# convert '__' to '.' due to hashing
-		synset = synset.replace('.', '__')
-
 		# 'explored' dictionary is used to monitor priority of the node
 		# since the same node may by visited twice
 		# allow over-writing on specific direction
 		explored[direction] = True
 
 		# check to see whether this node has been computed on this
-		# layer in this direction, if so short circuit the rest of
-		'''
-		if synset in self.hidden_state[layer][direction]:
-
+		# layer in this direction with the same remaining depth,
+		# if so short circuit the rest of the recursion
+		# the shared hypers/hypons of the DAG are computed once per forward
+		key = self._memo_key(layer, direction, synset, depth)
+		if self.memoize and key in self.node_memo:
 			# print('{}short-circuit synset: {}; direction: {}\n'.format('    ' * (old_depth - depth), synset, direction))
-			h_t = self.hidden_state[layer][direction][synset]
-			c_t = self.cell_state[layer][direction][synset]
+			h_t, c_t = self.node_memo[key]
+		else:
+			h_t, c_t = self._node_state(layer, direction, synset, depth, explored)
+			if self.memoize:
+				self.node_memo[key] = (h_t, c_t)
+
+		# store h and c for the new synset embeddings
+		# allow overwrite by parents
+		# (with memoize, the last stored states are set after the recursion, see _plan_stores)
+		if not self.memoize:
+			self._store(layer, direction, synset, h_t, c_t)
+
+		# if bidirectional, get the embeddings of the opposite direction
+		# otherwise, stop the recursion
+		# (a short-circuited node still visits its opposite direction)
+		if explored['up'] == True and explored['down'] == False:
+			self._upward_downward(layer, 'down', synset, depth, explored)
+		elif explored['up'] == False and explored['down'] == True:
+			self._upward_downward(layer, 'up', synset, depth, explored)
+		elif explored['up'] == False and explored['up'] == False:
+			print('both direction not explored')
+			raise NotImplementedError
+
+		# (hidden_size)
+		return h_t, c_t
+
+	# store the state of a node on a layer, the last stored one is read by the next layer
+	def _store(self, layer, direction, synset, h_t, c_t):
+		self.hidden_state[layer][direction][synset] = h_t
+		self.cell_state[layer][direction][synset] = c_t
 
-			return h_t, c_t
-		'''
+	'''
+	the remaining depth of the last state the recursion above stores
+	for each (direction, synset), without computing any state
+	the visit of (direction, synset, depth) stores, in order, the states of its hypers (or hypons)
+	c at depth - 1 in this direction then in the opposite one (each after its own visit),
+	so the stores are read in the reverse order by a depth-first walk:
+	the first store seen of a node is its last one, and a visit already walked
+	only repeats stores that were seen after it
+	'''
+	def _plan_stores(self, synset_id, depth):
+		last_stores = {}
+		walked = set()
+
+		# the top visit stores the target 'up' then 'down'
+		stack = [('up', synset_id, depth), ('down', synset_id, depth)]
+		while stack:
+			visit = stack.pop()
+			if visit in walked:
+				continue
+			walked.add(visit)
+			direction, synset, remaining = visit
+			last_stores.setdefault((direction, synset), remaining)
+
+			# the cut-off has no hypers (or hypons)
+			if remaining == 1:
+				continue
+			opposite = 'down' if direction == 'up' else 'up'
+			for child in self.graph_index.neighbor_ids(self.relations[direction], synset).tolist():
+				stack.append((direction, child, remaining - 1))
+				stack.append((opposite, child, remaining - 1))
+
+		return last_stores
+
+	'''
+	the LSTM gates of the current node (synset id) in the given direction
+	with the given remaining depth
+	'''
+	def _node_state(self, layer, direction, synset, depth, explored):
 
 		# get the current node x_t from the embedding
 		x_t = self._construct_x_t(layer, synset)
@@ -171,8 +316,6 @@ class ChildSumGraphLSTM(RNNBase):
 		# construct the hyper and hypon embedding recursively
 		# keep track of the depth of the recursion
 		# h_prev, c_prev: (hidden_size, num_hyper/num_hypon)
-		# convert '__' to '.' due to hashing
-		synset = synset.replace('__', '.')
 		oidx, (h_prev, c_prev) = self._construct_previous(layer, direction, synset, depth - 1, explored)
 
 		# broadcasting and cast the tensor size 
@@ -214,26 +357,10 @@ class ChildSumGraphLSTM(RNNBase):
 
 		# may add dropout
 		if self.dropout:
-			dropout = Dropout(p = self.dropout)
+			dropout = Dropout(p = self.dropout).train(self.training)
 			h_t = dropout(h_t)
 			c_t = dropout(c_t)
 
-		# store h and c for the new synset embeddings
-		# allow overwrite by parents
-		synset = synset.replace('.', '__')
-		self.hidden_state[layer][direction][synset] = h_t
-		self.cell_state[layer][direction][synset] = c_t
-
-		# if bidirectional, get the embeddings of the opposite direction
-		# otherwise, stop the recursion
-		if explored['up'] == True and explored['down'] == False:
-			self._upward_downward(layer, 'down', synset, depth, explored)
-		elif explored['up'] == False and explored['down'] == True:
-			self._upward_downward(layer, 'up', synset, depth, explored)
-		elif explored['up'] == False and explored['up'] == False:
-			print('both direction not explored')
-			raise NotImplementedError
-
 		# (hidden_size)
 		return h_t, c_t
 
@@ -263,7 +390,7 @@ class ChildSumGraphLSTM(RNNBase):
 		raise NotImplementedError
 
 	'''
-	given the current synset (node, in '.') and the direction
+	given the current synset (node id) and the direction
 	recursively find all its hyper or hypon embeddings
 	limited to the max recursion depth
 	'''
@@ -280,24 +407,8 @@ class ChildSumGraphLSTM(RNNBase):
 			# print('{}cut-off: {}; depth: {}; direction: {}\n'.format('    ' * (old_depth - depth), synset, depth, direction))
 			return oidx, (h_prev, c_prev)
 
-		# check the relationship and pick the synsets from the WN
-		if self.relationship == 'hyper_hypon':
-
-			# find the all hyper/hypon synsets of the current nodes by the WN
-			if direction == 'up':
-				oidx = [hyper.name() for hyper in wn.synset(synset).hypernyms()]
-			else:
-				oidx = [hypon.name() for hypon in wn.synset(synset).hyponyms()]
-		elif self.relationship == 'mer_holo':
-
-			# find the all mer/holo synsets of the current nodes by the WN
-			if direction == 'up':
-				oidx = [mer.name() for mer in wn.synset(synset).part_meronyms()]
-			else:
-				oidx = [holo.name() for holo in wn.synset(synset).part_holonyms()]
-		else:
-			print('Lexical Relationship Not Supported!')
-			raise NotImplementedError
+		# find the all hyper/hypon (or mer/holo) synset ids of the current node by the graph index
+		oidx = self.graph_index.neighbor_ids(self.relations[direction], synset).tolist()
 
 		# print(oidx)
 		# print('\n')					
@@ -327,6 +438,405 @@ class ChildSumGraphLSTM(RNNBase):
 		# (hidden_size, num_hyper/num_hypon)
 		return oidx, (h_prev, c_prev)
 
+	'''
+	the final hidden and cell states of many synset ids
+	without collecting the hidden states of all connected nodes
+	used to embed the whole graph offline (see graph_embeddings.py)
+	always one level sweep over the synset ids, with the states of either engine
+	'''
+	def embed_ids(self, synset_ids, depth):
+		_, (hidden_final, cell_final) = self._forward_levels(np.asarray(synset_ids), depth, return_all = False)
+		return hidden_final, cell_final
+
+	'''
+	the level-synchronous version of the recursion above
+	the state of a node at the remaining depth k only depends on its input
+	and the states of its hypers (or hypons) at the remaining depth k - 1,
+	so every level is computed at once from the previous one
+	as in the recursion, the outputs and the inputs of the next layer are
+	the last stored states of the nodes (see _plan_stores):
+	the states of the first layer only depend on the synset and the remaining depth,
+	so they are computed once for all targets, the stacked layers once per target
+	'''
+	def _forward_levels(self, synset_ids, depth, return_all = True):
+		"""
+		Parameters
+		----------
+
+		synset_ids: np.ndarray of synset ids in the synset vocab
+			the target synsets (nodes)
+
+		depth: the max depth the recursion will go through the WordNet
+			use -1 (or 0) for a complete resursion over the graph
+
+		return_all: whether to collect hidden_all (None otherwise)
+
+		Returns
+		-------
+		hidden_all: dict of torch.Tensor
+			the hidden states of all connected nodes, tagged with the synset ('__' name)
+			as the recursive engine; for a mini-batch, a node reached by several targets
+			keeps its state in the forward of the last of them
+		hidden_final, cell_final: torch.Tensor
+			(num_synsets, num_directions * hidden_size)
+			the final hidden state and cell state of the target synset nodes
+		"""
+
+		# as in the recursive engine, where the cut-off is never reached from depth 0
+		if depth <= 0:
+			return self._forward_complete(synset_ids, return_all)
+
+		# the rows are coded as target * num_synsets + synset id,
+		# without the target on the first layer
+		num_synsets = self.graph_index.num_synsets
+		synset_ids = np.asarray(synset_ids, dtype = np.int64)
+		last_codes, last_depths = self._plan_last_stores(synset_ids, depth)
+		target_codes = np.arange(len(synset_ids)) * num_synsets + synset_ids
+		target_depths = last_depths[np.searchsorted(last_codes, target_codes)]
+
+		# the rows of each layer, from the outputs down to the first layer
+		if return_all:
+			needed_codes, needed_depths = last_codes, last_depths
+		else:
+			needed_codes, needed_depths = target_codes, target_depths
+		plans = [None] * self.num_layers
+		for layer in range(self.num_layers - 1, -1, -1):
+			if layer == 0:
+				needed_codes = needed_codes % num_synsets
+			plans[layer] = {direction: self._plan_rows(direction, needed_codes, needed_depths[:, i], depth) for i, direction in enumerate(['up', 'down'])}
+
+			# the inputs of the stacked layers are the last stored states of the layer below
+			needed_codes = np.unique(np.concatenate([codes for direction in ['up', 'down'] for codes, _, _ in plans[layer][direction]]))
+			needed_depths = last_depths[np.searchsorted(last_codes, needed_codes)]
+
+		# states[direction] = (h, c) of the rows of all levels, level by level
+		states = None
+		for layer in range(self.num_layers):
+			below, states = states, {}
+
+			for direction in ['up', 'down']:
+				h_levels, c_levels = [], []
+				h_prev = torch.zeros(0, self.hidden_size).to(device)
+				c_prev = torch.zeros(0, self.hidden_size).to(device)
+
+				for codes, src, dst in plans[layer][direction]:
+
+					# the input of the nodes of this level
+					hidden_below = None
+					if below:
+						depths = last_depths[np.searchsorted(last_codes, codes)]
+						below_codes = codes % num_synsets if layer == 1 else codes
+						hidden_below = {}
+						for i, below_direction in enumerate(['up', 'down']):
+							positions = self._plan_positions(plans[layer - 1][below_direction], below_codes, depths[:, i])
+							hidden_below[below_direction] = (below[below_direction][0][positions], below[below_direction][1][positions])
+					x_t = self._construct_x_level(layer, codes % num_synsets, hidden_below)
+
+					h_prev, c_prev = self._level_cell(layer, direction, x_t, h_prev, c_prev, src, dst)
+					h_levels.append(h_prev)
+					c_levels.append(c_prev)
+
+				states[direction] = (torch.cat(h_levels), torch.cat(c_levels))
+
+		# the last stored states of the given (code, remaining depth) rows on the last layer
+		def last_states(codes, depths):
+			if self.num_layers == 1:
+				codes = codes % num_synsets
+			positions = [self._plan_positions(plans[-1][direction], codes, depths[:, i]) for i, direction in enumerate(['up', 'down'])]
+			hidden = torch.cat([states['up'][0][positions[0]], states['down'][0][positions[1]]], 1)
+			cell = torch.cat([states['up'][1][positions[0]], states['down'][1][positions[1]]], 1)
+			return hidden, cell
+
+		hidden_final, cell_final = last_states(target_codes, target_depths)
+		if not return_all:
+			return None, (hidden_final, cell_final)
+
+		# the codes are sorted by target, so the later targets overwrite the shared nodes
+		hidden, _ = last_states(last_codes, last_depths)
+		hidden_all = dict()
+		for i, synset_id in enumerate((last_codes % num_synsets).tolist()):
+			hidden_all[self.synset_vocab.idx2word[synset_id]] = hidden[i]
+
+		return hidden_all, (hidden_final, cell_final)
+
+	# the stored nodes of the recursion of each target and the remaining depths of their last stores
+	# returns the sorted target * num_synsets + synset id codes and their ('up', 'down') depths
+	def _plan_last_stores(self, synset_ids, depth):
+		num_synsets = self.graph_index.num_synsets
+		codes, depths = [], []
+		for target, synset_id in enumerate(synset_ids.tolist()):
+			last_stores = self._plan_stores(synset_id, depth)
+			nodes = sorted(set(synset for _, synset in last_stores))
+			codes.append(target * num_synsets + np.array(nodes, dtype = np.int64))
+			depths.append(np.array([[last_stores[('up', node)], last_stores[('down', node)]] for node in nodes], dtype = np.int64))
+		return np.concatenate(codes), np.concatenate(depths)
+
+	'''
+	the rows of each level in one direction, from the cut-off (remaining depth 1) up to depth:
+	the given rows, at their remaining depth, and all their hypers (or hypons) on the levels below
+	returns the sorted codes of each level and the (child, parent) edges from the level below
+	'''
+	def _plan_rows(self, direction, codes, depths, depth):
+		num_synsets = self.graph_index.num_synsets
+
+		# from the max depth down to the cut-off
+		levels = []
+		children = np.zeros(0, dtype = np.int64)
+		for k in range(depth, 0, -1):
+			level_codes = np.unique(np.concatenate([codes[depths == k], children]))
+
+			# at the cut-off, all nodes only have the zero child
+			if k > 1:
+				neighbors, counts = self.graph_index.gather(self.relations[direction], level_codes % num_synsets)
+			else:
+				neighbors, counts = np.zeros(0, dtype = np.int64), np.zeros(len(level_codes), dtype = np.int64)
+
+			# the children keep the target of their parent
+			children = np.repeat(level_codes - level_codes % num_synsets, counts) + neighbors
+			levels.append((level_codes, children, counts))
+		levels = levels[::-1]
+
+		plan = []
+		for k, (level_codes, children, counts) in enumerate(levels):
+
+			# index of each child in the level below
+			# 0 is saved for the zero child of the leaf nodes
+			src = np.searchsorted(levels[k - 1][0], children) + 1 if k > 0 else children
+			dst = np.repeat(np.arange(len(counts)), counts)
+
+			leaves = np.nonzero(counts == 0)[0]
+			src = np.concatenate([src, np.zeros(len(leaves), dtype = np.int64)])
+			dst = np.concatenate([dst, leaves])
+
+			plan.append((level_codes, torch.from_numpy(src).long().to(device), torch.from_numpy(dst).long().to(device)))
+
+		# computed from the cut-off up to the max depth
+		return plan
+
+	# the positions of the (code, remaining depth) rows in the states of all levels of a plan
+	@staticmethod
+	def _plan_positions(plan, codes, depths):
+		positions = np.zeros(len(codes), dtype = np.int64)
+		offset = 0
+		for k, (level_codes, _, _) in enumerate(plan):
+			at_level = depths == k + 1
+			positions[at_level] = offset + np.searchsorted(level_codes, codes[at_level])
+			offset += len(level_codes)
+		return torch.from_numpy(positions).long().to(device)
+
+	'''
+	the complete recursion over the connected graph without a depth limit
+	each node has a single state per direction, which depends on the
+	states of all its hypers (or hypons), so the nodes are computed
+	in a topological order, round by round, without any Python recursion
+	'''
+	def _forward_complete(self, synset_ids, return_all = True):
+		nodes = self._plan_component(synset_ids)
+		schedules = {direction: self._plan_topological(nodes, direction) for direction in ['up', 'down']}
+
+		# ordered[direction] = (h, c) of all nodes in the order of 'nodes'
+		ordered = None
+		for layer in range(self.num_layers):
+			below, ordered = ordered, {}
+
+			for direction in ['up', 'down']:
+				rounds, rows = schedules[direction]
+				h_rounds, c_rounds = [], []
+
+				for positions, src, dst in rounds:
+
+					# the input of the nodes of this round
+					if below:
+						hidden_below = {d: (below[d][0][positions], below[d][1][positions]) for d in ['up', 'down']}
+					else:
+						hidden_below = None
+					x_t = self._construct_x_level(layer, nodes[positions.cpu().numpy()], hidden_below)
+
+					# the states of the previous rounds
+					if h_rounds:
+						h_prev, c_prev = torch.cat(h_rounds), torch.cat(c_rounds)
+					else:
+						h_prev = torch.zeros(0, self.hidden_size).to(device)
+						c_prev = torch.zeros(0, self.hidden_size).to(device)
+
+					h_t, c_t = self._level_cell(layer, direction, x_t, h_prev, c_prev, src, dst)
+					h_rounds.append(h_t)
+					c_rounds.append(c_t)
+
+				ordered[direction] = (torch.cat(h_rounds)[rows], torch.cat(c_rounds)[rows])
+
+		# the final states of the targets
+		positions = torch.from_numpy(np.searchsorted(nodes, synset_ids)).long().to(device)
+		hidden = torch.cat([ordered['up'][0], ordered['down'][0]], 1)
+		cell = torch.cat([ordered['up'][1], ordered['down'][1]], 1)
+
+		if not return_all:
+			return None, (hidden[positions], cell[positions])
+
+		hidden_all = dict()
+		for i, synset_id in enumerate(nodes.tolist()):
+			hidden_all[self.synset_vocab.idx2word[synset_id]] = hidden[i]
+
+		return hidden_all, (hidden[positions], cell[positions])
+
+	# all the synset ids connected to the targets in either direction
+	def _plan_component(self, synset_ids):
+		visited = np.zeros(self.graph_index.num_synsets, dtype = bool)
+		frontier = np.unique(synset_ids)
+		visited[frontier] = True
+
+		# breadth-first search, one frontier at a time
+		while len(frontier) > 0:
+			neighbors = np.concatenate([self.graph_index.gather(self.relations[direction], frontier)[0] for direction in ['up', 'down']])
+			frontier = np.unique(neighbors[~visited[neighbors]])
+			visited[frontier] = True
+
+		return np.nonzero(visited)[0]
+
+	'''
+	split the nodes into rounds, where all hypers (or hypons) of a node
+	are computed in the earlier rounds
+	returns the rounds as (positions in nodes, src, dst) with the same edges as _plan_rows,
+	and the row of each node in the concatenated states of all rounds
+	'''
+	def _plan_topological(self, nodes, direction):
+		num_nodes = len(nodes)
+		children, counts = self.graph_index.gather(self.relations[direction], nodes)
+		child_pos = np.searchsorted(nodes, children)
+		parent_pos = np.repeat(np.arange(num_nodes), counts)
+
+		# the number of children not computed yet
+		remaining = counts.copy()
+		done = np.zeros(num_nodes, dtype = bool)
+		rows = np.zeros(num_nodes, dtype = np.int64)
+		num_rows = 0
+		rounds = []
+
+		while num_rows < num_nodes:
+			ready = np.nonzero((remaining == 0) & ~done)[0]
+
+			# a cycle in the relation (e.g. two verbs being hypernyms of each other)
+			# break it at a node of the cycle, by dropping its children not computed yet
+			if len(ready) == 0:
+				ready = np.array([self._cycle_node(parent_pos, child_pos, done)])
+
+			in_round = np.zeros(num_nodes, dtype = bool)
+			in_round[ready] = True
+			round_index = np.zeros(num_nodes, dtype = np.int64)
+			round_index[ready] = np.arange(len(ready))
+
+			# the (child, parent) edges into this round
+			# 0 is saved for the zero child of the leaf nodes
+			edges = in_round[parent_pos] & done[child_pos]
+			src = rows[child_pos[edges]] + 1
+			dst = round_index[parent_pos[edges]]
+
+			leaves = np.nonzero(np.bincount(dst, minlength = len(ready)) == 0)[0]
+			src = np.concatenate([src, np.zeros(len(leaves), dtype = np.int64)])
+			dst = np.concatenate([dst, leaves])
+
+			rounds.append((
+				torch.from_numpy(ready).long().to(device),
+				torch.from_numpy(src).long().to(device),
+				torch.from_numpy(dst).long().to(device)))
+
+			# the parents of this round have fewer children left
+			done[ready] = True
+			rows[ready] = np.arange(num_rows, num_rows + len(ready))
+			num_rows += len(ready)
+			remaining -= np.bincount(parent_pos[in_round[child_pos]], minlength = num_nodes)
+
+		return rounds, torch.from_numpy(rows).long().to(device)
+
+	'''
+	a node to break the cycles of the nodes not done yet, when none of them is ready
+	the root of the first strongly connected component closed by a depth-first search (Tarjan),
+	which has no children in the other components: its children not done yet are all on its cycles
+	'''
+	@staticmethod
+	def _cycle_node(parent_pos, child_pos, done):
+		# the (parent, child) edges between the nodes not done yet, sorted by parent
+		edges = ~done[parent_pos] & ~done[child_pos]
+		order = np.argsort(parent_pos[edges], kind = 'stable')
+		parents, children = parent_pos[edges][order], child_pos[edges][order]
+
+		start = int(np.nonzero(~done)[0][0])
+		index, low = {start: 0}, {start: 0}
+		stack = [(start, 0)]
+
+		# no component is closed before the first one, so all visited nodes are still on the Tarjan stack
+		while stack:
+			node, next_child = stack[-1]
+			first, last = np.searchsorted(parents, node), np.searchsorted(parents, node, side = 'right')
+			if first + next_child < last:
+				stack[-1] = (node, next_child + 1)
+				child = int(children[first + next_child])
+				if child in index:
+					low[node] = min(low[node], index[child])
+				else:
+					index[child] = low[child] = len(index)
+					stack.append((child, 0))
+				continue
+
+			stack.pop()
+			if low[node] == index[node]:
+				return node
+			parent = stack[-1][0]
+			low[parent] = min(low[parent], low[node])
+
+	'''
+	the child-sum LSTM gates of a whole level
+	src, dst: the (child, parent) edges, with child 0 as the zero child
+	'''
+	def _level_cell(self, layer, direction, x_t, h_prev, c_prev, src, dst):
+		num_nodes = x_t.shape[0]
+
+		# project the inputs once per node and the children once per child
+		# (num_nodes, 4 * hidden_size), (num_prev + 1, 4 * hidden_size)
+		if self.bias:
+			Wih, Whh, bih, bhh = self._get_parameters(layer, direction)
+			x_proj = torch.matmul(x_t, Wih.t()) + bih + bhh
+		else:
+			Wih, Whh = self._get_parameters(layer, direction)
+			x_proj = torch.matmul(x_t, Wih.t())
+
+		zero_child = torch.zeros(1, self.hidden_size).to(device)
+		h_prev = torch.cat([zero_child, h_prev])
+		c_prev = torch.cat([zero_child, c_prev])
+		h_proj = torch.matmul(h_prev, Whh.t())
+
+		# the gates of each (child, parent) edge
+		# (num_edges, 4 * hidden_size)
+		fcio_t_raw = h_proj[src] + x_proj[dst]
+		f_t_raw, cio_t_raw = fcio_t_raw[:, :self.hidden_size], fcio_t_raw[:, self.hidden_size:]
+
+		# summing over the gated children of each parent for new h and c
+		f_t = torch.sigmoid(f_t_raw)
+		gated_children = torch.zeros(num_nodes, self.hidden_size).to(device).index_add(0, dst, torch.mul(f_t, c_prev[src]))
+
+		cio_t_raw = torch.zeros(num_nodes, 3 * self.hidden_size).to(device).index_add(0, dst, cio_t_raw)
+		c_hat_t_raw, i_t_raw, o_t_raw = torch.split(cio_t_raw, self.hidden_size, dim = 1)
+
+		c_hat_t = self.__class__.nonlinearity(c_hat_t_raw)
+		i_t = torch.sigmoid(i_t_raw)
+		o_t = torch.sigmoid(o_t_raw)
+
+		c_t = gated_children + torch.mul(i_t, c_hat_t)
+		h_t = torch.mul(o_t, self.__class__.nonlinearity(c_t))
+
+		# may add dropout
+		if self.dropout:
+			dropout = Dropout(p = self.dropout).train(self.training)
+			h_t = dropout(h_t)
+			c_t = dropout(c_t)
+
+		# (num_nodes, hidden_size)
+		return h_t, c_t
+
+	@abstractmethod
+	def _construct_x_level(self, layer, synset_ids, hidden_below):
+		raise NotImplementedError
+
 
 class ChildSumGraphLSTM_WordNet(ChildSumGraphLSTM):
 	"""A bidirectional extension of child-sum tree LSTMs
@@ -352,12 +862,11 @@ class ChildSumGraphLSTM_WordNet(ChildSumGraphLSTM):
 		else:
 
 			# get the synset (sense) embedding
-			synset_idx = self.synset_vocab(synset)
-			lookup_tensor = torch.tensor([synset_idx], dtype = torch.long).to(device)
+			lookup_tensor = torch.tensor([synset], dtype = torch.long).to(device)
 			
 			# may add dropout
 			if self.dropout:
-				dropout = Dropout(p = self.dropout)
+				dropout = Dropout(p = self.dropout).train(self.training)
 				x_t = dropout(self.embedding(lookup_tensor).squeeze(0))
 			else:
 				x_t = self.embedding(lookup_tensor).squeeze(0)
@@ -366,6 +875,26 @@ class ChildSumGraphLSTM_WordNet(ChildSumGraphLSTM):
 		# print(x_t.shape)
 		return x_t
 
+	# the inputs of all nodes of a level
+	# hidden_below: the {'up', 'down'} states of the same level on the previous layer
+	def _construct_x_level(self, layer, synset_ids, hidden_below):
+		if layer > 0:
+			x_t = torch.cat([hidden_below['up'][0], hidden_below['down'][0]], 1)
+		else:
+
+			# get the synset (sense) embeddings
+			lookup_tensor = torch.from_numpy(synset_ids).long().to(device)
+
+			# may add dropout
+			if self.dropout:
+				dropout = Dropout(p = self.dropout).train(self.training)
+				x_t = dropout(self.embedding(lookup_tensor))
+			else:
+				x_t = self.embedding(lookup_tensor)
+
+		# (num_nodes, input_size)
+		return x_t
+
 # test run
 def main():
 
@@ -373,8 +902,12 @@ def main():
 		synset_vocab = pickle.load(f)
 	print("Size of synset vocab: {}".format(synset_vocab.idx))
 
+	# the prebuilt relation index (see utils/build_graph_index.py)
+	graph_index = WordNetGraphIndex.load('./data/graph_index.npz')
+
 	graph = ChildSumGraphLSTM_WordNet(
 		synset_vocab = synset_vocab, 
+		graph_index = graph_index, 
 		relationship = 'hyper_hypon', 
 		input_size = 256, 
 		hidden_size = 128, 
@@ -0,0 +1,154 @@
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+'''
+shallow fusion of a language model into the decoding
+the scores of the next word are log p_decoder + weight * log p_lm
+the language model keeps its own state per row and reads one word per step,
+so the fusion costs the same at every step, whatever the length of the prefix
+
+shipped language model: a small LSTM over the WordNet definitions
+(the definition table, see definition_table.py), trained offline by utils/build_definition_lm.py
+'''
+
+# the first ids of the language model vocab
+SPECIALS = ['<pad>', '<start>', '<end>', '<unk>']
+UNK = SPECIALS.index('<unk>')
+
+class DefinitionLM(nn.Module):
+	"""A small LSTM language model over the tokenized WordNet definitions
+	Its vocab is the most frequent words of the decoder vocab, see build_lm_vocab.
+	"""
+
+	def __init__(self, vocab_size, embed_size = 128, hidden_size = 256, pad_idx = 0):
+		super(DefinitionLM, self).__init__()
+		self.vocab_size = vocab_size
+		self.embed_size = embed_size
+		self.hidden_size = hidden_size
+		self.pad_idx = pad_idx
+
+		self.embed = nn.Embedding(vocab_size, embed_size, padding_idx = pad_idx)
+		self.lstm = nn.LSTM(embed_size, hidden_size)
+		self.linear = nn.Linear(hidden_size, vocab_size)
+
+	# the settings to rebuild the model, saved with its weights
+	def config(self):
+		return {'vocab_size': self.vocab_size, 'embed_size': self.embed_size, 'hidden_size': self.hidden_size, 'pad_idx': self.pad_idx}
+
+	# word_index (seq_length, batch_size) -> logits (seq_length, batch_size, vocab_size)
+	def forward(self, word_index):
+		hiddens, _ = self.lstm(self.embed(word_index))
+		return self.linear(hiddens)
+
+	# the state before the first word: (h, c) of shape (1, batch_size, hidden_size)
+	def init_state(self, batch_size, device):
+		return (torch.zeros(1, batch_size, self.hidden_size, device = device),
+				torch.zeros(1, batch_size, self.hidden_size, device = device))
+
+	# read one word per row: word_index (batch_size)
+	# returns the log probabilities of the next word (batch_size, vocab_size) and the new state
+	def step(self, word_index, state):
+		hidden, state = self.lstm(self.embed(word_index).unsqueeze(0), state)
+		return F.log_softmax(self.linear(hidden.squeeze(0)), dim = 1), state
+
+	# keep the rows of the state given by index (a long index or a bool mask)
+	def reorder_state(self, state, index):
+		return tuple(tensor[:, index] for tensor in state)
+
+class LMFusion(nn.Module):
+	"""Shallow fusion of a language model with its own vocab into the decoder vocab
+	lm_ids (decoder vocab size): the language model id of each decoder word,
+	the words out of the language model vocab share the probability of its <unk>.
+	"""
+
+	def __init__(self, lm, lm_ids, unk_idx, weight = 0.3):
+		super(LMFusion, self).__init__()
+		self.lm = lm
+		self.weight = weight
+
+		lm_ids = torch.as_tensor(lm_ids, dtype = torch.long)
+		self.register_buffer('lm_ids', lm_ids)
+
+		# the <unk> probability is split evenly over the words it stands for
+		num_unk = int((lm_ids == unk_idx).sum())
+		correction = torch.zeros(len(lm_ids))
+		if num_unk > 1:
+			correction[lm_ids == unk_idx] = -math.log(num_unk)
+		self.register_buffer('correction', correction)
+
+	def init_state(self, batch_size, device):
+		return self.lm.init_state(batch_size, device)
+
+	# read the decoder words (batch_size) just fed to the decoder
+	# returns the language model log probabilities of the next decoder word (batch_size, decoder vocab size)
+	def step(self, word_index, state):
+		with torch.no_grad():
+			log_probs, state = self.lm.step(self.lm_ids.index_select(0, word_index), state)
+			return log_probs.index_select(1, self.lm_ids) + self.correction, state
+
+	def reorder_state(self, state, index):
+		return self.lm.reorder_state(state, index)
+
+	# the fused scores of the next word for the decoder output (batch_size, decoder vocab size)
+	def fuse(self, output, lm_log_probs):
+		return F.log_softmax(output, dim = 1) + self.weight * lm_log_probs
+
+# the language model vocab: the special tokens and the lm_vocab_size most frequent words
+# returns lm_ids, the language model id of each decoder word (<unk> for the others),
+# and the number of language model words
+def build_lm_vocab(vocab, word_counts, lm_vocab_size):
+	specials = [vocab(word) for word in SPECIALS]
+
+	lm_ids = np.full(vocab.idx, UNK, dtype = np.int64)
+	lm_ids[specials] = np.arange(len(specials))
+
+	order = [idx for idx in np.argsort(-np.asarray(word_counts), kind = 'stable').tolist() if idx not in specials]
+	words = order[:max(lm_vocab_size - len(specials), 0)]
+	lm_ids[words] = np.arange(len(specials), len(specials) + len(words))
+	return lm_ids, len(specials) + len(words)
+
+# train the definition language model on all rows of a definition table
+def train_definition_lm(definition_table, vocab, lm_vocab_size = 10000, embed_size = 128, hidden_size = 256,
+						epochs = 5, batch_size = 256, device = torch.device('cpu')):
+	lm_ids, num_words = build_lm_vocab(vocab, definition_table.word_counts(vocab.idx), lm_vocab_size)
+	lm = DefinitionLM(num_words, embed_size = embed_size, hidden_size = hidden_size, pad_idx = 0).to(device)
+	optimizer = torch.optim.Adam(lm.parameters())
+	lm_ids_tensor = torch.as_tensor(lm_ids)
+
+	num_synsets = len(definition_table)
+	for epoch in range(epochs):
+		lm.train()
+		epoch_loss, num_batches = 0, 0
+		order = np.random.permutation(num_synsets)
+		for start in range(0, num_synsets, batch_size):
+			synset_ids = order[start:start + batch_size]
+
+			# (max_length, batch_size) in the language model vocab
+			definitions = lm_ids_tensor[definition_table.tensor(synset_ids)].t().to(device)
+
+			optimizer.zero_grad()
+			logits = lm(definitions[:-1])
+			loss = F.cross_entropy(logits.view(-1, num_words), definitions[1:].reshape(-1), ignore_index = 0)
+			loss.backward()
+			optimizer.step()
+
+			epoch_loss += loss.item()
+			num_batches += 1
+		print("Epoch {} | LM loss: {:.3f} | PPL: {:7.3f}".format(epoch + 1, epoch_loss / num_batches, math.exp(epoch_loss / num_batches)))
+
+	lm.eval()
+	return lm, lm_ids
+
+def save_definition_lm(lm, lm_ids, path):
+	torch.save({'config': lm.config(), 'state_dict': lm.state_dict(), 'lm_ids': torch.as_tensor(lm_ids)}, path)
+
+# the fusion of a saved definition language model, ready for decoding
+def load_lm_fusion(path, weight = 0.3, device = torch.device('cpu')):
+	checkpoint = torch.load(path, map_location = 'cpu')
+	lm = DefinitionLM(**checkpoint['config'])
+	lm.load_state_dict(checkpoint['state_dict'])
+	lm.eval()
+	return LMFusion(lm, checkpoint['lm_ids'], unk_idx = UNK, weight = weight).to(device)
@@ -0,0 +1,148 @@
+import collections
+import numpy as np
+import torch
+from definition_table import DefinitionTable, sequence_to_definition
+from graph_embeddings import load_graph_embeddings
+
+'''
+a serving mode of Graph2Seq_Model for the definitions of whole synsets
+the definition of a synset only depends on the synset, so
+	- the graph lstms are not run: the sense embeddings and cell states of all synsets
+	  are read from the precomputed matrices (see graph_embeddings.py, utils/embed_wordnet.py)
+	- the generated definitions are kept in an LRU cache, a repeated synset is one dict lookup
+	- the missed synsets of a define call are decoded together in batches
+'''
+
+class DefinitionCache(object):
+	"""LRU cache of the generated definitions, keyed by the synset vocab name
+	The least recently used entries are evicted once the definitions
+	take more than max_bytes (utf-8) in total.
+	"""
+
+	def __init__(self, max_bytes = 64 << 20):
+		self.max_bytes = max_bytes
+		self.num_bytes = 0
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, name):
+		return name in self.entries
+
+	# the cached definition, or None on a miss
+	def get(self, name):
+		definition = self.entries.get(name)
+		if definition is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(name)
+		return definition
+
+	def put(self, name, definition):
+		if name in self.entries:
+			self.num_bytes -= self._size(self.entries.pop(name))
+
+		# a definition larger than the whole cache is not kept
+		size = self._size(definition)
+		if size > self.max_bytes:
+			return
+		self.entries[name] = definition
+		self.num_bytes += size
+
+		while self.num_bytes > self.max_bytes:
+			_, evicted = self.entries.popitem(last = False)
+			self.num_bytes -= self._size(evicted)
+			self.evictions += 1
+
+	@staticmethod
+	def _size(definition):
+		return len(definition.encode('utf-8'))
+
+	def stats(self):
+		return {
+			'entries': len(self.entries),
+			'bytes': self.num_bytes,
+			'max_bytes': self.max_bytes,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions}
+
+class SynsetDefinitionService(object):
+	"""Batch definitions of synsets from a trained Graph2Seq_Model
+	define(synset_names) returns the generated definitions in the same order,
+	decoding only the synsets missing from the cache.
+	"""
+
+	def __init__(self, model, vocab, synset_vocab, embedding_dir, cache_bytes = 64 << 20,
+				batch_size = 256, beam_width = 1, length_penalty = 1.0, lm_fusion = None):
+		self.model = model
+		self.vocab = vocab
+		self.synset_vocab = synset_vocab
+		self.batch_size = batch_size
+		self.beam_width = beam_width
+		self.length_penalty = length_penalty
+		self.lm_fusion = lm_fusion
+
+		# the precomputed [hyper_hypon, mer_holo] sense embeddings and cell states
+		self.hidden, self.cell, self.manifest = load_graph_embeddings(embedding_dir)
+		if self.manifest['num_synsets'] != synset_vocab.idx:
+			raise ValueError('graph embeddings do not match the synset vocab')
+
+		self.cache = DefinitionCache(cache_bytes)
+
+	# the definitions of the given synsets ('dog.n.01' or 'dog__n__01')
+	def define(self, synset_names):
+		if isinstance(synset_names, str):
+			synset_names = [synset_names]
+		names = [name.replace('.', '__') for name in synset_names]
+
+		definitions = [self.cache.get(name) for name in names]
+
+		# each missed synset is decoded once, even if asked several times
+		missed = list(collections.OrderedDict.fromkeys(name for name, definition in zip(names, definitions) if definition is None))
+		if missed:
+			decoded = dict(zip(missed, self._decode(missed)))
+			for name in missed:
+				self.cache.put(name, decoded[name])
+			definitions = [decoded[name] if definition is None else definition for name, definition in zip(names, definitions)]
+
+		return definitions
+
+	# decode and cache the definitions of the given synsets ahead of the requests
+	# e.g. all synsets of the SemCor: warm([synset_vocab_SemCor.idx2word[idx] for idx in range(synset_vocab_SemCor.idx)])
+	def warm(self, synset_names):
+		names = [name.replace('.', '__') for name in synset_names]
+		missed = [name for name in collections.OrderedDict.fromkeys(names) if name not in self.cache]
+
+		for start in range(0, len(missed), self.batch_size):
+			chunk = missed[start:start + self.batch_size]
+			for name, definition in zip(chunk, self._decode(chunk)):
+				self.cache.put(name, definition)
+		return len(missed)
+
+	# the definitions of synsets, in batches of batch_size
+	def _decode(self, names):
+		synset_ids = DefinitionTable.ids(self.synset_vocab, names)
+
+		definitions = []
+		for start in range(0, len(synset_ids), self.batch_size):
+			chunk = synset_ids[start:start + self.batch_size]
+
+			# (len(chunk), 2 * num_directions * graph hidden_size)
+			hidden = torch.from_numpy(np.asarray(self.hidden[chunk], dtype = np.float32))
+			cell = torch.from_numpy(np.asarray(self.cell[chunk], dtype = np.float32))
+
+			# list[tensor] of size (max_length, len(chunk))
+			result, _ = self.model.beam_search_embeddings(
+				hidden,
+				cell,
+				beam_width = self.beam_width,
+				length_penalty = self.length_penalty,
+				lm_fusion = self.lm_fusion)
+			definitions.extend(sequence_to_definition(sequence, self.vocab) for sequence in torch.stack(result, 1).tolist())
+		return definitions
@@ -0,0 +1,191 @@
+import os
+import random
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import pytest
+import torch
+from graph_index import WordNetGraphIndex, RELATIONS
+from graph_lstm import ChildSumGraphLSTM_WordNet
+
+'''
+the execution engines and modes of the graph lstm on a small synthetic graph
+'''
+
+class SyntheticVocab(object):
+	"""The parts of the synset vocab used by the graph lstm"""
+
+	def __init__(self, names):
+		self.word2idx = {name: idx for idx, name in enumerate(names)}
+		self.idx2word = {idx: name for idx, name in enumerate(names)}
+		self.idx = len(names)
+
+	def __call__(self, name):
+		return self.word2idx[name]
+
+# a DAG of num_synsets nodes: the hypernyms of a node have lower ids,
+# so nodes share hypernyms and are reached at several depths
+# the meronyms are the hypernyms with an even id
+def synthetic_graph(num_synsets = 30, seed = 0):
+	rng = random.Random(seed)
+	up = {'hypernyms': [], 'part_meronyms': []}
+	for idx in range(num_synsets):
+		hypernyms = sorted(rng.sample(range(idx), min(idx, rng.choice([1, 1, 2, 3]))))
+		up['hypernyms'].append(hypernyms)
+		up['part_meronyms'].append([other for other in hypernyms if other % 2 == 0])
+
+	down = {'hyponyms': [[] for _ in range(num_synsets)], 'part_holonyms': [[] for _ in range(num_synsets)]}
+	for up_relation, down_relation in [('hypernyms', 'hyponyms'), ('part_meronyms', 'part_holonyms')]:
+		for idx, others in enumerate(up[up_relation]):
+			for other in others:
+				down[down_relation][other].append(idx)
+	return graph_index_of(num_synsets, dict(up, **down))
+
+def graph_index_of(num_synsets, adjacency):
+	offsets, neighbors = {}, {}
+	for relation in RELATIONS:
+		lengths = [len(adjacency[relation][idx]) for idx in range(num_synsets)]
+		offsets[relation] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+		neighbors[relation] = np.array([other for idx in range(num_synsets) for other in adjacency[relation][idx]], dtype = np.int32)
+	return WordNetGraphIndex(num_synsets, offsets, neighbors)
+
+def make_graph_lstm(graph_index, num_layers, seed = 0, **kwargs):
+	synset_vocab = SyntheticVocab(['s{}__n__01'.format(idx) for idx in range(graph_index.num_synsets)])
+	torch.manual_seed(seed)
+	graph = ChildSumGraphLSTM_WordNet(
+		synset_vocab = synset_vocab,
+		graph_index = graph_index,
+		relationship = 'hyper_hypon',
+		input_size = 8,
+		hidden_size = 6,
+		num_layers = num_layers,
+		bidirectional = True,
+		bias = True,
+		**kwargs)
+	graph.eval()
+	return graph
+
+def assert_same_forward(first, second):
+	hidden_all, (hidden_final, cell_final) = first
+	other_all, (other_hidden, other_cell) = second
+	assert torch.allclose(hidden_final, other_hidden, atol = 1e-6)
+	assert torch.allclose(cell_final, other_cell, atol = 1e-6)
+	assert sorted(hidden_all.keys()) == sorted(other_all.keys())
+	for name in hidden_all:
+		assert torch.allclose(hidden_all[name], other_all[name], atol = 1e-6)
+
+TARGETS = ['s{}.n.01'.format(idx) for idx in [0, 7, 18, 29]]
+
+@pytest.mark.parametrize('num_layers', [1, 2])
+def test_memoize_matches_plain_recursion(num_layers):
+	graph_index = synthetic_graph()
+	memoized = make_graph_lstm(graph_index, num_layers, memoize = True)
+	plain = make_graph_lstm(graph_index, num_layers, memoize = False)
+
+	with torch.no_grad():
+		for synset in TARGETS:
+			for depth in [1, 2, 4]:
+				assert_same_forward(memoized(synset, depth), plain(synset, depth))
+
+# with memoize, each node is stored once per layer and direction, however often it is reached
+def test_memoize_stores_each_node_once():
+	graph = make_graph_lstm(synthetic_graph(), 2, memoize = True)
+	stores = []
+	store = graph._store
+	graph._store = lambda *args: stores.append(args[:3]) or store(*args)
+
+	with torch.no_grad():
+		for depth in [4, 6, 8]:
+			del stores[:]
+			hidden_all, _ = graph('s29.n.01', depth)
+			assert len(stores) == len(set(stores)) == 2 * graph.num_layers * len(hidden_all)
+
+# the level engine plans the last stores of the recursion, so the states of the targets,
+# of all stored nodes and of the stacked layers are the same
+@pytest.mark.parametrize('num_layers', [1, 2])
+@pytest.mark.parametrize('memoize', [True, False])
+def test_level_engine_matches_recursive(num_layers, memoize):
+	graph_index = synthetic_graph()
+	recursive = make_graph_lstm(graph_index, num_layers, memoize = memoize)
+	level = make_graph_lstm(graph_index, num_layers, engine = 'level')
+
+	with torch.no_grad():
+		for depth in [1, 2, 3, 5]:
+			_, (hidden_final, cell_final) = level(TARGETS, depth)
+			for i, synset in enumerate(TARGETS):
+				_, (hidden, cell) = recursive(synset, depth)
+				assert torch.allclose(hidden_final[i], hidden, atol = 1e-6)
+				assert torch.allclose(cell_final[i], cell, atol = 1e-6)
+				assert_same_forward(level(synset, depth), recursive(synset, depth))
+
+# a mini-batch gives the states of the single forwards, and hidden_all keeps each node
+# from the last target that reached it; the recursion shares the first layer between the targets
+@pytest.mark.parametrize('engine', ['recursive', 'level'])
+def test_batch_matches_single_synsets(engine):
+	graph_index = synthetic_graph()
+	graph = make_graph_lstm(graph_index, 2, engine = engine)
+
+	with torch.no_grad():
+		batch_all, (hidden_final, cell_final) = graph(TARGETS, 3)
+		if engine == 'recursive':
+			batch_keys = set(key for key in graph.node_memo if key[0] == 0)
+		hidden_ids, cell_ids = graph.embed_ids(np.array([graph.synset_vocab(synset.replace('.', '__')) for synset in TARGETS]), 3)
+
+		single_all, single_keys = dict(), 0
+		for i, synset in enumerate(TARGETS):
+			hidden_all, (hidden, cell) = graph(synset, 3)
+			single_all.update(hidden_all)
+			if engine == 'recursive':
+				single_keys += sum(1 for key in graph.node_memo if key[0] == 0)
+			assert torch.allclose(hidden_final[i], hidden, atol = 1e-6)
+			assert torch.allclose(cell_final[i], cell, atol = 1e-6)
+			assert torch.allclose(hidden_ids[i], hidden, atol = 1e-6)
+
+		assert sorted(batch_all.keys()) == sorted(single_all.keys())
+		for name in batch_all:
+			assert torch.allclose(batch_all[name], single_all[name], atol = 1e-6)
+		if engine == 'recursive':
+			assert len(batch_keys) < single_keys
+
+@pytest.mark.parametrize('engine', ['recursive', 'level'])
+def test_depth_zero_is_the_complete_recursion(engine):
+	graph = make_graph_lstm(synthetic_graph(), 2, engine = engine)
+
+	with torch.no_grad():
+		for synset in TARGETS:
+			assert_same_forward(graph(synset, 0), graph(synset, -1))
+
+# without a depth limit, each node has a single state per direction (on a DAG),
+# which the recursion computes for the target once the depth is past the longest path of the graph
+# (the recursion would never stop without a depth limit, as each visit also visits the opposite direction)
+def test_complete_sweep_matches_recursion_past_the_longest_path():
+	graph_index = synthetic_graph()
+	graph = make_graph_lstm(graph_index, 1, memoize = True)
+	depth = graph_index.num_synsets + 1
+
+	with torch.no_grad():
+		synset_ids = np.array([graph.synset_vocab(synset.replace('.', '__')) for synset in TARGETS])
+		_, (hidden_complete, cell_complete) = graph._forward_complete(synset_ids)
+		for i, synset_id in enumerate(synset_ids.tolist()):
+			graph._forward_recursive(np.array([synset_id]), depth)
+			up, down = graph.node_memo[(0, 'up', synset_id, depth)], graph.node_memo[(0, 'down', synset_id, depth)]
+			assert torch.allclose(hidden_complete[i], torch.cat([up[0], down[0]]), atol = 1e-6)
+			assert torch.allclose(cell_complete[i], torch.cat([up[1], down[1]]), atol = 1e-6)
+
+# s0 -> s1 <-> s2 <- s3: the sweep stalls at s0, which is not on the cycle
+def test_cycle_broken_on_the_cycle():
+	hypernyms = [[1], [2], [1], [2]]
+	adjacency = {relation: [[] for _ in range(4)] for relation in RELATIONS}
+	adjacency['hypernyms'] = hypernyms
+	adjacency['hyponyms'] = [[idx for idx in range(4) if other in hypernyms[idx]] for other in range(4)]
+	graph = make_graph_lstm(graph_index_of(4, adjacency), 1)
+
+	rounds, _ = graph._plan_topological(np.arange(4), 'up')
+	positions = [round_positions.tolist() for round_positions, _, _ in rounds]
+	assert positions[0] in [[1], [2]]
+	assert sorted(sum(positions, [])) == [0, 1, 2, 3]
+
+	# s0 and s3 get their hypernym, only one edge of the cycle is dropped
+	num_edges = sum(int((src > 0).sum()) for _, src, _ in rounds)
+	assert num_edges == 3
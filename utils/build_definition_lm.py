@@ -0,0 +1,58 @@
+import argparse
+import pickle
+import torch
+import sys
+sys.path.append('..')
+from definition_table import DefinitionTable
+from lm_fusion import train_definition_lm, save_definition_lm
+
+'''
+train the small LSTM language model of the WordNet definitions
+for the shallow fusion in the decoding (see lm_fusion.py), fully offline
+from the prebuilt definition table (see build_definition_table.py)
+'''
+def main(args):
+
+	# get the decoder vocab
+	with open(args.vocab_path, 'rb') as f:
+		vocab = pickle.load(f)
+	print("Size of vocab: {}".format(vocab.idx))
+
+	definition_table = DefinitionTable(args.definition_dir)
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+	lm, lm_ids = train_definition_lm(
+		definition_table, 
+		vocab, 
+		lm_vocab_size = args.lm_vocab_size, 
+		embed_size = args.embed_size, 
+		hidden_size = args.hidden_size, 
+		epochs = args.epochs, 
+		batch_size = args.batch_size, 
+		device = device)
+	save_definition_lm(lm, lm_ids, args.lm_path)
+	print("Saved the definition language model to '{}'".format(args.lm_path))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--vocab_path', type = str, default = '../data/vocab.pkl',
+						help = 'path of the decoder vocabulary wrapper')
+	parser.add_argument('--definition_dir', type = str, default = '../data/definitions_17',
+						help = 'directory of the prebuilt definition table')
+	parser.add_argument('--lm_vocab_size', type = int, default = 10000,
+						help = 'number of words of the language model, the others are <unk>')
+	parser.add_argument('--embed_size', type = int, default = 128,
+						help = 'word embedding size of the language model')
+	parser.add_argument('--hidden_size', type = int, default = 256,
+						help = 'hidden size of the language model')
+	parser.add_argument('--epochs', type = int, default = 5,
+						help = 'number of epochs over the definitions')
+	parser.add_argument('--batch_size', type = int, default = 256,
+						help = 'number of definitions per step')
+	parser.add_argument('--lm_path', type = str, default = '../models/definition_lm.pth',
+						help = 'path for saving the language model')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
@@ -0,0 +1,44 @@
+import argparse
+import pickle
+import sys
+sys.path.append('..')
+from definition_table import build_definition_table
+
+'''
+tokenize the WordNet definitions of all synsets once for the decoder vocab
+so that the trainers fetch their targets by synset id, without NLTK at runtime
+e.g. graph2seq:
+	python build_definition_table.py --max_length 20 --out_dir ../data/definitions_20
+emb2seq:
+	python build_definition_table.py --max_length 17 --out_dir ../data/definitions_17
+'''
+def main(args):
+
+	# get the decoder vocab
+	with open(args.vocab_path, 'rb') as f:
+		vocab = pickle.load(f)
+	print("Size of vocab: {}".format(vocab.idx))
+
+	# get the graph lstm synset vocab
+	with open(args.synset_vocab_path, 'rb') as f:
+		synset_vocab = pickle.load(f)
+	print("Size of synset vocab: {}".format(synset_vocab.idx))
+
+	build_definition_table(synset_vocab, vocab, args.max_length, args.out_dir)
+	print("Saved the definition table to '{}'".format(args.out_dir))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--vocab_path', type = str, default = '../data/vocab.pkl',
+						help = 'path of the decoder vocabulary wrapper')
+	parser.add_argument('--synset_vocab_path', type = str, default = '../data/synset_vocab.pkl',
+						help = 'path of the synset vocabulary wrapper')
+	parser.add_argument('--max_length', type = int, default = 20,
+						help = 'max length of the definitions with <start> and <end>')
+	parser.add_argument('--out_dir', type = str, default = '../data/definitions_20',
+						help = 'directory for saving the definition table')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
@@ -0,0 +1,46 @@
+import argparse
+import sys
+sys.path.append('..')
+from elmo_cache import build_elmo_cache
+from wsd_data import iter_corpus
+
+'''
+prebuild the ELMo feature cache for the sentences of the WSD corpora
+only sentences with at least one tagged word are used by the trainers
+'''
+def corpus_sentences(corpus_path):
+	return [sentence for sentence, tagged_sent, _ in iter_corpus(corpus_path) if len(tagged_sent) > 0]
+
+def main(args):
+	sentences = []
+	for corpus_path in args.corpus_paths:
+		corpus = corpus_sentences(corpus_path)
+		sentences += corpus
+		print("Read {} sentences from '{}'".format(len(corpus), corpus_path))
+
+	entries = build_elmo_cache(
+		sentences, 
+		args.cache_dir, 
+		num_workers = args.num_workers, 
+		dtype = args.dtype, 
+		shard_tokens = args.shard_tokens)
+	print("Saved {} sentences to the ELMo cache '{}'".format(len(entries), args.cache_dir))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--corpus_paths', type = str, nargs = '+', 
+						default = ['../../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml', 
+								'../../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.data.xml'],
+						help = 'paths of the WSD corpora in XML')
+	parser.add_argument('--cache_dir', type = str, default = '../data/elmo_cache', 
+						help = 'directory for saving the ELMo cache')
+	parser.add_argument('--num_workers', type = int, default = 4, 
+						help = 'number of worker processes running ELMo')
+	parser.add_argument('--dtype', type = str, default = 'float32', choices = ['float32', 'float16'], 
+						help = 'dtype of the stored activations')
+	parser.add_argument('--shard_tokens', type = int, default = 20000, 
+						help = 'number of tokens per shard')
+	args = parser.parse_args()
+	main(args)
@@ -0,0 +1,32 @@
+import argparse
+import pickle
+import sys
+sys.path.append('..')
+from graph_index import WordNetGraphIndex
+
+'''
+build the CSR relation index of the WordNet for the graph lstm
+the synset ids follow the synset vocab
+'''
+def main(args):
+
+	# get the graph lstm synset vocab
+	with open(args.synset_vocab_path, 'rb') as f:
+		synset_vocab = pickle.load(f)
+	print("Size of synset vocab: {}".format(synset_vocab.idx))
+
+	graph_index = WordNetGraphIndex.build(synset_vocab)
+	graph_index.save(args.index_path)
+	print("Saved the graph index to '{}'".format(args.index_path))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--synset_vocab_path', type = str, default = '../data/synset_vocab.pkl',
+						help = 'path of the synset vocabulary wrapper')
+	parser.add_argument('--index_path', type = str, default = '../data/graph_index.npz',
+						help = 'path for saving the graph index')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
@@ -0,0 +1,153 @@
+import argparse
+import os
+import pickle
+import time
+import torch
+import sys
+sys.path.append('..')
+from graph_lstm import ChildSumGraphLSTM_WordNet
+from graph_index import WordNetGraphIndex
+from decoder import Decoder
+from graph2seq_model import Graph2Seq_Model
+from lm_fusion import load_lm_fusion
+from synset_definition_service import SynsetDefinitionService
+
+'''
+generate the definitions of synsets with the trained graph2seq model
+from the precomputed graph embeddings (see embed_wordnet.py), e.g.
+	python define_synsets.py dog.n.01 cat.n.01
+	python define_synsets.py --warm_semcor < synsets.txt
+the synsets are read from the command line, or one per line from the standard input
+'''
+def main(args):
+
+	# get the decoder vocab
+	with open(args.vocab_path, 'rb') as f:
+		vocab = pickle.load(f)
+	print("Size of vocab: {}".format(vocab.idx))
+
+	# get the graph lstm synset vocab
+	with open(args.synset_vocab_path, 'rb') as f:
+		synset_vocab = pickle.load(f)
+	print("Size of synset vocab: {}".format(synset_vocab.idx))
+
+	# get the prebuilt WordNet relation index over the synset vocab
+	graph_index = WordNetGraphIndex.load(args.index_path)
+
+	# the same settings as the pretrained graph2seq model
+	# the graph lstms are only built to load the checkpoint, they are not run
+	hyper_hypon_graph = ChildSumGraphLSTM_WordNet(
+		synset_vocab = synset_vocab,
+		graph_index = graph_index,
+		relationship = 'hyper_hypon',
+		input_size = 256,
+		hidden_size = 64,
+		num_layers = 2,
+		bidirectional = True,
+		bias = True,
+		dropout = 0.2,
+		engine = 'level')
+
+	mer_holo_graph = ChildSumGraphLSTM_WordNet(
+		synset_vocab = synset_vocab,
+		graph_index = graph_index,
+		relationship = 'mer_holo',
+		input_size = 256,
+		hidden_size = 64,
+		num_layers = 2,
+		bidirectional = True,
+		bias = True,
+		dropout = 0.2,
+		engine = 'level')
+
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+	decoder = Decoder(
+		vocab_size = vocab.idx,
+		max_seq_length = args.max_seq_length,
+		hidden_size = 256,
+		input_size = 512,
+		device = device)
+
+	model = Graph2Seq_Model(
+		hyper_hypon_graph,
+		mer_holo_graph,
+		args.hyper_hypon_depth,
+		args.mer_holo_depth,
+		decoder,
+		vocab = vocab,
+		max_seq_length = args.max_seq_length,
+		decoder_hidden_size = 256,
+		device = device)
+	model.load_state_dict(torch.load(args.model_path, map_location = device))
+	model.to(device)
+	model.eval()
+
+	lm_fusion = None
+	if args.lm_path is not None and os.path.exists(args.lm_path):
+		lm_fusion = load_lm_fusion(args.lm_path, weight = args.lm_weight, device = device)
+
+	service = SynsetDefinitionService(
+		model,
+		vocab,
+		synset_vocab,
+		args.embedding_dir,
+		cache_bytes = args.cache_mb << 20,
+		batch_size = args.batch_size,
+		beam_width = args.beam_width,
+		length_penalty = args.length_penalty,
+		lm_fusion = lm_fusion)
+
+	# decode the SemCor synset inventory ahead of the requests
+	if args.warm_semcor:
+		with open(args.synset_vocab_semcor_path, 'rb') as f:
+			synset_vocab_SemCor = pickle.load(f)
+		start_time = time.time()
+		num_decoded = service.warm([synset_vocab_SemCor.idx2word[idx] for idx in range(synset_vocab_SemCor.idx)])
+		print("Warmed the cache with {} SemCor synsets in {:.1f}s: {}".format(num_decoded, time.time() - start_time, service.cache.stats()))
+
+	synset_names = args.synsets if args.synsets else [line.strip() for line in sys.stdin if line.strip()]
+	for name, definition in zip(synset_names, service.define(synset_names)):
+		print("{}\t{}".format(name, definition))
+	print(service.cache.stats())
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('synsets', nargs = '*',
+						help = "names of the synsets to define, e.g. 'dog.n.01'")
+	parser.add_argument('--model_path', type = str, default = '../models/graph2seq_best_model.pth',
+						help = 'path of the trained graph2seq model')
+	parser.add_argument('--vocab_path', type = str, default = '../data/vocab.pkl',
+						help = 'path of the decoder vocabulary wrapper')
+	parser.add_argument('--synset_vocab_path', type = str, default = '../data/synset_vocab.pkl',
+						help = 'path of the synset vocabulary wrapper')
+	parser.add_argument('--synset_vocab_semcor_path', type = str, default = '../data/synset_vocab_SemCor.pkl',
+						help = 'path of the synset vocabulary wrapper of the SemCor')
+	parser.add_argument('--index_path', type = str, default = '../data/graph_index.npz',
+						help = 'path of the graph index')
+	parser.add_argument('--embedding_dir', type = str, default = '../data/graph_embeddings',
+						help = 'directory of the precomputed graph embeddings')
+	parser.add_argument('--max_seq_length', type = int, default = 20,
+						help = 'max length of the generated definitions')
+	parser.add_argument('--hyper_hypon_depth', type = int, default = 5,
+						help = 'recursion depth of the hyper_hypon graph of the model')
+	parser.add_argument('--mer_holo_depth', type = int, default = 5,
+						help = 'recursion depth of the mer_holo graph of the model')
+	parser.add_argument('--lm_path', type = str, default = None,
+						help = 'path of the definition language model for the shallow fusion, if any')
+	parser.add_argument('--lm_weight', type = float, default = 0.3,
+						help = 'weight of the language model in the fusion')
+	parser.add_argument('--beam_width', type = int, default = 1,
+						help = 'beam width of the decoding, 1 for greedy')
+	parser.add_argument('--length_penalty', type = float, default = 1.0,
+						help = 'length penalty of the beam search')
+	parser.add_argument('--batch_size', type = int, default = 256,
+						help = 'number of synsets decoded together')
+	parser.add_argument('--cache_mb', type = int, default = 64,
+						help = 'size of the definition cache in MB')
+	parser.add_argument('--warm_semcor', action = 'store_true',
+						help = 'decode all SemCor synsets into the cache first')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
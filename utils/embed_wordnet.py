@@ -0,0 +1,90 @@
+import argparse
+import pickle
+import torch
+import sys
+sys.path.append('..')
+from graph_lstm import ChildSumGraphLSTM_WordNet
+from graph_index import WordNetGraphIndex
+from graph_embeddings import export_graph_embeddings
+
+'''
+embed all synsets of the WordNet with the trained graph lstms
+(separated from the pretrained graph2seq model by separate_model.py)
+and save them as memory-mapped matrices indexed by the synset vocab id
+'''
+def main(args):
+
+	# get the graph lstm synset vocab
+	with open(args.synset_vocab_path, 'rb') as f:
+		synset_vocab = pickle.load(f)
+	print("Size of synset vocab: {}".format(synset_vocab.idx))
+
+	# get the prebuilt WordNet relation index over the synset vocab
+	graph_index = WordNetGraphIndex.load(args.index_path)
+
+	# the same settings as the pretrained graph2seq model
+	hyper_hypon_graph = ChildSumGraphLSTM_WordNet(
+		synset_vocab = synset_vocab, 
+		graph_index = graph_index, 
+		relationship = 'hyper_hypon', 
+		input_size = 256, 
+		hidden_size = 64, 
+		num_layers = 2, 
+		bidirectional = True, 
+		bias = True, 
+		dropout = 0.2, 
+		engine = 'level')
+
+	mer_holo_graph = ChildSumGraphLSTM_WordNet(
+		synset_vocab = synset_vocab, 
+		graph_index = graph_index, 
+		relationship = 'mer_holo',
+		input_size = 256, 
+		hidden_size = 64, 
+		num_layers = 2, 
+		bidirectional = True, 
+		bias = True, 
+		dropout = 0.2, 
+		engine = 'level')
+
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+	hyper_hypon_graph.load_state_dict(torch.load(args.hyper_hypon_path, map_location = device))
+	mer_holo_graph.load_state_dict(torch.load(args.mer_holo_path, map_location = device))
+	hyper_hypon_graph.to(device)
+	mer_holo_graph.to(device)
+
+	manifest = export_graph_embeddings(
+		hyper_hypon_graph, 
+		mer_holo_graph, 
+		args.hyper_hypon_depth, 
+		args.mer_holo_depth, 
+		args.out_dir, 
+		dtype = args.dtype, 
+		chunk_size = args.chunk_size)
+	print("Saved {} x {} graph embeddings to '{}'".format(manifest['num_synsets'], manifest['dim'], args.out_dir))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--synset_vocab_path', type = str, default = '../data/synset_vocab.pkl',
+						help = 'path of the synset vocabulary wrapper')
+	parser.add_argument('--index_path', type = str, default = '../data/graph_index.npz',
+						help = 'path of the graph index')
+	parser.add_argument('--hyper_hypon_path', type = str, default = '../models/hyper_hypon_graph.pth',
+						help = 'path of the trained hyper_hypon graph lstm')
+	parser.add_argument('--mer_holo_path', type = str, default = '../models/mer_holo_graph.pth',
+						help = 'path of the trained mer_holo graph lstm')
+	parser.add_argument('--hyper_hypon_depth', type = int, default = 5,
+						help = 'recursion depth of the hyper_hypon graph, -1 for the complete graph')
+	parser.add_argument('--mer_holo_depth', type = int, default = 5,
+						help = 'recursion depth of the mer_holo graph, -1 for the complete graph')
+	parser.add_argument('--chunk_size', type = int, default = 1024,
+						help = 'number of synsets per level sweep for the depth-limited graphs')
+	parser.add_argument('--dtype', type = str, default = 'float32', choices = ['float32', 'float16'],
+						help = 'dtype of the saved matrices')
+	parser.add_argument('--out_dir', type = str, default = '../data/graph_embeddings',
+						help = 'directory for saving the matrices and the manifest')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
@@ -0,0 +1,70 @@
+import argparse
+import pickle
+import sys
+sys.path.append('..')
+from wsd_data import GoldKeyIndex, compile_corpus, iter_sentences
+from definition_table import DefinitionTable
+
+'''
+compile a WSD corpus (XML data and gold keys) into memory-mapped numpy arrays
+so that the trainers do no XML or NLTK work at runtime
+e.g. SemCor:
+	python preprocess_corpus.py --out_dir ../data/semcor
+SemEval 2007:
+	python preprocess_corpus.py 
+		--corpus_path ../../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.data.xml 
+		--key_path ../../WSD_Evaluation_Framework/Evaluation_Datasets/semeval2007/semeval2007.gold.key.txt 
+		--out_dir ../data/semeval2007
+'''
+def main(args):
+
+	# get the decoder vocab
+	with open(args.vocab_path, 'rb') as f:
+		vocab = pickle.load(f)
+	print("Size of vocab: {}".format(vocab.idx))
+
+	# copy the definition ids from the prebuilt definition table if any
+	# see build_definition_table.py
+	definition_table, synset_vocab = None, None
+	if args.definition_dir is not None:
+		definition_table = DefinitionTable(args.definition_dir)
+		with open(args.synset_vocab_path, 'rb') as f:
+			synset_vocab = pickle.load(f)
+
+	gold_keys = GoldKeyIndex.from_key_file(args.key_path)
+	num_sentences = compile_corpus(
+		iter_sentences(args.corpus_path), 
+		gold_keys, 
+		vocab, 
+		args.max_length, 
+		args.out_dir, 
+		split_phrases = args.split_phrases, 
+		definition_table = definition_table, 
+		synset_vocab = synset_vocab)
+	print("Saved {} sentences to '{}'".format(num_sentences, args.out_dir))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--corpus_path', type = str, 
+						default = '../../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml', 
+						help = 'path of the corpus in XML')
+	parser.add_argument('--key_path', type = str, 
+						default = '../../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.gold.key.txt', 
+						help = 'path of the gold keys of the corpus')
+	parser.add_argument('--vocab_path', type = str, default = '../data/vocab.pkl', 
+						help = 'path of the decoder vocabulary wrapper')
+	parser.add_argument('--max_length', type = int, default = 17, 
+						help = 'max length of the definitions with <start> and <end>')
+	parser.add_argument('--split_phrases', action = 'store_true', 
+						help = 'split the multi-word phrases into words')
+	parser.add_argument('--definition_dir', type = str, default = None, 
+						help = 'directory of the prebuilt definition table with the same max_length')
+	parser.add_argument('--synset_vocab_path', type = str, default = '../data/synset_vocab.pkl', 
+						help = 'path of the synset vocabulary wrapper of the definition table')
+	parser.add_argument('--out_dir', type = str, default = '../data/semcor', 
+						help = 'directory for saving the compiled corpus')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
@@ -6,6 +6,7 @@ sys.path.append('..')
 import graph_lstm 
 import decoder
 import graph2seq_model 
+from graph_index import WordNetGraphIndex
 
 # separate the decoder and grapsh from pretraining graph
 def separate_from_graph(path):
@@ -20,6 +21,9 @@ def separate_from_graph(path):
 		synset_vocab = pickle.load(f)
 	print("Size of synset vocab: {}".format(synset_vocab.idx))
 
+	# get the prebuilt WordNet relation index over the synset vocab
+	graph_index = WordNetGraphIndex.load('../data/graph_index.npz')
+
 	# some hyperparameters
 	max_seq_length = 20
 	decoder_hidden_size = 256
@@ -30,6 +34,7 @@ def separate_from_graph(path):
 	# set the hyper-hypon and mer-holo graph lstms
 	hyper_hypon_graph = ChildSumGraphLSTM_WordNet(
 		synset_vocab = synset_vocab, 
+		graph_index = graph_index, 
 		relationship = 'hyper_hypon', 
 		input_size = 256, 
 		hidden_size = 64, 
@@ -40,6 +45,7 @@ def separate_from_graph(path):
 
 	mer_holo_graph = ChildSumGraphLSTM_WordNet(
 		synset_vocab = synset_vocab, 
+		graph_index = graph_index, 
 		relationship = 'mer_holo',
 		input_size = 256, 
 		hidden_size = 64, 
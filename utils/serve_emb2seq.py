@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import os
+import pickle
+import torch
+import sys
+sys.path.append('..')
+from encoder import Encoder
+from decoder import Decoder
+from emb2seq_model import Emb2Seq_Model
+from definition_table import DefinitionTable
+from lm_fusion import load_lm_fusion
+from emb2seq_server import DynamicBatcher, DefinitionServer
+
+'''
+serve a trained Emb2Seq_Model (see emb2seq_server.py), e.g.
+	python serve_emb2seq.py --port 8080
+	python serve_emb2seq.py --unix_socket /tmp/emb2seq.sock
+	curl -d '{"sentence": ["The", "dog", "barks"], "positions": [1]}' localhost:8080/define
+	curl localhost:8080/metrics
+'''
+def main(args):
+
+	# get the decoder vocab
+	with open(args.vocab_path, 'rb') as f:
+		vocab = pickle.load(f)
+	print("Size of vocab: {}".format(vocab.idx))
+
+	device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+	# the output layer must match the trained decoder
+	word_counts = None
+	if args.output_layer != 'linear':
+		word_counts = DefinitionTable(args.definition_dir).word_counts(vocab.idx)
+
+	from allennlp.commands.elmo import ElmoEmbedder
+	elmo = ElmoEmbedder(cuda_device = 0 if torch.cuda.is_available() else -1)
+
+	encoder = Encoder(elmo_class = elmo, device = device)
+	decoder = Decoder(
+		vocab_size = vocab.idx,
+		max_seq_length = args.max_seq_length,
+		hidden_size = args.decoder_hidden_size,
+		output_layer = args.output_layer,
+		word_counts = word_counts,
+		device = device)
+	model = Emb2Seq_Model(
+		encoder,
+		decoder,
+		vocab = vocab,
+		max_seq_length = args.max_seq_length,
+		decoder_hidden_size = args.decoder_hidden_size,
+		device = device)
+	model.load_state_dict(torch.load(args.model_path, map_location = device))
+	model.to(device)
+	model.eval()
+
+	lm_fusion = None
+	if args.lm_path is not None and os.path.exists(args.lm_path):
+		lm_fusion = load_lm_fusion(args.lm_path, weight = args.lm_weight, device = device)
+
+	batcher = DynamicBatcher(
+		model,
+		vocab,
+		max_instances = args.max_instances,
+		max_latency = args.max_latency_ms / 1000,
+		beam_width = args.beam_width,
+		length_penalty = args.length_penalty,
+		lm_fusion = lm_fusion)
+	server = DefinitionServer(batcher, host = args.host, port = args.port, unix_socket = args.unix_socket)
+
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(server.start())
+	print("Serving on '{}'".format(args.unix_socket if args.unix_socket is not None else '{}:{}'.format(args.host, args.port)))
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		loop.run_until_complete(server.stop())
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument('--model_path', type = str, default = '../models/emb2seq_best_model.pth',
+						help = 'path of the trained Emb2Seq_Model')
+	parser.add_argument('--vocab_path', type = str, default = '../data/vocab.pkl',
+						help = 'path of the decoder vocabulary wrapper')
+	parser.add_argument('--max_seq_length', type = int, default = 17,
+						help = 'max length of the generated definitions')
+	parser.add_argument('--decoder_hidden_size', type = int, default = 256,
+						help = 'hidden size of the trained decoder')
+	parser.add_argument('--output_layer', type = str, default = 'linear',
+						help = "output layer of the trained decoder: 'linear', 'adaptive' or 'sampled'")
+	parser.add_argument('--definition_dir', type = str, default = '../data/definitions_17',
+						help = 'definition table for the word counts of the adaptive or sampled output layer')
+	parser.add_argument('--lm_path', type = str, default = None,
+						help = 'path of the definition language model for the shallow fusion, if any')
+	parser.add_argument('--lm_weight', type = float, default = 0.3,
+						help = 'weight of the language model in the fusion')
+	parser.add_argument('--beam_width', type = int, default = 1,
+						help = 'beam width of the decoding, 1 for greedy')
+	parser.add_argument('--length_penalty', type = float, default = 1.0,
+						help = 'length penalty of the beam search')
+	parser.add_argument('--max_instances', type = int, default = 64,
+						help = 'max number of target words per batch')
+	parser.add_argument('--max_latency_ms', type = float, default = 10,
+						help = 'max time a request waits for its batch to fill')
+	parser.add_argument('--host', type = str, default = '127.0.0.1',
+						help = 'host of the HTTP server')
+	parser.add_argument('--port', type = int, default = 8080,
+						help = 'port of the HTTP server')
+	parser.add_argument('--unix_socket', type = str, default = None,
+						help = 'serve on this Unix socket instead of host and port')
+	args = parser.parse_args()
+	from build_vocab import Vocabulary
+	main(args)
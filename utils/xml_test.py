@@ -1,36 +1,26 @@
-import xml.etree.ElementTree as ET
-tree = ET.parse('../../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml')
+import sys
+sys.path.append('..')
+from wsd_data import iter_corpus
 from nltk.corpus import wordnet as wn
 import time
 import math
 
-corpus = tree.getroot()
-
+# stream the corpus sentence by sentence instead of parsing the whole tree
 sentence_num = 0
-i = 0
-for text in corpus[30:40]:
+tagged_num = 0
+for sentence, tagged_sent, spans in iter_corpus('../../WSD_Evaluation_Framework/Training_Corpora/SemCor/semcor.data.xml'):
 
-	i += 1
-	sentence_num += len(text)
+	sentence_num += 1
+	if len(tagged_sent) > 0:
+		tagged_num += 1
 
-	if i % 10 == 0:
-		print("[{}/{}] subcorpus done.".format(i, len(corpus)))
+	if sentence_num % 10000 == 0:
+		print("[{}] sentences done.".format(sentence_num))
 
 	'''
-	for sentence in text:
-
-		tagged_sent = [instance for instance in sentence if instance.tag == 'instance']
-		# print([instance.text for instance in tagged_sent])
-
-		if len(tagged_sent) > 0:
-
-			# get all-word definitions, batch_size is the sentence length
-			# [batch_size, self.max_length]
-			print([instance.text for instance in sentence])
+	# get all-word definitions, batch_size is the sentence length
+	# [batch_size, self.max_length]
+	print(sentence)
+	print([instance.text for instance in tagged_sent], spans)
 	'''
-print(sentence_num)
-
-
-
-
-
+print(sentence_num, tagged_num)
@@ -0,0 +1,335 @@
+import json
+import os
+import pickle
+import numpy as np
+import xml.etree.ElementTree as ET
+
+'''
+data utilities shared by the emb2seq trainers
+for the WSD corpora of the WSD_Evaluation_Framework (SemCor, SemEval)
+'''
+
+# stream the XML elements of the sentences of a WSD corpus one at a time
+# each sentence is detached from the tree once processed, so memory stays bounded
+def iter_sentences(corpus_path):
+	context = ET.iterparse(corpus_path, events = ('start', 'end'))
+
+	# the open elements from the root to the current one
+	parents = []
+	for event, elem in context:
+		if event == 'start':
+			parents.append(elem)
+			continue
+
+		parents.pop()
+		if elem.tag == 'sentence':
+			yield elem
+
+			# the tagged instances held by the caller are still valid
+			elem.clear()
+			if parents:
+				parents[-1].remove(elem)
+
+# stream (sentence, tagged_sent, spans) of each sentence of a WSD corpus
+# see sentence_instances
+def iter_corpus(corpus_path, split_phrases = False):
+	for sent in iter_sentences(corpus_path):
+		yield sentence_instances(sent, split_phrases)
+
+# the plain sentence, the tagged instances and their token positions
+# from the XML element of a sentence
+def sentence_instances(sent, split_phrases = False):
+	'''
+	split_phrases: split the multi-word phrases into words for ELMo,
+		the phrase span is then average pooled by the encoder
+		otherwise each XML element is one token, as in the original pipeline
+
+	@return:
+	sentence: list of tokens
+	tagged_sent: list of the tagged XML elements ('instance')
+	spans: list of (start, end) token positions of each tagged element
+	'''
+	sentence, tagged_sent, spans = [], [], []
+	for word in sent:
+		tokens = word.text.split(' ') if split_phrases else [word.text]
+		if word.tag == 'instance':
+			tagged_sent.append(word)
+			spans.append((len(sentence), len(sentence) + len(tokens)))
+		sentence.extend(tokens)
+
+	return sentence, tagged_sent, spans
+
+class GoldKeyIndex(object):
+	"""The gold sense keys of a WSD corpus, loaded once
+	instance id -> sense key -> synset name (and its WordNet definition)
+	"""
+
+	def __init__(self, sense_keys, synsets, definitions):
+
+		# {instance id: sense key}
+		self.sense_keys = sense_keys
+
+		# {sense key: synset name}
+		self.synsets = synsets
+
+		# {synset name: definition}
+		self.definitions = definitions
+
+	# read the whole gold key file once
+	# each line is: instance id, sense key(s); the last sense key is used
+	@classmethod
+	def from_key_file(cls, key_path):
+		from nltk.corpus import wordnet as wn
+
+		sense_keys, synsets, definitions = {}, {}, {}
+		with open(key_path, 'r') as f:
+			for line in f:
+				fields = line.split()
+				if not fields:
+					continue
+				instance_id, key = fields[0], fields[-1]
+				sense_keys[instance_id] = key
+
+				if key not in synsets:
+					synset = wn.lemma_from_key(key).synset()
+					synsets[key] = synset.name()
+					definitions[synset.name()] = synset.definition()
+
+		return cls(sense_keys, synsets, definitions)
+
+	def save(self, path):
+		with open(path, 'wb') as f:
+			pickle.dump((self.sense_keys, self.synsets, self.definitions), f, protocol = pickle.HIGHEST_PROTOCOL)
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			return cls(*pickle.load(f))
+
+	def sense_key(self, instance_id):
+		return self.sense_keys[instance_id]
+
+	def synset(self, instance_id):
+		return self.synsets[self.sense_keys[instance_id]]
+
+	def definition(self, instance_id):
+		return self.definitions[self.synset(instance_id)]
+
+	# batch lookup for all tagged instances (XML elements) of a sentence
+	def synsets_of(self, tagged_sent):
+		return [self.synset(instance.get('id')) for instance in tagged_sent]
+
+	def definitions_of(self, tagged_sent):
+		return [self.definition(instance.get('id')) for instance in tagged_sent]
+
+# load the gold key index from its binary form
+# or build it from the key file and save it on the first run
+def load_gold_keys(key_path, index_path):
+	if os.path.exists(index_path):
+		return GoldKeyIndex.load(index_path)
+
+	gold_keys = GoldKeyIndex.from_key_file(key_path)
+	gold_keys.save(index_path)
+	print("Saved the gold key index of '{}' to '{}'".format(key_path, index_path))
+	return gold_keys
+
+# utility function
+# turn the given definition into its index list form
+def def2idx(definition, max_length, vocab):
+	import nltk
+	
+	# definition is given by the WN NLTK API in a string
+	def_tokens = nltk.tokenize.word_tokenize(definition.lower())
+	
+	# limit the length if too long, trim
+	if len(def_tokens) > (max_length - 2):
+		def_tokens = def_tokens[0:(max_length - 2)]
+		
+		# add the start and end symbol
+		def_tokens = ['<start>'] + def_tokens + ['<end>']
+	
+	# if the length is too short, pad
+	elif len(def_tokens) < (max_length - 2):
+		
+		# add the start and end symbol
+		def_tokens = ['<start>'] + def_tokens + ['<end>']
+		
+		pad = ['<pad>'] * (max_length - len(def_tokens))
+		def_tokens = def_tokens + pad
+		
+	else:
+		def_tokens = ['<start>'] + def_tokens + ['<end>']
+			
+	# get the index for each element in the token list
+	def_idx_list = [vocab(token) for token in def_tokens]
+	
+	return def_idx_list
+
+# the (len(synsets), max_length) int32 definition ids of the given gold synsets
+# copied from the definition table if any, otherwise tokenized
+def _definition_ids(synsets, gold_keys, vocab, max_length, definition_table = None, synset_vocab = None):
+	if definition_table is None:
+		return np.array([def2idx(gold_keys.definitions[synset], max_length, vocab) for synset in synsets], dtype = np.int32).reshape(-1, max_length)
+
+	if definition_table.max_length != max_length:
+		raise ValueError('the definition table is built for max_length {}'.format(definition_table.max_length))
+	return definition_table.rows(definition_table.ids(synset_vocab, synsets))
+
+'''
+the preprocessed binary form of a WSD corpus
+only the sentences with at least one tagged word are kept
+	tokens.json: the distinct token strings
+	token_ids.npy: (num_tokens) int32, the tokens of all sentences
+	sentence_offsets.npy: (num_sentences + 1) int64, sentence i is token_ids[offsets[i]:offsets[i + 1]]
+	instance_offsets.npy: (num_sentences + 1) int64, the same for the tagged instances
+	instance_spans.npy: (num_instances, 2) int32, (start, end) token positions in the sentence
+	instance_synsets.npy: (num_instances) int32, the gold synset of each instance in synsets.json
+	definitions.npy: (num_synsets, max_length) int32, the padded definition ids of each synset
+	synsets.json: the gold synset names and their literal definitions
+	instance_ids.json: the XML id of each instance
+'''
+def compile_corpus(corpus, gold_keys, vocab, max_length, out_dir, split_phrases = False,
+				definition_table = None, synset_vocab = None):
+	'''
+	corpus: an iterable of the XML elements of the sentences
+	gold_keys: the GoldKeyIndex of the corpus
+	definition_table: the prebuilt DefinitionTable of the synset vocab (see definition_table.py)
+		to copy the definition ids from, instead of tokenizing the definitions
+	'''
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+
+	token_index, tokens, token_ids = {}, [], []
+	synset_index, synsets, definitions = {}, [], []
+	sentence_offsets, instance_offsets = [0], [0]
+	instance_spans, instance_synsets, instance_ids = [], [], []
+
+	for sent in corpus:
+		sentence, tagged_sent, spans = sentence_instances(sent, split_phrases)
+		if len(tagged_sent) == 0:
+			continue
+
+		for token in sentence:
+			if token not in token_index:
+				token_index[token] = len(tokens)
+				tokens.append(token)
+			token_ids.append(token_index[token])
+
+		# tokenize each gold definition once per corpus
+		for instance, synset in zip(tagged_sent, gold_keys.synsets_of(tagged_sent)):
+			if synset not in synset_index:
+				synset_index[synset] = len(synsets)
+				synsets.append(synset)
+				definitions.append(_definition_ids([synset], gold_keys, vocab, max_length, definition_table, synset_vocab)[0])
+			instance_synsets.append(synset_index[synset])
+			instance_ids.append(instance.get('id'))
+
+		instance_spans.extend(spans)
+		sentence_offsets.append(len(token_ids))
+		instance_offsets.append(len(instance_synsets))
+
+		if (len(sentence_offsets) - 1) % 10000 == 0:
+			print("[{}] sentences compiled.".format(len(sentence_offsets) - 1))
+
+	np.save(os.path.join(out_dir, 'token_ids.npy'), np.array(token_ids, dtype = np.int32))
+	np.save(os.path.join(out_dir, 'sentence_offsets.npy'), np.array(sentence_offsets, dtype = np.int64))
+	np.save(os.path.join(out_dir, 'instance_offsets.npy'), np.array(instance_offsets, dtype = np.int64))
+	np.save(os.path.join(out_dir, 'instance_spans.npy'), np.array(instance_spans, dtype = np.int32).reshape(-1, 2))
+	np.save(os.path.join(out_dir, 'instance_synsets.npy'), np.array(instance_synsets, dtype = np.int32))
+	np.save(os.path.join(out_dir, 'definitions.npy'), np.array(definitions, dtype = np.int32).reshape(-1, max_length))
+
+	with open(os.path.join(out_dir, 'tokens.json'), 'w') as f:
+		json.dump(tokens, f)
+	with open(os.path.join(out_dir, 'synsets.json'), 'w') as f:
+		json.dump({'synsets': synsets, 'definitions': [gold_keys.definitions[synset] for synset in synsets]}, f)
+	with open(os.path.join(out_dir, 'instance_ids.json'), 'w') as f:
+		json.dump(instance_ids, f)
+
+	return len(sentence_offsets) - 1
+
+class WSDDataset(object):
+	"""A compiled WSD corpus (see compile_corpus), memory-mapped
+	Each item is (sentence, spans, definitions, literal_definitions) of a sentence:
+	the list of tokens, the (num_tagged, 2) spans of the tagged words,
+	their (num_tagged, max_length) definition ids and their literal definitions.
+	"""
+
+	def __init__(self, data_dir):
+		self.data_dir = data_dir
+
+		def load(name):
+			return np.load(os.path.join(data_dir, name), mmap_mode = 'r')
+
+		self.token_ids = load('token_ids.npy')
+		self.sentence_offsets = load('sentence_offsets.npy')
+		self.instance_offsets = load('instance_offsets.npy')
+		self.instance_spans = load('instance_spans.npy')
+		self.instance_synsets = load('instance_synsets.npy')
+		self.definitions = load('definitions.npy')
+
+		with open(os.path.join(data_dir, 'tokens.json'), 'r') as f:
+			self.tokens = json.load(f)
+		with open(os.path.join(data_dir, 'synsets.json'), 'r') as f:
+			synsets = json.load(f)
+			self.synsets = synsets['synsets']
+			self.literal_definitions = synsets['definitions']
+
+	def __len__(self):
+		return len(self.sentence_offsets) - 1
+
+	def __getitem__(self, idx):
+		tokens = self.token_ids[self.sentence_offsets[idx]:self.sentence_offsets[idx + 1]]
+		start, end = self.instance_offsets[idx], self.instance_offsets[idx + 1]
+		synsets = self.instance_synsets[start:end]
+
+		sentence = [self.tokens[token] for token in tokens.tolist()]
+		spans = np.asarray(self.instance_spans[start:end])
+		definitions = self.definitions[synsets]
+		literal_definitions = [self.literal_definitions[synset] for synset in synsets.tolist()]
+		return sentence, spans, definitions, literal_definitions
+
+	def __iter__(self):
+		for idx in range(len(self)):
+			yield self[idx]
+
+class StreamingCorpus(object):
+	"""A WSD corpus read from its XML on the fly, sentence by sentence
+	Yields the same (sentence, spans, definitions, literal_definitions) items as WSDDataset,
+	for the sentences with at least one tagged word; it can be iterated once per epoch.
+	"""
+
+	def __init__(self, corpus_path, gold_keys, vocab, max_length, split_phrases = False,
+				definition_table = None, synset_vocab = None):
+		self.corpus_path = corpus_path
+		self.gold_keys = gold_keys
+		self.vocab = vocab
+		self.max_length = max_length
+		self.split_phrases = split_phrases
+
+		# the prebuilt definition ids, see compile_corpus
+		self.definition_table = definition_table
+		self.synset_vocab = synset_vocab
+
+	def __iter__(self):
+		return self.iter_shard(0, 1)
+
+	# only every num_shards-th sentence with tagged words, from the shard_id-th one
+	# the other sentences are skipped before their definitions are looked up and tokenized
+	def iter_shard(self, shard_id, num_shards):
+		tagged_idx = -1
+		for sentence, tagged_sent, spans in iter_corpus(self.corpus_path, self.split_phrases):
+			if len(tagged_sent) == 0:
+				continue
+			tagged_idx += 1
+			if tagged_idx % num_shards != shard_id:
+				continue
+
+			literal_definitions = self.gold_keys.definitions_of(tagged_sent)
+			definitions = _definition_ids(
+				self.gold_keys.synsets_of(tagged_sent), 
+				self.gold_keys, 
+				self.vocab, 
+				self.max_length, 
+				self.definition_table, 
+				self.synset_vocab)
+			yield sentence, np.array(spans, dtype = np.int32).reshape(-1, 2), definitions, literal_definitions